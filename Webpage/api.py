@@ -1,13 +1,41 @@
-from fastapi import FastAPI, Query
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+import numpy as np
 import pandas as pd
 import os
-from typing import Optional
+from typing import Literal, Optional
 import folium
 from folium.plugins import HeatMap
+from cache import CachedResponse, PresetStore, ResponseCache, SingleFlight, canonical_params
+from dataset import Dataset, DANGEROUS_MIN_CRASHES, LOCATION_DELTA, top_k
+from export import MEDIA_TYPES, StaleCursor, export_chunks, make_cursor, page_end, pa, read_cursor
+from filters import parse_date
+from heatmap import grid_cells, heat_grid, heat_points, pack_points, tile_features
+from responses import FrameJSONResponse, RankingResponse, SampleResponse, TimeSeriesResponse
+from snapshot import load_dataframe, load_snapshot, read_meta
+from timing import Metrics, TimingMiddleware, in_context, logger, note, profiled, record_error, stage
 
-app = FastAPI()
+# Requests share one DataFrame; copy-on-write guarantees nothing derived from
+# it can write back into the shared columns
+pd.set_option("mode.copy_on_write", True)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load the data before taking requests, so none of them waits for it
+    await asyncio.get_running_loop().run_in_executor(render_executor, get_dataset)
+    watcher = asyncio.create_task(watch_snapshot())
+    yield
+    watcher.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS so Vue frontend can access the API
 app.add_middleware(
@@ -18,110 +46,188 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Stage timings of every request, served by /metrics
+metrics = Metrics()
+app.add_middleware(TimingMiddleware, metrics=metrics)
+
 # Path to your dataset
-DATA_PATH = os.path.join(os.path.dirname(__file__), "..", "Newnew_dataset.csv")
+DATA_PATH = os.environ.get("CRASH_DATA_PATH", os.path.join(os.path.dirname(__file__), "..", "Newnew_dataset.csv"))
+# Columnar snapshot built from it by snapshot.py
+SNAPSHOT_DIR = os.environ.get("CRASH_SNAPSHOT_DIR", os.path.join(os.path.dirname(__file__), "..", "Newnew_dataset.snapshot"))
+
+# Rendered map and ranking responses, reused for repeated filter combinations
+response_cache = ResponseCache()
+# Browsers keep responses but revalidate them with the ETag before reuse
+CACHE_CONTROL = "no-cache"
+
+# Zoom level the map opens at, and the deepest one grid mode bins for
+MAP_ZOOM = 11
+MAX_ZOOM = 18
+# Deepest map tile served by /tiles
+MAX_TILE_ZOOM = 22
+
+# Largest radius /api/nearby searches, and the crash columns it lists
+MAX_RADIUS_M = 5000
+NEARBY_COLUMNS = ['CRASH_RECORD_ID', 'CRASH_DATE', 'STREET_NAME', 'LATITUDE', 'LONGITUDE',
+                  'INJURY_SCORE', 'INJURIES_FATAL', 'INJURIES_INCAPACITATING', 'INJURIES_NON_INCAPACITATING']
+
+# Responses precomputed by precompute.py, stored inside the snapshot directory
+PRESET_DIR = "presets"
+preset_store = PresetStore()
+
+# Rendering is pandas/numpy work that mostly holds the GIL, so it runs on a
+# pool no larger than the machine instead of one thread per request, off the
+# event loop
+RENDER_WORKERS = os.cpu_count() or 1
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+# Concurrent requests for the same response share one render
+render_flights = SingleFlight()
+
+# Seconds between checks for a new snapshot written by ingest.py
+RELOAD_INTERVAL = 5
 
 # Load data once at startup
-df_cache = None
-
-# Cause categories from st_ranking2.py
-USER_ERROR = ['DRIVING SKILLS/KNOWLEDGE/EXPERIENCE', 'FAILING TO REDUCE SPEED TO AVOID CRASH', 
-    'IMPROPER OVERTAKING/PASSING', 'FOLLOWING TOO CLOSELY', 'DISTRACTION - FROM OUTSIDE VEHICLE',
-    'FAILING TO YIELD RIGHT-OF-WAY', 'DISREGARDING STOP SIGN', 'IMPROPER LANE USAGE',
-    'IMPROPER TURNING/NO SIGNAL', 'OPERATING VEHICLE IN ERRATIC, RECKLESS, CARELESS, NEGLIGENT OR AGGRESSIVE MANNER',
-    'IMPROPER BACKING', 'DISTRACTION - FROM INSIDE VEHICLE', 'DRIVING ON WRONG SIDE/WRONG WAY',
-    'DISREGARDING TRAFFIC SIGNALS', 'CELL PHONE USE OTHER THAN TEXTING', 'PHYSICAL CONDITION OF DRIVER',
-    'DISREGARDING OTHER TRAFFIC SIGNS', 'RELATED TO BUS STOP', 'DISREGARDING ROAD MARKINGS',
-    'TURNING RIGHT ON RED', 'UNDER THE INFLUENCE OF ALCOHOL/DRUGS (USE WHEN ARREST IS EFFECTED)',
-    'HAD BEEN DRINKING (USE WHEN ARREST IS NOT MADE)', 'TEXTING', 'OBSTRUCTED CROSSWALKS',
-    'DISTRACTION - OTHER ELECTRONIC DEVICE (NAVIGATION DEVICE, DVD PLAYER, ETC.)',
-    'PASSING STOPPED SCHOOL BUS', 'DISREGARDING YIELD SIGN', 'BICYCLE ADVANCING LEGALLY ON RED LIGHT',
-    'MOTORCYCLE ADVANCING LEGALLY ON RED LIGHT', 'EXCEEDING AUTHORIZED SPEED LIMIT',
-    'EXCEEDING SAFE SPEED FOR CONDITIONS']
-
-NON_USER_ERROR = ['ANIMAL', 'ROAD ENGINEERING/SURFACE/MARKING DEFECTS',
-    'VISION OBSCURED (SIGNS, TREE LIMBS, BUILDINGS, ETC.)',
-    'EVASIVE ACTION DUE TO ANIMAL, OBJECT, NONMOTORIST', 'WEATHER', 'ROAD CONSTRUCTION/MAINTENANCE']
-
-VEHICLE_ERROR = ['EQUIPMENT - VEHICLE CONDITION']
-
-
-def get_dataframe():
-    global df_cache
-    if df_cache is None:
-        df_cache = pd.read_csv(DATA_PATH)
-        df_cache["COUNT"] = 1
-        # Convert date column
-        if "CRASH_DATE_ONLY" in df_cache.columns:
-            df_cache["CRASH_DATE_ONLY"] = pd.to_datetime(df_cache["CRASH_DATE_ONLY"])
-    return df_cache.copy()
-
-
-def apply_filters(df, date_start, date_end, damage, crash_type, injuries, cause, lighting):
-    """Apply all filters to dataframe"""
-    # Apply date filter
-    if date_start:
-        start_dt = pd.to_datetime(date_start)
-        df = df[df["CRASH_DATE_ONLY"] >= start_dt]
-    if date_end:
-        end_dt = pd.to_datetime(date_end)
-        df = df[df["CRASH_DATE_ONLY"] <= end_dt]
-    
-    # Apply damage filter
-    if damage:
-        damage_list = damage.split(',')
-        df = df[df["DAMAGE"].isin(damage_list)]
-    
-    # Apply crash type filter
-    if crash_type:
-        crash_list = crash_type.split(',')
-        df = df[df["CRASH_TYPE"].isin(crash_list)]
-    
-    # Apply injury filter
-    if injuries:
-        injury_list = injuries.split(',')
-        injury_conditions = []
-        if 'none' in injury_list:
-            injury_conditions.append(df["INJURY_SCORE"] == 0)
-        if 'non_incapacitating' in injury_list:
-            injury_conditions.append(df["INJURIES_NON_INCAPACITATING"] > 0)
-        if 'incapacitating' in injury_list:
-            injury_conditions.append(df["INJURIES_INCAPACITATING"] > 0)
-        if 'fatal' in injury_list:
-            injury_conditions.append(df["INJURIES_FATAL"] > 0)
-        
-        if injury_conditions:
-            combined = injury_conditions[0]
-            for cond in injury_conditions[1:]:
-                combined = combined | cond
-            df = df[combined]
-    
-    # Apply cause filter
-    if cause:
-        cause_list = cause.split(',')
-        cause_values = []
-        if 'user' in cause_list:
-            cause_values.extend(USER_ERROR)
-        if 'non_user' in cause_list:
-            cause_values.extend(NON_USER_ERROR)
-        if 'vehicle' in cause_list:
-            cause_values.extend(VEHICLE_ERROR)
-        
-        if cause_values:
-            cause_col = None
-            for col in ['PRIM_CONTRIBUTORY_CAUSE', 'PRIMARY_CONTRIBUTORY_CAUSE', 'PRIMARY_CAUSE']:
-                if col in df.columns:
-                    cause_col = col
-                    break
-            if cause_col:
-                df = df[df[cause_col].isin(cause_values)]
-    
-    # Apply lighting filter
-    if lighting:
-        lighting_list = lighting.split(',')
-        df = df[df["LIGHTING_CONDITION"].isin(lighting_list)]
-    
-    return df
+dataset_cache = None
+dataset_lock = threading.Lock()
+# The dataset a cached response is rendered from, pinned for the whole render
+request_dataset = contextvars.ContextVar("dataset", default=None)
+
+
+def get_dataset():
+    global dataset_cache
+    pinned = request_dataset.get()
+    if pinned is not None:
+        return pinned
+    if dataset_cache is None:
+        with dataset_lock:
+            if dataset_cache is None:
+                # Dates come back parsed and strings as categoricals, whether
+                # this hits the snapshot or falls back to the CSV
+                df, text, source = load_dataframe(DATA_PATH, SNAPSHOT_DIR)
+                dataset = Dataset(df, text=text, source=source, cache_dir=SNAPSHOT_DIR)
+                load_presets(dataset)
+                dataset_cache = dataset
+    return dataset_cache
+
+
+def reload_dataset():
+    """Swap in the snapshot ingest.py wrote, if it changed since the data was loaded.
+
+    Requests already running keep the dataset they started with. The new
+    snapshot is only mapped, never rebuilt from the CSV here; returns
+    whether the dataset was replaced.
+    """
+    global dataset_cache
+    current = get_dataset()
+    meta = read_meta(SNAPSHOT_DIR)
+    source = meta.get("source") if meta else None
+    if not source or (current.source and source["checksum"] == current.source["checksum"]):
+        return False
+    df, text = load_snapshot(SNAPSHOT_DIR)
+    if read_meta(SNAPSHOT_DIR) != meta:
+        # Replaced again while loading; pick it up on the next poll
+        return False
+    dataset = Dataset(df, text=text, source=source, cache_dir=SNAPSHOT_DIR)
+    with dataset_lock:
+        load_presets(dataset)
+        dataset_cache = dataset
+    return True
+
+
+async def watch_snapshot():
+    """Poll the snapshot directory for new versions and reload them off the event loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        try:
+            await loop.run_in_executor(render_executor, reload_dataset)
+        except Exception:
+            # A snapshot half-way through being replaced; try again next time
+            logger.exception("Snapshot reload failed")
+
+
+def load_presets(dataset):
+    """Pick up the responses precompute.py stored for this dataset, if any"""
+    global preset_store
+    checksum = dataset.source["checksum"] if dataset.source else None
+    preset_store = PresetStore.load(os.path.join(SNAPSHOT_DIR, PRESET_DIR), checksum)
+
+
+def serialize(content, response_class=FrameJSONResponse, **kwargs):
+    """A response for content, timed as the request's serialize stage"""
+    with stage("serialize"):
+        return response_class(content, **kwargs)
+
+
+async def cached_response(request, endpoint, params, render):
+    """Serve a precomputed or cached response, rendering it on a miss.
+
+    Misses are rendered on the render pool, and identical requests arriving
+    while one is being rendered wait for that render instead of starting
+    their own. The ETag lets browsers revalidate with If-None-Match and get
+    an empty 304 instead of the body; the cache is dropped whenever the
+    dataset's source CSV changes.
+
+    The dataset is read once and pinned for the render, and its version is
+    part of the cache and render keys, so a snapshot reloaded meanwhile can
+    neither mix into a render nor have an old render cached or shared as
+    its own.
+    """
+    dataset = get_dataset()
+    version = dataset.source["checksum"] if dataset.source else None
+    response_cache.bind(version)
+    canonical = canonical_params(params)
+    key = (endpoint, version, canonical)
+
+    def render_entry():
+        response = render()
+        entry = CachedResponse(response.body, response.media_type)
+        response_cache.put(key, entry, version)
+        return entry
+
+    pinned = request_dataset.set(dataset)
+    try:
+        entry, outcome = preset_store.get((endpoint, canonical)), "preset"
+        if entry is None:
+            entry, outcome = response_cache.get(key), "hit"
+        if entry is None and key in render_flights.calls:
+            outcome = "coalesced"
+            with stage("wait"):
+                entry = await render_flights.run(key, render_executor, render_entry)
+        elif entry is None:
+            outcome = "miss"
+            # The render's stages are timed on a pool thread, but in this request's context
+            entry = await render_flights.run(key, render_executor, profiled(in_context(render_entry), endpoint))
+    finally:
+        request_dataset.reset(pinned)
+    note("cache", outcome)
+
+    headers = {"ETag": entry.etag, "Cache-Control": CACHE_CONTROL}
+    if_none_match = request.headers.get("if-none-match", "")
+    if entry.etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type=entry.media_type, headers=headers)
+
+
+def parse_bbox(bbox):
+    """Parse "west,south,east,north" into (south, west, north, east), rejecting bad boxes with a 422"""
+    if not bbox:
+        return None
+    try:
+        west, south, east, north = (float(v) for v in bbox.split(','))
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"bbox must be west,south,east,north, got {bbox!r}")
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise HTTPException(status_code=422, detail=f"Invalid bbox {bbox!r}")
+    return south, west, north, east
+
+
+def parse_date_range(date_start, date_end):
+    """Parse the date filters once, rejecting malformed dates with a 422"""
+    try:
+        return parse_date(date_start), parse_date(date_end)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 
 @app.get("/")
@@ -130,183 +236,576 @@ def root():
     return {"status": "API is running"}
 
 
+def map_frame(date_start, date_end, damage, crash_type, injuries, cause, lighting, weight=None, mode="points",
+              bbox=None):
+    """Coordinates (and the weight column) of the filtered crashes to plot, inside bbox if given.
+
+    Outside grid mode large results are sampled down to 10,000 crashes.
+    """
+    dataset = get_dataset()
+    with stage("filter") as timer:
+        if bbox is not None:
+            # Only the crashes in the viewport, found through the spatial index
+            rows = dataset.bbox_rows(bbox, date_start, date_end, damage, crash_type, injuries, cause, lighting)
+        else:
+            rows = dataset.filter_rows(date_start, date_end, damage, crash_type, injuries, cause, lighting)
+        timer.rows = len(rows)
+    
+    with stage("select") as timer:
+        columns = ['LATITUDE', 'LONGITUDE'] + ([weight] if weight else [])
+        map_df = dataset.df[columns].iloc[rows].dropna(subset=['LATITUDE', 'LONGITUDE'])
+        map_df = map_df[(map_df['LATITUDE'] != 0) & (map_df['LONGITUDE'] != 0)]
+        
+        # Sample if too large for performance
+        if mode != "grid" and len(map_df) > 10000:
+            map_df = map_df.sample(n=10000, random_state=42)
+        timer.rows = len(map_df)
+    return map_df
+
+
+def build_map(date_start, date_end, damage, crash_type, injuries, cause, lighting,
+              weight=None, mode="points", zoom=MAP_ZOOM, bbox=None):
+    """Render the Folium heatmap of the filtered crashes as HTML.
+
+    weight names a column (e.g. INJURY_SCORE) to weight every crash by, so
+    the heat shows severity instead of crash counts. In "grid" mode all
+    crashes are binned server-side for the given zoom level instead of
+    plotting a sample of them.
+    """
+    # Prepare data for map
+    map_df = map_frame(date_start, date_end, damage, crash_type, injuries, cause, lighting, weight, mode, bbox)
+    
+    if map_df.empty:
+        # Return empty map centered on Chicago
+        m = folium.Map(location=[41.8781, -87.6298], zoom_start=11, tiles='CartoDB dark_matter')
+        return m._repr_html_()
+    
+    # Create map centered on the data
+    center_lat = map_df['LATITUDE'].mean()
+    center_lon = map_df['LONGITUDE'].mean()
+    
+    m = folium.Map(
+        location=[center_lat, center_lon],
+        zoom_start=zoom,
+        tiles='CartoDB dark_matter'
+    )
+    
+    # Prepare heatmap data
+    with stage("points") as timer:
+        weights = map_df[weight] if weight else None
+        if mode == "grid":
+            heat_data = heat_grid(map_df['LATITUDE'], map_df['LONGITUDE'], weights, zoom=zoom)
+        else:
+            heat_data = heat_points(map_df['LATITUDE'], map_df['LONGITUDE'], weights)
+        timer.rows = len(heat_data)
+    
+    if heat_data:
+        HeatMap(
+            heat_data,
+            radius=15,
+            blur=12,
+            max_zoom=13,
+            min_opacity=0.3,
+            gradient={
+                0.0: 'rgba(0, 0, 255, 0)',
+                0.2: 'rgba(0, 255, 255, 0.5)',
+                0.4: 'rgba(0, 255, 0, 0.6)',
+                0.6: 'rgba(255, 255, 0, 0.7)',
+                0.8: 'rgba(255, 128, 0, 0.8)',
+                1.0: 'rgba(255, 0, 0, 0.9)'
+            }
+        ).add_to(m)
+    
+    with stage("render"):
+        return m._repr_html_()
+
+
 @app.get("/api/map", response_class=HTMLResponse)
-def get_map(
+async def get_map(
+    request: Request,
     date_start: Optional[str] = Query(None),
     date_end: Optional[str] = Query(None),
     damage: Optional[str] = Query(None),
     crash_type: Optional[str] = Query(None),
     injuries: Optional[str] = Query(None),
     cause: Optional[str] = Query(None),
-    lighting: Optional[str] = Query(None)
+    lighting: Optional[str] = Query(None),
+    weight: Optional[str] = Query(None),
+    mode: Literal["points", "grid"] = Query("points"),
+    zoom: int = Query(MAP_ZOOM, ge=0, le=MAX_ZOOM),
+    bbox: Optional[str] = Query(None)
 ):
     """Generate Folium heatmap with filters applied"""
+    date_start, date_end = parse_date_range(date_start, date_end)
+    if weight and weight not in get_dataset().measures:
+        raise HTTPException(status_code=422, detail=f"Cannot weight the map by {weight!r}")
+    params = dict(date_start=date_start, date_end=date_end, damage=damage, crash_type=crash_type,
+                  injuries=injuries, cause=cause, lighting=lighting, weight=weight, mode=mode, zoom=zoom,
+                  bbox=parse_bbox(bbox))
     try:
-        df = get_dataframe()
-        df = apply_filters(df, date_start, date_end, damage, crash_type, injuries, cause, lighting)
-        
-        # Prepare data for map
-        map_df = df.dropna(subset=['LATITUDE', 'LONGITUDE'])
-        map_df = map_df[(map_df['LATITUDE'] != 0) & (map_df['LONGITUDE'] != 0)]
-        
-        if map_df.empty:
-            # Return empty map centered on Chicago
-            m = folium.Map(location=[41.8781, -87.6298], zoom_start=11, tiles='CartoDB dark_matter')
-            return m._repr_html_()
-        
-        # Sample if too large for performance
-        if len(map_df) > 10000:
-            map_df = map_df.sample(n=10000, random_state=42)
-        
-        # Create map centered on the data
-        center_lat = map_df['LATITUDE'].mean()
-        center_lon = map_df['LONGITUDE'].mean()
-        
-        m = folium.Map(
-            location=[center_lat, center_lon],
-            zoom_start=11,
-            tiles='CartoDB dark_matter'
-        )
-        
-        # Prepare heatmap data
-        heat_data = []
-        for _, row in map_df.iterrows():
-            if not pd.isna(row['LATITUDE']) and not pd.isna(row['LONGITUDE']):
-                heat_data.append([row['LATITUDE'], row['LONGITUDE']])
-        
-        if heat_data:
-            HeatMap(
-                heat_data,
-                radius=15,
-                blur=12,
-                max_zoom=13,
-                min_opacity=0.3,
-                gradient={
-                    0.0: 'rgba(0, 0, 255, 0)',
-                    0.2: 'rgba(0, 255, 255, 0.5)',
-                    0.4: 'rgba(0, 255, 0, 0.6)',
-                    0.6: 'rgba(255, 255, 0, 0.7)',
-                    0.8: 'rgba(255, 128, 0, 0.8)',
-                    1.0: 'rgba(255, 0, 0, 0.9)'
-                }
-            ).add_to(m)
-        
-        return m._repr_html_()
+        return await cached_response(request, "map", params, lambda: serialize(build_map(**params), HTMLResponse))
     except Exception as e:
-        return f"<html><body><h2>Error loading map: {str(e)}</h2></body></html>"
+        record_error(e)
+        return HTMLResponse(f"<html><body><h2>Error loading map: {str(e)}</h2></body></html>",
+                            status_code=500)
 
 
-@app.get("/api/ranking")
-def get_ranking(
-    rank_type: str = Query("frequency"),
-    group_by: str = Query("street"),
-    limit: int = Query(10),
+def build_heatmap(date_start, date_end, damage, crash_type, injuries, cause, lighting,
+                  weight=None, mode="grid", zoom=MAP_ZOOM, format="json", bbox=None):
+    """Weighted heat points of the filtered crashes (inside bbox, if given), without any map around them.
+
+    JSON carries the points as [lat, lon, weight] triples; "binary" is the
+    same triples as packed float32 for the dashboard's heat layer.
+    """
+    map_df = map_frame(date_start, date_end, damage, crash_type, injuries, cause, lighting, weight, mode, bbox)
+    lat, lon = map_df['LATITUDE'].to_numpy(dtype=float), map_df['LONGITUDE'].to_numpy(dtype=float)
+    with stage("points") as timer:
+        weights = map_df[weight] if weight else None
+        if mode == "grid":
+            lat, lon, weights = grid_cells(lat, lon, weights, zoom=zoom)
+        else:
+            weights = np.ones(len(lat)) if weights is None else np.nan_to_num(weights.to_numpy(dtype=float), nan=0.0)
+        timer.rows = len(lat)
+    
+    with stage("serialize"):
+        if format == "binary":
+            return Response(pack_points(lat, lon, weights), media_type="application/octet-stream")
+        # 5 decimals is about a metre; the full float repr would triple the size
+        points = heat_points(np.round(lat, 5), np.round(lon, 5), weights)
+        return JSONResponse({"points": points, "crashes": len(map_df)})
+
+
+@app.get("/api/heatmap")
+async def get_heatmap(
+    request: Request,
     date_start: Optional[str] = Query(None),
     date_end: Optional[str] = Query(None),
     damage: Optional[str] = Query(None),
     crash_type: Optional[str] = Query(None),
     injuries: Optional[str] = Query(None),
     cause: Optional[str] = Query(None),
-    lighting: Optional[str] = Query(None)
+    lighting: Optional[str] = Query(None),
+    weight: Optional[str] = Query(None),
+    mode: Literal["points", "grid"] = Query("grid"),
+    zoom: int = Query(MAP_ZOOM, ge=0, le=MAX_ZOOM),
+    format: Literal["json", "binary"] = Query("json"),
+    bbox: Optional[str] = Query(None)
 ):
-    """Get crash location rankings with filters"""
+    """Heatmap points for a Leaflet heat layer, as JSON or packed float32"""
+    date_start, date_end = parse_date_range(date_start, date_end)
+    if weight and weight not in get_dataset().measures:
+        raise HTTPException(status_code=422, detail=f"Cannot weight the map by {weight!r}")
+    params = dict(date_start=date_start, date_end=date_end, damage=damage, crash_type=crash_type,
+                  injuries=injuries, cause=cause, lighting=lighting, weight=weight, mode=mode, zoom=zoom,
+                  format=format, bbox=parse_bbox(bbox))
     try:
-        df = get_dataframe()
-        df = apply_filters(df, date_start, date_end, damage, crash_type, injuries, cause, lighting)
-        
-        # Check if data is empty
-        if df.empty:
-            return {
-                "ranking": [],
-                "rank_type": rank_type,
-                "group_by": group_by,
-                "total_crashes": 0,
-                "message": "No data matches your filter criteria"
-            }
-        
-        delta = 0.00045
-        
-        # Create location bins
-        df['LAT_BIN'] = (df['LATITUDE'] / delta).round().astype(int)
-        df['LON_BIN'] = (df['LONGITUDE'] / delta).round().astype(int)
-        df['LOCATION_BIN'] = df['LAT_BIN'].astype(str) + "_" + df['LON_BIN'].astype(str)
-        
-        # Group data
-        if group_by == "street":
-            ranking = df.groupby('STREET_NAME').sum(numeric_only=True)
-            ranking['name'] = ranking.index
-        else:  # location
-            ranking = df.groupby('LOCATION_BIN').sum(numeric_only=True)
-            ranking["LAT_BIN"] = ranking.index.map(lambda x: int(x.split("_")[0]))
-            ranking["LON_BIN"] = ranking.index.map(lambda x: int(x.split("_")[1]))
-            ranking["LATITUDE"] = round(ranking["LAT_BIN"] * delta, 5)
-            ranking["LONGITUDE"] = round(ranking["LON_BIN"] * delta, 5)
-            ranking["name"] = ranking["LATITUDE"].astype(str) + ", " + ranking["LONGITUDE"].astype(str)
-        
-        # Calculate months for crashes per month
-        if date_start and date_end:
-            start_dt = pd.to_datetime(date_start)
-            end_dt = pd.to_datetime(date_end)
-        else:
-            start_dt = pd.to_datetime('2017-10-24')
-            end_dt = pd.to_datetime('2025-10-24')
-        
-        months = (end_dt.year - start_dt.year) * 12 + (end_dt.month - start_dt.month) + 1
-        ranking["CRASHES_PER_MONTH"] = (ranking["COUNT"] / months).round(2)
-        
-        # Apply ranking type
-        if rank_type == "frequency":
-            ranking = ranking.sort_values(by='COUNT', ascending=False)
-            result_cols = ['name', 'COUNT', 'CRASHES_PER_MONTH']
-        elif rank_type == "weighted":
-            ranking = ranking.sort_values(by='INJURY_SCORE', ascending=False)
-            result_cols = ['name', 'INJURIES_FATAL', 'INJURIES_INCAPACITATING', 
-                          'INJURIES_NON_INCAPACITATING', 'COUNT', 'CRASHES_PER_MONTH', 'INJURY_SCORE']
-        else:  # dangerous
-            ranking["AVERAGE_INJURY_SCORE"] = ranking["INJURY_SCORE"] / ranking["COUNT"]
-            ranking = ranking.sort_values(by='AVERAGE_INJURY_SCORE', ascending=False)
-            result_cols = ['name', 'INJURIES_FATAL', 'INJURIES_INCAPACITATING',
-                          'INJURIES_NON_INCAPACITATING', 'COUNT', 'CRASHES_PER_MONTH', 'INJURY_SCORE', 'AVERAGE_INJURY_SCORE']
-        
-        # Get top results
-        ranking = ranking.head(limit)
-        ranking = ranking.reset_index(drop=True)
-        
-        # Filter to only relevant columns that exist
-        available_cols = [col for col in result_cols if col in ranking.columns]
-        result = ranking[available_cols].to_dict(orient="records")
-        
+        return await cached_response(request, "heatmap", params, lambda: build_heatmap(**params))
+    except Exception as e:
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def build_tile(z, x, y, date_start, date_end, damage, crash_type, injuries, cause, lighting, weight=None):
+    """GeoJSON crash density cells of one map tile for the filtered crashes"""
+    dataset = get_dataset()
+    index = dataset.spatial_index
+    with stage("search") as timer:
+        positions = index.tile(z, x, y)
+        rows = index.rows[positions]
+        timer.rows = len(rows)
+    with stage("filter") as timer:
+        keep = dataset.passes_filters(rows, date_start, date_end, damage, crash_type, injuries, cause, lighting)
+        timer.rows = int(keep.sum())
+    with stage("points"):
+        px, py = index.pixels(positions[keep], z)
+        weights = dataset.df[weight].to_numpy()[rows[keep]] if weight else None
+        return tile_features(z, x, y, px, py, weights)
+
+
+@app.get("/tiles/{z}/{x}/{y}")
+async def get_tile(
+    request: Request,
+    z: int,
+    x: int,
+    y: int,
+    date_start: Optional[str] = Query(None),
+    date_end: Optional[str] = Query(None),
+    damage: Optional[str] = Query(None),
+    crash_type: Optional[str] = Query(None),
+    injuries: Optional[str] = Query(None),
+    cause: Optional[str] = Query(None),
+    lighting: Optional[str] = Query(None),
+    weight: Optional[str] = Query(None)
+):
+    """Crash density of one slippy-map tile as GeoJSON cells"""
+    if not (0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=404, detail=f"No tile {z}/{x}/{y}")
+    date_start, date_end = parse_date_range(date_start, date_end)
+    if weight and weight not in get_dataset().measures:
+        raise HTTPException(status_code=422, detail=f"Cannot weight the map by {weight!r}")
+    params = dict(z=z, x=x, y=y, date_start=date_start, date_end=date_end, damage=damage,
+                  crash_type=crash_type, injuries=injuries, cause=cause, lighting=lighting, weight=weight)
+    try:
+        return await cached_response(request, "tile", params,
+                               lambda: serialize(build_tile(**params), JSONResponse, media_type="application/geo+json"))
+    except Exception as e:
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def build_ranking(rank_type, group_by, limit, min_crashes, date_start, date_end,
+                  damage, crash_type, injuries, cause, lighting, bbox=None):
+    """Rank streets or grid cells for the filtered crashes (inside bbox, if given)"""
+    dataset = get_dataset()
+    date_start, date_end = parse_date(date_start), parse_date(date_end)
+    # The frequency ranking only needs the crash counts
+    measures = ['COUNT'] if rank_type == "frequency" else None
+    if bbox is not None:
+        # Only the crashes in the viewport, found through the spatial index
+        with stage("filter") as timer:
+            rows = dataset.bbox_rows(bbox, date_start, date_end, damage, crash_type, injuries, cause, lighting)
+            timer.rows = len(rows)
+        with stage("aggregate"):
+            ranking, total_crashes = dataset.raw_totals(group_by, rows, measures)
+    else:
+        # Summed from the pre-aggregated cubes built when the data was loaded
+        ranking, total_crashes = dataset.group_totals(
+            group_by, date_start, date_end, damage, crash_type, injuries, cause, lighting, measures=measures
+        )
+    
+    # Check if data is empty
+    if total_crashes == 0:
         return {
-            "ranking": result,
+            "ranking": [],
             "rank_type": rank_type,
             "group_by": group_by,
-            "total_crashes": len(df)
+            "total_crashes": 0,
+            "message": "No data matches your filter criteria"
         }
+    
+    delta = LOCATION_DELTA
+    
+    # Months of the date range that the data actually covers, for crashes per month
+    months = dataset.rollups.covered_months(date_start, date_end)
+    
+    # Apply ranking type
+    if rank_type == "frequency":
+        score = ranking['COUNT']
+        result_cols = ['name', 'COUNT', 'CRASHES_PER_MONTH']
+    elif rank_type == "weighted":
+        score = ranking['INJURY_SCORE']
+        result_cols = ['name', 'INJURIES_FATAL', 'INJURIES_INCAPACITATING', 
+                      'INJURIES_NON_INCAPACITATING', 'COUNT', 'CRASHES_PER_MONTH', 'INJURY_SCORE']
+    else:  # dangerous
+        # Averages over a handful of crashes are noise, not hotspots
+        ranking = ranking[ranking["COUNT"] >= min_crashes]
+        score = ranking["INJURY_SCORE"] / ranking["COUNT"]
+        result_cols = ['name', 'INJURIES_FATAL', 'INJURIES_INCAPACITATING',
+                      'INJURIES_NON_INCAPACITATING', 'COUNT', 'CRASHES_PER_MONTH', 'INJURY_SCORE', 'AVERAGE_INJURY_SCORE']
+    
+    # Get top results; ties keep street name / grid cell order
+    with stage("rank"):
+        top = top_k(score.to_numpy(), limit)
+    ranking = ranking.iloc[top].reset_index(drop=True)
+    # Without any dated crashes in range there is no rate to give, so it goes out as null
+    ranking["CRASHES_PER_MONTH"] = (ranking["COUNT"] / months).round(2) if months > 0 else np.nan
+    if rank_type == "dangerous":
+        ranking["AVERAGE_INJURY_SCORE"] = score.to_numpy()[top]
+    
+    # Label grid cells by their centre, only for the rows returned
+    if group_by != "street":
+        ranking["LATITUDE"] = round(ranking["LAT_BIN"] * delta, 5)
+        ranking["LONGITUDE"] = round(ranking["LON_BIN"] * delta, 5)
+        ranking["name"] = ranking["LATITUDE"].astype(str) + ", " + ranking["LONGITUDE"].astype(str)
+    
+    # Filter to only relevant columns that exist
+    available_cols = [col for col in result_cols if col in ranking.columns]
+    
+    return {
+        "ranking": ranking[available_cols],
+        "rank_type": rank_type,
+        "group_by": group_by,
+        "total_crashes": total_crashes
+    }
+
+
+def render_ranking(**params):
+    """build_ranking() as the JSON response /api/ranking sends"""
+    return serialize(build_ranking(**params))
+
+
+@app.get("/api/ranking", responses={200: {"model": RankingResponse}})
+async def get_ranking(
+    request: Request,
+    rank_type: str = Query("frequency"),
+    group_by: str = Query("street"),
+    limit: int = Query(10),
+    min_crashes: int = Query(DANGEROUS_MIN_CRASHES),
+    date_start: Optional[str] = Query(None),
+    date_end: Optional[str] = Query(None),
+    damage: Optional[str] = Query(None),
+    crash_type: Optional[str] = Query(None),
+    injuries: Optional[str] = Query(None),
+    cause: Optional[str] = Query(None),
+    lighting: Optional[str] = Query(None),
+    bbox: Optional[str] = Query(None)
+):
+    """Get crash location rankings with filters"""
+    date_start, date_end = parse_date_range(date_start, date_end)
+    params = dict(rank_type=rank_type, group_by=group_by, limit=limit, min_crashes=min_crashes,
+                  date_start=date_start, date_end=date_end, damage=damage, crash_type=crash_type,
+                  injuries=injuries, cause=cause, lighting=lighting, bbox=parse_bbox(bbox))
+    try:
+        return await cached_response(request, "ranking", params, lambda: render_ranking(**params))
+    except Exception as e:
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def cell_label(lat_bin, lon_bin):
+    """Centre and "lat, lon" name of location ranking grid cells"""
+    lat = np.round(np.asarray(lat_bin) * LOCATION_DELTA, 5)
+    lon = np.round(np.asarray(lon_bin) * LOCATION_DELTA, 5)
+    return lat, lon, [f"{a}, {b}" for a, b in zip(lat.tolist(), lon.tolist())]
+
+
+def build_nearby(lat, lon, radius, limit, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+    """Crashes within radius metres of a point: totals plus the nearest few"""
+    dataset = get_dataset()
+    with stage("search") as timer:
+        rows, distance = dataset.nearby_rows(lat, lon, radius, date_start, date_end,
+                                             damage, crash_type, injuries, cause, lighting)
+        timer.rows = len(rows)
+    totals = {col: float(np.nansum(dataset.df[col].to_numpy()[rows])) for col in dataset.measures if col != "COUNT"}
+    columns = [col for col in NEARBY_COLUMNS if col in dataset.columns]
+    nearest = dataset.frame(columns, rows[:limit])
+    nearest["DISTANCE_M"] = np.round(distance[:limit], 1)
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "radius_m": radius,
+        "total_crashes": len(rows),
+        "totals": totals,
+        "nearest": nearest,
+    }
+
+
+@app.get("/api/nearby")
+async def get_nearby(
+    request: Request,
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radius: float = Query(150, gt=0, le=MAX_RADIUS_M),
+    limit: int = Query(10, ge=0),
+    date_start: Optional[str] = Query(None),
+    date_end: Optional[str] = Query(None),
+    damage: Optional[str] = Query(None),
+    crash_type: Optional[str] = Query(None),
+    injuries: Optional[str] = Query(None),
+    cause: Optional[str] = Query(None),
+    lighting: Optional[str] = Query(None)
+):
+    """Crashes within radius metres of a point, such as an intersection"""
+    date_start, date_end = parse_date_range(date_start, date_end)
+    params = dict(lat=lat, lon=lon, radius=radius, limit=limit, date_start=date_start, date_end=date_end,
+                  damage=damage, crash_type=crash_type, injuries=injuries, cause=cause, lighting=lighting)
+    try:
+        return await cached_response(request, "nearby", params, lambda: serialize(build_nearby(**params)))
+    except Exception as e:
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def build_hotspots(lat, lon, k, min_crashes, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+    """The k nearest grid cells to a point with at least min_crashes crashes"""
+    dataset = get_dataset()
+    with stage("search") as timer:
+        cells, distance, totals = dataset.nearest_hotspots(lat, lon, k, min_crashes, date_start, date_end,
+                                                           damage, crash_type, injuries, cause, lighting)
+        timer.rows = len(cells)
+    cell_lat, cell_lon, names = cell_label(dataset.cell_lat_bin[cells], dataset.cell_lon_bin[cells])
+    hotspots = pd.DataFrame({"name": names, "LATITUDE": cell_lat, "LONGITUDE": cell_lon,
+                             "DISTANCE_M": np.round(distance, 1)})
+    for col in dataset.measures:
+        hotspots[col] = totals[col].to_numpy()
+    return {"latitude": lat, "longitude": lon, "hotspots": hotspots}
+
+
+@app.get("/api/hotspots/nearest")
+async def get_nearest_hotspots(
+    request: Request,
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    k: int = Query(5, ge=1, le=100),
+    min_crashes: int = Query(DANGEROUS_MIN_CRASHES, ge=1),
+    date_start: Optional[str] = Query(None),
+    date_end: Optional[str] = Query(None),
+    damage: Optional[str] = Query(None),
+    crash_type: Optional[str] = Query(None),
+    injuries: Optional[str] = Query(None),
+    cause: Optional[str] = Query(None),
+    lighting: Optional[str] = Query(None)
+):
+    """Nearest location ranking grid cells to a point with at least min_crashes crashes"""
+    date_start, date_end = parse_date_range(date_start, date_end)
+    params = dict(lat=lat, lon=lon, k=k, min_crashes=min_crashes, date_start=date_start, date_end=date_end,
+                  damage=damage, crash_type=crash_type, injuries=injuries, cause=cause, lighting=lighting)
+    try:
+        return await cached_response(request, "hotspots", params, lambda: serialize(build_hotspots(**params)))
+    except Exception as e:
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def build_timeseries(granularity, date_start, date_end):
+    """Crash counts per hour, day or month between two dates, from the rollups"""
+    rollups = get_dataset().rollups
+    # Like the other filters, date_end includes the whole day
+    end = date_end.normalize() + pd.Timedelta(days=1) - pd.Timedelta(1) if date_end is not None else None
+    with stage("select") as timer:
+        series = rollups.frame(granularity, date_start, end)
+        timer.rows = len(series)
+    first, last = (pd.Timestamp(t) for t in rollups.span) if rollups.span else (None, None)
+    return {
+        "granularity": granularity,
+        "conditions": rollups.conditions,
+        "first_crash": first,
+        "last_crash": last,
+        "series": series,
+    }
+
+
+@app.get("/api/timeseries", responses={200: {"model": TimeSeriesResponse}})
+async def get_timeseries(
+    request: Request,
+    granularity: Literal["hour", "day", "month"] = Query("day"),
+    date_start: Optional[str] = Query(None),
+    date_end: Optional[str] = Query(None)
+):
+    """Crashes per hour, day or month, split by weather condition when the data has one.
+
+    Periods without crashes are left out.
+    """
+    date_start, date_end = parse_date_range(date_start, date_end)
+    params = dict(granularity=granularity, date_start=date_start, date_end=date_end)
+    try:
+        return await cached_response(request, "timeseries", params, lambda: serialize(build_timeseries(**params)))
     except Exception as e:
-        return {"error": str(e)}
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
 
 
-@app.get("/api/data/sample")
+@app.get("/api/cache")
+def get_cache_stats():
+    """Hit, miss and eviction counters of the response cache"""
+    return dict(response_cache.stats(), presets=len(preset_store.entries), preset_hits=preset_store.hits,
+                **render_flights.stats())
+
+
+@app.get("/api/export")
+def export_rows(
+    date_start: Optional[str] = Query(None),
+    date_end: Optional[str] = Query(None),
+    damage: Optional[str] = Query(None),
+    crash_type: Optional[str] = Query(None),
+    injuries: Optional[str] = Query(None),
+    cause: Optional[str] = Query(None),
+    lighting: Optional[str] = Query(None),
+    format: Literal["ndjson", "csv", "arrow"] = Query("ndjson"),
+    columns: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = Query(None)
+):
+    """Stream the filtered crash rows as NDJSON, CSV or an Arrow IPC stream.
+
+    Without a limit every matching row is sent. With one, the response
+    holds that many rows and its X-Next-Cursor header, if any, is the
+    cursor of the next page.
+    """
+    date_start, date_end = parse_date_range(date_start, date_end)
+    if format == "arrow" and pa is None:
+        raise HTTPException(status_code=501, detail="Arrow export needs pyarrow installed on the server")
+    # Requests keep the dataset they started with, even if a new snapshot is swapped in
+    dataset = get_dataset()
+    columns = columns.split(',') if columns else dataset.columns
+    unknown = [col for col in columns if col not in dataset.columns]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown columns: {', '.join(unknown)}")
+    try:
+        start_row = read_cursor(dataset, cursor)
+    except StaleCursor as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    filters = dict(date_start=date_start, date_end=date_end, damage=damage, crash_type=crash_type,
+                   injuries=injuries, cause=cause, lighting=lighting)
+    headers = {}
+    stop_row = page_end(dataset.filter_chunks(**filters, start_row=start_row), limit) if limit else None
+    if stop_row is not None:
+        headers["X-Next-Cursor"] = make_cursor(dataset, stop_row)
+    chunks = dataset.filter_chunks(**filters, start_row=start_row, stop_row=stop_row)
+    return StreamingResponse(export_chunks(dataset, columns, chunks, format), media_type=MEDIA_TYPES[format],
+                             headers=headers)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Request and stage timings, row counts and errors in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/data/sample", responses={200: {"model": SampleResponse}})
 def get_sample(limit: int = 10):
     """Return a sample of rows from the CSV"""
     try:
-        df = get_dataframe()
-        sample = df.head(limit)
-        return {"data": sample.to_dict(orient="records")}
+        dataset = get_dataset()
+        sample = dataset.frame(dataset.columns, np.arange(min(max(limit, 0), len(dataset.df))))
+        return FrameJSONResponse({"data": sample})
     except Exception as e:
-        return {"error": str(e)}
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
 
 
 @app.get("/api/columns")
 def get_columns():
     """Return column names from the CSV"""
     try:
-        df = get_dataframe()
-        return {"columns": df.columns.tolist()}
+        return {"columns": get_dataset().columns}
     except Exception as e:
-        return {"error": str(e)}
+        record_error(e)
+        return JSONResponse({"error": str(e)}, status_code=500)
 
 
 if __name__ == "__main__":
+    import argparse
+    import multiprocessing
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    import timing
+
+    parser = argparse.ArgumentParser(description="Serve the crash API")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--csv", default=DATA_PATH, help="source CSV")
+    parser.add_argument("--snapshot", default=SNAPSHOT_DIR, help="snapshot directory")
+    parser.add_argument("--profile-slow-ms", type=float, help="save a sampled profile of renders slower than this")
+    args = parser.parse_args()
+    if args.profile_slow_ms is not None:
+        # Workers read it from the environment when they import timing.py
+        os.environ["CRASH_PROFILE_SLOW_MS"] = str(args.profile_slow_ms)
+        timing.PROFILE_SLOW_MS = args.profile_slow_ms
+
+    if args.workers == 1:
+        DATA_PATH, SNAPSHOT_DIR = args.csv, args.snapshot
+        uvicorn.run(app, host="127.0.0.1", port=args.port)
+    else:
+        # Workers import the app afresh and find the data through the environment
+        os.environ["CRASH_DATA_PATH"], os.environ["CRASH_SNAPSHOT_DIR"] = args.csv, args.snapshot
+        # Every worker maps the same snapshot, cube and index files, so build
+        # them once up front (in a process of their own, so this one does not
+        # keep a copy of the data) instead of letting the workers race to
+        preparing = multiprocessing.get_context("spawn").Process(target=get_dataset)
+        preparing.start()
+        preparing.join()
+        uvicorn.run("api:app", host="127.0.0.1", port=args.port, workers=args.workers,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
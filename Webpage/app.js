@@ -2,6 +2,10 @@ const { createApp } = Vue;
 
 const API_URL = 'http://127.0.0.1:8000';
 
+// Zoom the map opens at, and the deepest one /api/heatmap bins crashes for
+const MAP_ZOOM = 11;
+const MAX_HEAT_ZOOM = 18;
+
 // Main Content Component (80%)
 const MainContent = {
     template: `
@@ -11,12 +15,7 @@ const MainContent = {
                 <h1>{{ title }}</h1>
                 <p class="stats">Total crashes in dataset: <strong>{{ totalCrashes.toLocaleString() }}</strong></p>
                 <div class="graph-container">
-                    <iframe 
-                        :key="mapKey"
-                        :src="mapUrl" 
-                        class="map-iframe"
-                        frameborder="0"
-                    ></iframe>
+                    <div ref="map" class="map-canvas"></div>
                 </div>
             </div>
             
@@ -76,61 +75,121 @@ const MainContent = {
             panelOpen: false
         };
     },
-    computed: {
-        mapKey() {
-            // Generate a unique key based on all filter values to force iframe refresh
-            if (!this.filters) return 'default';
-            return JSON.stringify(this.filters);
-        },
-        mapUrl() {
-            const params = new URLSearchParams();
-            if (this.filters) {
-                if (this.filters.dateStart) params.append('date_start', this.filters.dateStart);
-                if (this.filters.dateEnd) params.append('date_end', this.filters.dateEnd);
-                if (this.filters.damage.length) params.append('damage', this.filters.damage.join(','));
-                if (this.filters.crashType.length) params.append('crash_type', this.filters.crashType.join(','));
-                if (this.filters.injuries.length) params.append('injuries', this.filters.injuries.join(','));
-                if (this.filters.cause.length) params.append('cause', this.filters.cause.join(','));
-                if (this.filters.lighting.length) params.append('lighting', this.filters.lighting.join(','));
-            }
-            return `${API_URL}/api/map?${params}`;
-        }
-    },
     watch: {
         rankType() { this.fetchRanking(); },
         groupBy() { this.fetchRanking(); },
         filters: {
-            handler() { this.fetchRanking(); },
+            handler() {
+                this.fetchRanking();
+                this.fetchHeatmap();
+            },
             deep: true
         }
     },
     mounted() {
+        this.initMap();
         this.fetchRanking();
+        this.fetchHeatmap();
     },
     methods: {
         togglePanel() {
             this.panelOpen = !this.panelOpen;
         },
+        addFilterParams(params) {
+            if (this.filters) {
+                if (this.filters.dateStart) params.append('date_start', this.filters.dateStart);
+                if (this.filters.dateEnd) params.append('date_end', this.filters.dateEnd);
+                if (this.filters.damage.length) params.append('damage', this.filters.damage.join(','));
+                if (this.filters.crashType.length) params.append('crash_type', this.filters.crashType.join(','));
+                if (this.filters.injuries.length) params.append('injuries', this.filters.injuries.join(','));
+                if (this.filters.cause.length) params.append('cause', this.filters.cause.join(','));
+                if (this.filters.lighting.length) params.append('lighting', this.filters.lighting.join(','));
+            }
+            return params;
+        },
+        initMap() {
+            // Leaflet objects are kept off the reactive data on purpose
+            this.map = L.map(this.$refs.map).setView([41.8781, -87.6298], MAP_ZOOM);
+            L.tileLayer('https://{s}.basemaps.cartocdn.com/dark_all/{z}/{x}/{y}{r}.png', {
+                attribution: '&copy; OpenStreetMap contributors &copy; CARTO',
+                subdomains: 'abcd',
+                maxZoom: 20
+            }).addTo(this.map);
+            this.heatLayer = L.heatLayer([], {
+                radius: 15,
+                blur: 12,
+                maxZoom: 13,
+                minOpacity: 0.3,
+                gradient: {
+                    0.0: 'rgba(0, 0, 255, 0)',
+                    0.2: 'rgba(0, 255, 255, 0.5)',
+                    0.4: 'rgba(0, 255, 0, 0.6)',
+                    0.6: 'rgba(255, 255, 0, 0.7)',
+                    0.8: 'rgba(255, 128, 0, 0.8)',
+                    1.0: 'rgba(255, 0, 0, 0.9)'
+                }
+            }).addTo(this.map);
+            // The server bins the crashes in view for the zoom level, so
+            // re-fetch after every pan or zoom (a zoom ends with moveend too)
+            this.map.on('moveend', () => this.fetchHeatmap());
+            this.heatmapRequest = 0;
+        },
+        heatmapBbox() {
+            // A margin around the viewport keeps short pans covered until
+            // the next response arrives
+            const bounds = this.map.getBounds().pad(0.25);
+            const west = Math.max(bounds.getWest(), -180);
+            const south = Math.max(bounds.getSouth(), -90);
+            const east = Math.min(bounds.getEast(), 180);
+            const north = Math.min(bounds.getNorth(), 90);
+            return [west, south, east, north].map(value => value.toFixed(5)).join(',');
+        },
+        async fetchHeatmap() {
+            const request = ++this.heatmapRequest;
+            const zoom = this.map.getZoom();
+            const params = this.addFilterParams(new URLSearchParams({
+                mode: 'grid',
+                zoom: Math.min(zoom, MAX_HEAT_ZOOM),
+                format: 'binary'
+            }));
+            // Up to the opening zoom the whole city is in view: asking
+            // without a box gets the response precomputed for it
+            if (zoom > MAP_ZOOM) params.append('bbox', this.heatmapBbox());
+            try {
+                const response = await fetch(`${API_URL}/api/heatmap?${params}`);
+                // A newer request was sent while this one was in flight
+                if (request !== this.heatmapRequest) return;
+                if (!response.ok) {
+                    const data = await response.json().catch(() => ({}));
+                    this.error = data.error || `Failed to load the heatmap (HTTP ${response.status})`;
+                    return;
+                }
+                // Only a binary body holds points; anything else is not decoded
+                if (response.headers.get('content-type') !== 'application/octet-stream') return;
+                // Packed float32 (lat, lon, weight) triples
+                const values = new Float32Array(await response.arrayBuffer());
+                if (request !== this.heatmapRequest) return;
+                const points = [];
+                let max = 0;
+                for (let i = 0; i + 2 < values.length; i += 3) {
+                    points.push([values[i], values[i + 1], values[i + 2]]);
+                    max = Math.max(max, values[i + 2]);
+                }
+                this.heatLayer.setOptions({ max: max || 1 });
+                this.heatLayer.setLatLngs(points);
+            } catch (err) {
+                this.error = 'Failed to connect to API. Make sure the server is running (python api.py)';
+            }
+        },
         async fetchRanking() {
             this.loading = true;
             this.error = null;
             try {
-                const params = new URLSearchParams({
+                const params = this.addFilterParams(new URLSearchParams({
                     rank_type: this.rankType,
                     group_by: this.groupBy,
                     limit: 10
-                });
-                
-                // Add filter parameters
-                if (this.filters) {
-                    if (this.filters.dateStart) params.append('date_start', this.filters.dateStart);
-                    if (this.filters.dateEnd) params.append('date_end', this.filters.dateEnd);
-                    if (this.filters.damage.length) params.append('damage', this.filters.damage.join(','));
-                    if (this.filters.crashType.length) params.append('crash_type', this.filters.crashType.join(','));
-                    if (this.filters.injuries.length) params.append('injuries', this.filters.injuries.join(','));
-                    if (this.filters.cause.length) params.append('cause', this.filters.cause.join(','));
-                    if (this.filters.lighting.length) params.append('lighting', this.filters.lighting.join(','));
-                }
+                }));
                 
                 const response = await fetch(`${API_URL}/api/ranking?${params}`);
                 const data = await response.json();
@@ -0,0 +1,874 @@
+"""Benchmarks for the API's data path.
+
+    python benchmark.py startup [--repeat N]
+    python benchmark.py memory [--concurrency N] [--rounds N]
+    python benchmark.py filters [--combinations N]
+    python benchmark.py cube [--combinations N]
+    python benchmark.py ranking [--limit N]
+    python benchmark.py points
+    python benchmark.py grid
+    python benchmark.py tiles [--combinations N]
+    python benchmark.py spatial [--combinations N]
+    python benchmark.py load [--users 1,10,50] [--duration S] [--no-cache]
+    python benchmark.py workers [--workers 1,4,8]
+    python benchmark.py ingest [--deltas 1000,10000,100000] [--combinations N]
+    python benchmark.py export [--combinations N] [--page-size N]
+    python benchmark.py json [--sizes 10,1000,100000]
+    python benchmark.py timeseries
+
+Every subcommand also takes --csv PATH and --snapshot DIR, and those timing
+something --repeat N.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from dataset import DANGEROUS_MIN_CRASHES, HOTSPOT_MAX_RADIUS_M, LOCATION_DELTA, RECORD_ID, top_k
+from filters import CATEGORY_FILTERS, CAUSE_BUCKETS, filter_mask
+from heatmap import GRID_MAX_CELLS, TILE_SIZE, heat_grid, heat_points, mercator_pixels
+from snapshot import DATA_PATH, SNAPSHOT_DIR, TEXT_COLUMNS, build_snapshot, is_fresh, load_dataframe, load_snapshot
+from spatial import haversine_m
+
+
+def timed(fn, repeat):
+    """Best and median wall time of fn over repeat runs"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+
+def report(label, best, median):
+    print(f"{label:<32} best {best * 1000:9.1f} ms   median {median * 1000:9.1f} ms")
+
+
+def check_small_startup(csv_path, rows=20):
+    """Raise unless a Dataset starts from the first rows of csv_path.
+
+    Few rows make nearly every column mostly distinct, which must not move
+    any column but the TEXT_COLUMNS out of the frame.
+    """
+    with open(csv_path) as f:
+        lines = [line for _, line in zip(range(rows + 1), f)]
+    workdir = tempfile.mkdtemp()
+    try:
+        small_csv = os.path.join(workdir, "small.csv")
+        with open(small_csv, "w") as f:
+            f.writelines(lines)
+        dataset = load_dataset(small_csv, os.path.join(workdir, "snapshot"))
+        text = [col for col in TEXT_COLUMNS if col in lines[0].rstrip("\n").split(",")]
+        if sorted(dataset.text) != sorted(text):
+            raise AssertionError(f"text columns {sorted(dataset.text)}, expected {sorted(text)}")
+        for group_by in ("street", "location"):
+            dataset.group_totals(group_by, **random_filters(dataset.df, random.Random(0)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"starts from a {rows} row CSV")
+
+
+def bench_startup(args):
+    """Cold-start cost: parsing the CSV vs loading the snapshot"""
+    check_small_startup(args.csv)
+    if not is_fresh(args.csv, args.snapshot):
+        build_snapshot(args.csv, args.snapshot)
+
+    def from_csv():
+        df = pd.read_csv(args.csv)
+        df["COUNT"] = 1
+        df["CRASH_DATE_ONLY"] = pd.to_datetime(df["CRASH_DATE_ONLY"])
+
+    def from_snapshot_mmap():
+        load_snapshot(args.snapshot)
+
+    def from_snapshot_read():
+        load_snapshot(args.snapshot, mmap=False)
+
+    report("csv + to_datetime", *timed(from_csv, args.repeat))
+    report("snapshot (mmap)", *timed(from_snapshot_mmap, args.repeat))
+    report("snapshot (read into memory)", *timed(from_snapshot_read, args.repeat))
+    report("freshness check", *timed(lambda: is_fresh(args.csv, args.snapshot), args.repeat))
+
+
+def ranking_params(**overrides):
+    """Keyword arguments for api.build_ranking, the uncached ranking"""
+    params = dict(
+        rank_type="frequency", group_by="street", limit=10, min_crashes=DANGEROUS_MIN_CRASHES,
+        date_start=None, date_end=None, damage=None, crash_type=None,
+        injuries=None, cause=None, lighting=None,
+    )
+    params.update(overrides)
+    return params
+
+
+def load_api(args):
+    """Import the API pointed at the benchmark's data files"""
+    import api
+    api.DATA_PATH = args.csv
+    api.SNAPSHOT_DIR = args.snapshot
+    return api
+
+
+def ranking_peak_rss(args, copy_per_request):
+    """Peak RSS growth (KiB) while serving concurrent ranking requests"""
+    api = load_api(args)
+    dataset = api.get_dataset()
+    if copy_per_request:
+        # The old read path: every request started from a deep copy
+        def copying_dataset():
+            copy = api.Dataset.__new__(api.Dataset)
+            copy.__dict__.update(dataset.__dict__)
+            copy.df = dataset.df.copy()
+            return copy
+        api.get_dataset = copying_dataset
+
+    requests = [
+        ranking_params(group_by=group_by, rank_type=rank_type)
+        for group_by in ("street", "location")
+        for rank_type in ("frequency", "weighted", "dangerous")
+    ]
+    for params in requests:
+        api.build_ranking(**params)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        jobs = [requests[i % len(requests)] for i in range(args.concurrency * args.rounds)]
+        list(pool.map(lambda params: api.build_ranking(**params), jobs))
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+
+def bench_memory(args):
+    """Peak RSS under concurrent ranking requests: copy per request vs shared dataset"""
+    if not is_fresh(args.csv, args.snapshot):
+        build_snapshot(args.csv, args.snapshot)
+    # A fresh process per mode, since ru_maxrss only ever grows
+    ctx = multiprocessing.get_context("spawn")
+    for label, copy_per_request in (("copy per request", True), ("shared dataset", False)):
+        with ctx.Pool(1) as pool:
+            growth = pool.apply(ranking_peak_rss, (args, copy_per_request))
+        print(f"{label:<32} {args.concurrency} concurrent: peak RSS +{growth / 1024:8.1f} MiB")
+
+
+def random_filters(df, rng):
+    """A random combination of the filters the dashboard can send"""
+    choices = {param: df[col].dropna().unique().tolist() for param, col in CATEGORY_FILTERS.items()}
+    choices['injuries'] = ['none', 'non_incapacitating', 'incapacitating', 'fatal']
+    choices['cause'] = list(CAUSE_BUCKETS)
+
+    params = dict.fromkeys(['date_start', 'date_end', 'damage', 'crash_type', 'injuries', 'cause', 'lighting'])
+    for param, values in choices.items():
+        if values and rng.random() < 0.5:
+            params[param] = ','.join(rng.sample(values, rng.randint(1, len(values))))
+    if rng.random() < 0.5:
+        dates = df["CRASH_DATE_ONLY"].dropna()
+        start = dates.min() + (dates.max() - dates.min()) * rng.random()
+        end = start + pd.Timedelta(days=rng.randint(0, 730))
+        params['date_start'] = start.strftime('%Y-%m-%d')
+        params['date_end'] = end.strftime('%Y-%m-%d')
+    return params
+
+
+def one_sided(combos):
+    """The combos with a date range again with only its start, and with only its end"""
+    return [dict(params, **{bound: None})
+            for params in combos if params["date_start"]
+            for bound in ("date_start", "date_end")]
+
+
+def check_filters(dataset, combos):
+    """Raise unless the indexed filters and ranking totals match filter_mask for every combo"""
+    for params in combos:
+        expected = np.flatnonzero(filter_mask(dataset.df, **params))
+        if not np.array_equal(dataset.filter_rows(**params), expected):
+            raise AssertionError(f"Indexed filters disagree with filter_mask for {params}")
+        if dataset.group_totals("street", **params, measures=["COUNT"])[1] != len(expected):
+            raise AssertionError(f"Ranking total disagrees with filter_mask for {params}")
+
+
+def missing_dates_dataset(csv_path, workdir, rows=20000, missing=50):
+    """A Dataset of the first rows of csv_path, with the date of some of them removed"""
+    df = pd.read_csv(csv_path, nrows=rows, low_memory=False)
+    df.loc[df.sample(missing, random_state=0).index, "CRASH_DATE_ONLY"] = None
+    small_csv = os.path.join(workdir, "missing_dates.csv")
+    df.to_csv(small_csv, index=False)
+    return load_dataset(small_csv, os.path.join(workdir, "snapshot"))
+
+
+def bench_filters(args):
+    """Scan-based filter_mask vs the dataset's indexed filters, checking they agree"""
+    dataset = load_api(args).get_dataset()
+    rng = random.Random(0)
+    combos = [random_filters(dataset.df, rng) for _ in range(args.combinations)]
+
+    check_filters(dataset, combos + one_sided(combos))
+    print(f"{len(combos)} random filter combinations select identical rows")
+
+    # Crashes without a date only match when no date is given
+    workdir = tempfile.mkdtemp()
+    try:
+        undated = missing_dates_dataset(args.csv, workdir)
+        undated_combos = [random_filters(undated.df, rng) for _ in range(args.combinations)]
+        check_filters(undated, undated_combos + one_sided(undated_combos))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{len(undated_combos)} random filter combinations select identical rows with missing dates")
+
+    def scan():
+        for params in combos:
+            filter_mask(dataset.df, **params)
+
+    def indexed():
+        for params in combos:
+            dataset.filter_rows(**params)
+
+    report(f"scan x{len(combos)}", *timed(scan, args.repeat))
+    report(f"indexed x{len(combos)}", *timed(indexed, args.repeat))
+
+
+def bench_cube(args):
+    """Ranking totals from the cube vs aggregating raw rows, checking they agree"""
+    dataset = load_api(args).get_dataset()
+    rng = random.Random(0)
+    combos = [random_filters(dataset.df, rng) for _ in range(args.combinations)]
+
+    def raw(group_by, params):
+        return dataset.raw_totals(group_by, dataset.filter_rows(**params))
+
+    for group_by in ("street", "location"):
+        for params in combos:
+            expected, expected_total = raw(group_by, params)
+            for totals in (dataset.cube_totals, dataset.group_totals):
+                actual, total = totals(group_by, **params)
+                if total != expected_total or not actual.index.equals(expected.index):
+                    raise AssertionError(f"{totals.__name__} selects different {group_by} groups for {params}")
+                for col in dataset.measures:
+                    if not np.allclose(actual[col].to_numpy(dtype=float), expected[col].to_numpy(dtype=float)):
+                        raise AssertionError(f"{totals.__name__} {col} differs from raw rows for {group_by} {params}")
+    print(f"{len(combos)} random filter combinations match raw aggregation")
+
+    for group_by in ("street", "location"):
+        cube = dataset.cubes[group_by]
+        print(f"{group_by} cube: {len(cube.arrays['month'])} rows for {len(dataset.df)} crashes")
+        report(f"raw {group_by} x{len(combos)}",
+               *timed(lambda: [raw(group_by, params) for params in combos], args.repeat))
+        report(f"cube {group_by} x{len(combos)}",
+               *timed(lambda: [dataset.cube_totals(group_by, **params) for params in combos], args.repeat))
+        report(f"group_totals {group_by} x{len(combos)}",
+               *timed(lambda: [dataset.group_totals(group_by, **params) for params in combos], args.repeat))
+
+
+def bench_ranking(args):
+    """Ranking latency vs number of groups: full sort vs partial top-k"""
+    rng = np.random.default_rng(0)
+    for groups in (1_000, 10_000, 100_000, 1_000_000):
+        # Small integer counts, so there are plenty of ties to break
+        frame = pd.DataFrame({"COUNT": rng.poisson(3, groups)})
+        scores = frame["COUNT"].to_numpy()
+        expected = np.lexsort((np.arange(groups), -scores))[:args.limit]
+        if not np.array_equal(top_k(scores, args.limit), expected):
+            raise AssertionError(f"top_k disagrees with a stable sort for {groups} groups")
+        report(f"sort_values {groups:>9,} groups",
+               *timed(lambda: frame.sort_values("COUNT", ascending=False).head(args.limit), args.repeat))
+        report(f"top_k       {groups:>9,} groups", *timed(lambda: top_k(scores, args.limit), args.repeat))
+
+    api = load_api(args)
+    dataset = api.get_dataset()
+    for group_by in ("street", "location"):
+        print(f"{group_by}: {dataset.group_count(group_by):,} groups")
+        for rank_type in ("frequency", "weighted", "dangerous"):
+            params = ranking_params(group_by=group_by, rank_type=rank_type, limit=args.limit)
+            report(f"  build_ranking {rank_type}", *timed(lambda: api.build_ranking(**params), args.repeat))
+
+
+def bench_points(args):
+    """Heatmap point extraction: iterrows loop vs heat_points"""
+    rng = np.random.default_rng(0)
+    for n in (10_000, 100_000, 1_000_000):
+        frame = pd.DataFrame({
+            "LATITUDE": rng.uniform(41.64, 42.02, n),
+            "LONGITUDE": rng.uniform(-87.94, -87.52, n),
+            "INJURY_SCORE": rng.poisson(0.3, n).astype(float),
+        })
+
+        def loop():
+            heat_data = []
+            for _, row in frame.iterrows():
+                if not pd.isna(row['LATITUDE']) and not pd.isna(row['LONGITUDE']):
+                    heat_data.append([row['LATITUDE'], row['LONGITUDE']])
+            return heat_data
+
+        # The old loop takes about a minute at 1M points, so it is skipped there
+        if n <= 100_000:
+            if loop() != heat_points(frame["LATITUDE"], frame["LONGITUDE"]):
+                raise AssertionError(f"heat_points disagrees with the iterrows loop at {n} points")
+            report(f"iterrows      {n:>9,} points", *timed(loop, 1))
+        report(f"heat_points   {n:>9,} points",
+               *timed(lambda: heat_points(frame["LATITUDE"], frame["LONGITUDE"]), args.repeat))
+        report(f"  weighted    {n:>9,} points",
+               *timed(lambda: heat_points(frame["LATITUDE"], frame["LONGITUDE"], frame["INJURY_SCORE"]), args.repeat))
+
+
+def bench_grid(args):
+    """Server-side heat grid: cells sent and binning time vs number of crashes"""
+    rng = np.random.default_rng(0)
+    for n in (10_000, 100_000, 1_000_000):
+        lat = rng.normal(41.85, 0.08, n)
+        lon = rng.normal(-87.68, 0.07, n)
+        for zoom in (11, 13, 15, 18):
+            cells = heat_grid(lat, lon, zoom=zoom)
+            if round(sum(weight for _, _, weight in cells)) != n:
+                raise AssertionError(f"Heat grid lost crashes at {n} points, zoom {zoom}")
+            if len(cells) > GRID_MAX_CELLS:
+                raise AssertionError(f"Heat grid sent {len(cells):,} cells at {n} points, zoom {zoom}")
+            best, median = timed(lambda: heat_grid(lat, lon, zoom=zoom), args.repeat)
+            print(f"{n:>9,} crashes  zoom {zoom:>2}  {len(cells):>7,} cells   "
+                  f"best {best * 1000:7.1f} ms   median {median * 1000:7.1f} ms")
+
+
+def bench_tiles(args):
+    """Map tiles from the spatial index, checked against a full scan, and their cost per tile"""
+    api = load_api(args)
+    dataset = api.get_dataset()
+    df = dataset.df
+    lat, lon = df["LATITUDE"].to_numpy(dtype=float), df["LONGITUDE"].to_numpy(dtype=float)
+    located = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)) & (lat != 0) & (lon != 0))
+    rng = random.Random(0)
+
+    for zoom in (11, 13, 15, 17):
+        # Tiles around randomly picked crashes, so they are never empty
+        tiles = set()
+        for i in rng.sample(list(located), min(args.combinations, len(located))):
+            x, y = mercator_pixels(lat[i], lon[i], zoom)
+            tiles.add((zoom, int(x // TILE_SIZE), int(y // TILE_SIZE)))
+        tiles = sorted(tiles)
+        combos = [random_filters(df, rng) for _ in tiles]
+
+        px, py = mercator_pixels(lat, lon, zoom)
+        for (z, x, y), params in list(zip(tiles, combos))[:20]:
+            on_tile = np.zeros(len(df), dtype=bool)
+            on_tile[located] = True
+            on_tile &= (px // TILE_SIZE == x) & (py // TILE_SIZE == y) & filter_mask(df, **params)
+            features = api.build_tile(z, x, y, **params)["features"]
+            if sum(f["properties"]["crashes"] for f in features) != on_tile.sum():
+                raise AssertionError(f"Tile {z}/{x}/{y} disagrees with a full scan for {params}")
+
+        best, median = timed(lambda: [api.build_tile(*tile, **params) for tile, params in zip(tiles, combos)], args.repeat)
+        print(f"zoom {zoom:>2}  {len(tiles):>4} tiles   per tile best {best / len(tiles) * 1000:6.2f} ms"
+              f"   median {median / len(tiles) * 1000:6.2f} ms")
+
+
+def bench_spatial(args):
+    """Bounding box, radius and nearest hotspot queries vs full scans"""
+    dataset = load_api(args).get_dataset()
+    df = dataset.df
+    lat, lon = df["LATITUDE"].to_numpy(dtype=float), df["LONGITUDE"].to_numpy(dtype=float)
+    located = ~(np.isnan(lat) | np.isnan(lon)) & (lat != 0) & (lon != 0)
+    rng = random.Random(0)
+    centres = [int(i) for i in rng.sample(list(np.flatnonzero(located)), args.combinations)]
+    combos = [random_filters(df, rng) for _ in centres]
+    boxes = [(lat[i] - 0.01, lon[i] - 0.015, lat[i] + 0.01, lon[i] + 0.015) for i in centres]
+
+    def bbox_scan(box, params):
+        south, west, north, east = box
+        inside = located & (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        return np.flatnonzero(inside & filter_mask(df, **params))
+
+    def radius_scan(i, params, radius=150):
+        inside = located & (haversine_m(lat[i], lon[i], lat, lon) <= radius)
+        return np.flatnonzero(inside & filter_mask(df, **params))
+
+    def hotspot_scan(i, params, k=5):
+        rows = np.flatnonzero(located & filter_mask(df, **params))
+        cells = dataset.cell_ids[rows]
+        counts = np.bincount(cells[cells >= 0], minlength=len(dataset.cell_lat_bin))
+        hot = np.flatnonzero(counts >= DANGEROUS_MIN_CRASHES)
+        distance = haversine_m(lat[i], lon[i], dataset.cell_lat_bin[hot] * LOCATION_DELTA,
+                               dataset.cell_lon_bin[hot] * LOCATION_DELTA)
+        keep = distance <= HOTSPOT_MAX_RADIUS_M
+        hot, distance = hot[keep], distance[keep]
+        return hot[np.lexsort((hot, distance))[:k]]
+
+    for i, box, params in zip(centres, boxes, combos):
+        if not np.array_equal(dataset.bbox_rows(box, **params), bbox_scan(box, params)):
+            raise AssertionError(f"bbox query disagrees with a scan for {box} {params}")
+        rows, _ = dataset.nearby_rows(lat[i], lon[i], 150, **params)
+        if not np.array_equal(np.sort(rows), radius_scan(i, params)):
+            raise AssertionError(f"radius query disagrees with a scan around row {i} for {params}")
+        cells, _, totals = dataset.nearest_hotspots(lat[i], lon[i], 5, DANGEROUS_MIN_CRASHES, **params)
+        if not np.array_equal(cells, hotspot_scan(i, params)):
+            raise AssertionError(f"nearest hotspots disagree with a scan around row {i} for {params}")
+        if (totals["COUNT"].to_numpy() < DANGEROUS_MIN_CRASHES).any():
+            raise AssertionError(f"nearest hotspots report cells under the threshold around row {i}")
+    print(f"{len(centres)} random bbox, radius and nearest hotspot queries match full scans")
+
+    queries = list(zip(centres, boxes, combos))
+    report(f"bbox scan x{len(queries)}", *timed(lambda: [bbox_scan(b, p) for _, b, p in queries], args.repeat))
+    report(f"bbox index x{len(queries)}", *timed(lambda: [dataset.bbox_rows(b, **p) for _, b, p in queries], args.repeat))
+    report(f"radius scan x{len(queries)}", *timed(lambda: [radius_scan(i, p) for i, _, p in queries], args.repeat))
+    report(f"radius index x{len(queries)}",
+           *timed(lambda: [dataset.nearby_rows(lat[i], lon[i], 150, **p) for i, _, p in queries], args.repeat))
+    report(f"hotspot scan x{len(queries)}", *timed(lambda: [hotspot_scan(i, p) for i, _, p in queries], args.repeat))
+    report(f"hotspot index x{len(queries)}",
+           *timed(lambda: [dataset.nearest_hotspots(lat[i], lon[i], 5, DANGEROUS_MIN_CRASHES, **p)
+                           for i, _, p in queries], args.repeat))
+
+
+def serve(args, port):
+    """Run the API with uvicorn on a local port (in its own process)"""
+    import uvicorn
+    api = load_api(args)
+    api.get_dataset()
+    if args.no_cache:
+        # Every request renders, unless it joins an identical one in flight
+        api.response_cache.max_bytes = 0
+        api.preset_store = api.PresetStore()
+    uvicorn.run(api.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def load_requests(df, rng, count):
+    """count random ranking and heatmap requests as (path, params)"""
+    requests = []
+    for _ in range(count):
+        params = {k: v for k, v in random_filters(df, rng).items() if v is not None}
+        if rng.random() < 0.25:
+            requests.append(("/api/heatmap", dict(params, mode="grid", zoom=11, format="binary")))
+        else:
+            requests.append(("/api/ranking", dict(params, rank_type=rng.choice(["frequency", "weighted", "dangerous"]),
+                                                  group_by=rng.choice(["street", "location"]))))
+    return requests
+
+
+async def load_level(client, requests, users, duration, rng):
+    """Latencies of users clients each sending random requests for duration seconds"""
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def user():
+        while time.perf_counter() < deadline:
+            path, params = rng.choice(requests)
+            start = time.perf_counter()
+            response = await client.get(path, params=params)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                raise AssertionError(f"{path} {params} returned {response.status_code}")
+
+    await asyncio.gather(*(user() for _ in range(users)))
+    return latencies
+
+
+async def run_load(args, url):
+    import httpx
+    df = load_api(args).get_dataset().df
+    async with httpx.AsyncClient(base_url=url, timeout=600, limits=httpx.Limits(max_connections=None)) as client:
+        for _ in range(600):
+            try:
+                await client.get("/")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.5)
+        for users in args.users:
+            # New filter combinations per level, so earlier levels did not cache them
+            rng = random.Random(users)
+            requests = load_requests(df, rng, args.combinations)
+            before = (await client.get("/api/cache")).json()
+            start = time.perf_counter()
+            latencies = await load_level(client, requests, users, args.duration, rng)
+            elapsed = time.perf_counter() - start
+            after = (await client.get("/api/cache")).json()
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            print(f"{users:>3} users  {len(latencies):6d} requests  {len(latencies) / elapsed:8.1f} req/s"
+                  f"   p50 {p50:8.1f} ms   p99 {p99:8.1f} ms"
+                  f"   renders {after['renders'] - before['renders']:5d}"
+                  f"   coalesced {after['coalesced'] - before['coalesced']:4d}")
+
+
+def bench_load(args):
+    """Latency and throughput of a local uvicorn server at several numbers of concurrent users"""
+    if not is_fresh(args.csv, args.snapshot):
+        build_snapshot(args.csv, args.snapshot)
+    port = 8765
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(args, port), daemon=True)
+    server.start()
+    try:
+        asyncio.run(run_load(args, f"http://127.0.0.1:{port}"))
+    finally:
+        server.terminate()
+        server.join()
+
+
+def process_memory(pid):
+    """RSS, PSS and private memory (KiB) of a process, from /proc"""
+    memory = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                memory[fields[0][:-1]] = int(fields[1])
+    return memory["Rss"], memory["Pss"], memory["Private_Clean"] + memory["Private_Dirty"]
+
+
+def descendants(pid):
+    """pid and all of its child processes, recursively"""
+    children = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            children += [int(child) for child in f.read().split()]
+    return [pid] + [p for child in children for p in descendants(child)]
+
+
+def maps_snapshot(pid, snapshot_dir):
+    """Whether a process has the snapshot mapped, i.e. is an API worker"""
+    try:
+        with open(f"/proc/{pid}/maps") as f:
+            return os.path.realpath(snapshot_dir) in f.read()
+    except OSError:
+        return False
+
+
+async def warm_up(url, df, workers):
+    """Send each worker's share of a request mix so they all touch the data"""
+    import httpx
+    rng = random.Random(0)
+    requests = load_requests(df, rng, 40 * workers) + [
+        ("/api/nearby", dict(lat=lat, lon=lon, radius=500))
+        for lat, lon in df[["LATITUDE", "LONGITUDE"]].dropna().sample(10 * workers, random_state=0).to_numpy()
+    ]
+    async with httpx.AsyncClient(base_url=url, timeout=600) as client:
+        for _ in range(600):
+            try:
+                await client.get("/")
+                break
+            except httpx.TransportError:
+                await asyncio.sleep(0.5)
+        semaphore = asyncio.Semaphore(2 * workers)
+
+        async def send(path, params):
+            async with semaphore:
+                response = await client.get(path, params=params)
+                if response.status_code != 200:
+                    raise AssertionError(f"{path} {params} returned {response.status_code}")
+
+        await asyncio.gather(*(send(path, params) for path, params in requests))
+
+
+def bench_workers(args):
+    """Per-worker memory of `api.py --workers N`, which map one shared snapshot"""
+    if not is_fresh(args.csv, args.snapshot):
+        build_snapshot(args.csv, args.snapshot)
+    df = load_api(args).get_dataset().df
+    port = 8766
+    single_pss = None
+    for workers in args.workers:
+        server = subprocess.Popen([sys.executable, "api.py", "--workers", str(workers), "--port", str(port),
+                                   "--csv", args.csv, "--snapshot", args.snapshot],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            asyncio.run(warm_up(f"http://127.0.0.1:{port}", df, workers))
+            pids = [pid for pid in descendants(server.pid) if maps_snapshot(pid, args.snapshot)]
+            memory = [process_memory(pid) for pid in pids]
+        finally:
+            server.terminate()
+            server.wait()
+        if len(pids) != workers:
+            raise AssertionError(f"expected {workers} workers mapping the snapshot, found {len(pids)}")
+        rss, pss, private = (sum(column) / len(memory) / 1024 for column in zip(*memory))
+        total_pss = sum(m[1] for m in memory) / 1024
+        print(f"{workers} workers   per worker: RSS {rss:7.1f} MiB  PSS {pss:7.1f} MiB  private {private:7.1f} MiB"
+              f"   all workers PSS {total_pss:8.1f} MiB")
+        if single_pss is None:
+            single_pss = total_pss
+        elif total_pss >= workers * single_pss:
+            raise AssertionError(f"{workers} workers use {total_pss:.0f} MiB, no less than {workers} separate copies")
+
+
+def load_dataset(csv_path, snapshot_dir):
+    """A Dataset for csv_path, building whatever is not cached in snapshot_dir"""
+    from dataset import Dataset
+    df, text, source = load_dataframe(csv_path, snapshot_dir)
+    return Dataset(df, text=text, source=source, cache_dir=snapshot_dir)
+
+
+def check_same_dataset(ingested, rebuilt, combos):
+    """Raise unless two Datasets hold the same rows, index and ranking totals"""
+    if ingested.columns != rebuilt.columns:
+        raise AssertionError(f"columns differ: {ingested.columns} vs {rebuilt.columns}")
+    for col in ingested.df.columns:
+        pd.testing.assert_series_equal(ingested.df[col], rebuilt.df[col])
+    for col in ingested.text:
+        if not np.array_equal(ingested.text[col], rebuilt.text[col]):
+            raise AssertionError(f"text column {col} differs")
+    arrays = ["street_ids", "street_names", "cell_ids", "cell_lat_bin", "cell_lon_bin", "record_order"]
+    for name in arrays:
+        if not np.array_equal(getattr(ingested, name), getattr(rebuilt, name)):
+            raise AssertionError(f"{name} differs")
+    for name, values in ingested.spatial_index.arrays().items():
+        if not np.array_equal(values, rebuilt.spatial_index.arrays()[name]):
+            raise AssertionError(f"spatial index {name} differs")
+    for name, values in ingested.rollups.arrays.items():
+        if not np.array_equal(values, rebuilt.rollups.arrays[name]):
+            raise AssertionError(f"rollup {name} differs")
+    if ingested.rollups.meta() != rebuilt.rollups.meta():
+        raise AssertionError("rollup conditions or span differ")
+    for params in combos:
+        if not np.array_equal(ingested.filter_rows(**params), rebuilt.filter_rows(**params)):
+            raise AssertionError(f"filtered rows differ for {params}")
+        for group_by in ("street", "location"):
+            pd.testing.assert_frame_equal(ingested.cube_totals(group_by, **params)[0],
+                                          rebuilt.cube_totals(group_by, **params)[0])
+
+
+def bench_ingest(args):
+    """Incremental ingestion vs a full rebuild, checking both give the same dataset"""
+    import ingest
+    with open(args.csv) as f:
+        lines = f.readlines()
+    rng = random.Random(0)
+    workdir = tempfile.mkdtemp()
+    try:
+        for size in args.deltas:
+            csv_path, delta_path = os.path.join(workdir, "crashes.csv"), os.path.join(workdir, "delta.csv")
+            snapshot_dir, rebuilt_dir = os.path.join(workdir, "snapshot"), os.path.join(workdir, "rebuilt")
+            # The base is everything but the last rows; the delta holds those,
+            # plus rows the base already has and repeats, which must be skipped
+            base, new = lines[:-size], lines[-size:]
+            with open(csv_path, "w") as f:
+                f.writelines(base)
+            with open(delta_path, "w") as f:
+                f.writelines([lines[0]] + new + rng.sample(base[1:], min(100, len(base) - 1)) + new[:50])
+            load_dataset(csv_path, snapshot_dir)
+
+            start = time.perf_counter()
+            added = ingest.ingest([delta_path], csv_path, snapshot_dir)
+            ingest_time = time.perf_counter() - start
+            if added != size:
+                raise AssertionError(f"ingested {added} rows out of a delta of {size} new ones")
+
+            start = time.perf_counter()
+            build_snapshot(csv_path, rebuilt_dir)
+            rebuilt = load_dataset(csv_path, rebuilt_dir)
+            rebuild_time = time.perf_counter() - start
+
+            ingested = load_dataset(csv_path, snapshot_dir)
+            combos = [random_filters(rebuilt.df, rng) for _ in range(args.combinations)]
+            check_same_dataset(ingested, rebuilt, combos)
+            print(f"{size:>7} new rows   ingest {ingest_time:7.2f}s   full rebuild {rebuild_time:7.2f}s"
+                  f"   same data for {len(combos)} filter combinations")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def legacy_json(content, nulls):
+    """content serialised the way the API used to: records dicts through jsonable_encoder"""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    records = {}
+    for key, value in content.items():
+        if isinstance(value, pd.DataFrame):
+            if nulls:
+                value = value.astype(object).where(value.notna(), None)
+            value = value.to_dict(orient="records")
+        records[key] = value
+    return JSONResponse(jsonable_encoder(records)).body
+
+
+def same_json(a, b):
+    """Equal JSON values, floats compared to the 10 decimals FrameJSONResponse writes"""
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(same_json(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(same_json(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, (int, float)):
+        return math.isclose(a, b, rel_tol=1e-12, abs_tol=1e-10)
+    return a == b
+
+
+def bench_json(args):
+    """Ranking and sample responses: to_dict + jsonable_encoder vs FrameJSONResponse"""
+    from responses import FrameJSONResponse
+    api = load_api(args)
+    dataset = api.get_dataset()
+    for size in args.sizes:
+        ranking = api.build_ranking(**ranking_params(rank_type="weighted", group_by="location", limit=size))
+        sample = {"data": dataset.frame(dataset.columns, np.arange(len(dataset.df))[:size])}
+        # The sample has missing values, which used to need converting to None
+        for label, content, nulls in (("ranking", ranking, False), ("sample", sample, True)):
+            rows = len(content["ranking" if label == "ranking" else "data"])
+            legacy = lambda: legacy_json(content, nulls)
+            framed = lambda: FrameJSONResponse(content).body
+            if not same_json(json.loads(legacy()), json.loads(framed())):
+                raise AssertionError(f"FrameJSONResponse differs from jsonable_encoder for the {label} of {rows} rows")
+            report(f"{label:<7} {rows:>7} rows encoder", *timed(legacy, args.repeat))
+            report(f"{label:<7} {rows:>7} rows frame", *timed(framed, args.repeat))
+
+
+def peak_rss_since_reset(pid, reset=False):
+    """Current and peak RSS (KiB) of a process; reset=True starts a new peak"""
+    if reset:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    memory = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                memory[line.split(":")[0]] = int(line.split()[1])
+    return memory["VmRSS"], memory["VmHWM"]
+
+
+def export_pages(client, params, page_size):
+    """Every page of an NDJSON export of params, as lists of records"""
+    pages, cursor = [], None
+    while True:
+        response = client.get("/api/export", params=dict(params, limit=page_size, cursor=cursor))
+        response.raise_for_status()
+        pages.append([json.loads(line) for line in response.text.splitlines()])
+        cursor = response.headers.get("x-next-cursor")
+        if cursor is None:
+            return pages
+
+
+def timed_download(client, url, pid):
+    """Time to first byte, total time, bytes and server peak RSS growth (KiB) of one streamed GET"""
+    baseline, _ = peak_rss_since_reset(pid, reset=True)
+    start = time.perf_counter()
+    first, size = None, 0
+    with client.stream("GET", url) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes():
+            first = first or time.perf_counter()
+            size += len(chunk)
+    elapsed = time.perf_counter() - start
+    _, peak = peak_rss_since_reset(pid)
+    return first - start, elapsed, size, peak - baseline
+
+
+def bench_export(args):
+    """Checks paged exports against filter_mask, then times full exports against /api/data/sample"""
+    import httpx
+    if not is_fresh(args.csv, args.snapshot):
+        build_snapshot(args.csv, args.snapshot)
+    port = 8767
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(args, port), daemon=True)
+    server.start()
+    try:
+        dataset = load_api(args).get_dataset()
+        client = httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=600)
+        for _ in range(600):
+            try:
+                client.get("/")
+                break
+            except httpx.TransportError:
+                time.sleep(0.5)
+
+        rng = random.Random(0)
+        for _ in range(args.combinations):
+            filters = random_filters(dataset.df, rng)
+            params = {k: v for k, v in filters.items() if v is not None}
+            expected = dataset.frame([RECORD_ID], np.flatnonzero(filter_mask(dataset.df, **filters)))[RECORD_ID]
+            pages = export_pages(client, params, args.page_size)
+            if any(len(page) > args.page_size for page in pages):
+                raise AssertionError(f"A page of {params} holds more than {args.page_size} rows")
+            paged = [record[RECORD_ID] for page in pages for record in page]
+            whole = pd.read_csv(io.StringIO(client.get("/api/export", params=dict(params, format="csv")).text),
+                                dtype=str)[RECORD_ID]
+            if paged != expected.tolist() or whole.tolist() != expected.tolist():
+                raise AssertionError(f"Export of {params} differs from filter_mask")
+        print(f"{args.combinations} random filter combinations export the filtered rows, "
+              f"paged by {args.page_size} and whole")
+
+        # Touch every mapped column first, so the peaks below are the memory
+        # each response needs and not the snapshot being paged in
+        timed_download(client, "/api/export?format=csv", server.pid)
+        rows = len(dataset.df)
+        urls = [(f"{format} export", f"/api/export?format={format}") for format in ["ndjson", "csv", "arrow"]]
+        urls.append(("data/sample", f"/api/data/sample?limit={rows}"))
+        for label, url in urls:
+            if label == "arrow export" and client.get("/api/export?format=arrow&limit=1").status_code == 501:
+                print(f"{label:<16} skipped: pyarrow is not installed")
+                continue
+            first, elapsed, size, growth = timed_download(client, url, server.pid)
+            print(f"{label:<16} {rows} rows   first byte {first * 1000:8.1f} ms   total {elapsed:6.2f}s"
+                  f"   {size / elapsed / 2**20:6.1f} MiB/s   server peak RSS +{growth / 1024:6.1f} MiB")
+    finally:
+        server.terminate()
+        server.join()
+
+
+def bench_timeseries(args):
+    """Crashes per hour, day and month: rollups vs grouping the crash timestamps"""
+    from dataset import crash_times
+    from rollup import Rollups
+    dataset = load_api(args).get_dataset()
+    times = crash_times(dataset.df, dataset.text, dataset.dates)
+    dated = pd.Series(times.view("datetime64[ns]")).dropna()
+    floors = {
+        "hour": lambda t: t.dt.floor("h"),
+        "day": lambda t: t.dt.floor("D"),
+        "month": lambda t: t.dt.to_period("M").dt.to_timestamp(),
+    }
+    for granularity, floor in floors.items():
+        expected = dated.groupby(floor(dated)).size()
+        actual = dataset.rollups.frame(granularity).groupby("period")["crashes"].sum()
+        if not (actual.index.equals(expected.index) and np.array_equal(actual.to_numpy(), expected.to_numpy())):
+            raise AssertionError(f"{granularity} rollup differs from the crash timestamps")
+    if dataset.rollups.span != (int(dated.min().value), int(dated.max().value)):
+        raise AssertionError("rollup span differs from the crash timestamps")
+    print(f"hour, day and month rollups match {len(dated)} crash timestamps")
+
+    report("build rollups", *timed(lambda: Rollups.build(times), args.repeat))
+    for granularity, floor in floors.items():
+        report(f"group timestamps by {granularity}", *timed(lambda: dated.groupby(floor(dated)).size(), args.repeat))
+        report(f"rollup {granularity} frame", *timed(lambda: dataset.rollups.frame(granularity), args.repeat))
+
+
+def main():
+    # Every subcommand takes the same options, after its name
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--csv", default=DATA_PATH)
+    options.add_argument("--snapshot", default=SNAPSHOT_DIR)
+    options.add_argument("--repeat", type=int, default=5)
+    options.add_argument("--concurrency", type=int, default=8)
+    options.add_argument("--rounds", type=int, default=4)
+    options.add_argument("--combinations", type=int, default=200)
+    options.add_argument("--limit", type=int, default=10)
+    options.add_argument("--users", type=lambda v: [int(u) for u in v.split(",")], default=[1, 10, 50])
+    options.add_argument("--duration", type=float, default=10)
+    options.add_argument("--no-cache", action="store_true", help="load test without the response cache and presets")
+    options.add_argument("--workers", type=lambda v: [int(w) for w in v.split(",")], default=[1, 4, 8])
+    options.add_argument("--deltas", type=lambda v: [int(d) for d in v.split(",")], default=[1000, 10000, 100000])
+    options.add_argument("--page-size", type=int, default=5000)
+    options.add_argument("--sizes", type=lambda v: [int(n) for n in v.split(",")], default=[10, 1000, 100000])
+
+    parser = argparse.ArgumentParser(description="API data path benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    commands = {
+        "startup": bench_startup, "memory": bench_memory, "filters": bench_filters, "cube": bench_cube,
+        "ranking": bench_ranking, "points": bench_points, "grid": bench_grid, "tiles": bench_tiles,
+        "spatial": bench_spatial, "load": bench_load, "workers": bench_workers, "ingest": bench_ingest,
+        "export": bench_export, "json": bench_json, "timeseries": bench_timeseries,
+    }
+    for name, func in commands.items():
+        sub.add_parser(name, parents=[options], help=func.__doc__).set_defaults(func=func)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
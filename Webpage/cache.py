@@ -0,0 +1,227 @@
+"""In-process cache of rendered API responses.
+
+The dashboard re-requests the ranking and the map every time a setting
+changes, and users keep flipping between the same few combinations. A
+ResponseCache keeps the rendered bodies of recent responses, keyed on the
+canonical form of their parameters, so a repeated request is answered
+without touching the data. It is bounded by the total size of the bodies it
+holds (least recently used entries go first) and entries expire after a
+TTL. Everything cached belongs to one dataset version; when the dataset
+changes the whole cache is dropped.
+
+Responses for the dashboard's common views can also be computed ahead of
+time by precompute.py and saved as a preset store, which the API loads into
+a PresetStore and serves before trying the cache. A SingleFlight makes
+identical requests that miss both at the same time share one render.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from filters import parse_date
+
+# Parameters holding comma separated filter values, whose order never matters
+LIST_PARAMS = ('damage', 'crash_type', 'injuries', 'cause', 'lighting')
+DATE_PARAMS = ('date_start', 'date_end')
+
+
+def canonical_params(params):
+    """Hashable form of request parameters: equivalent requests compare equal.
+
+    Filter lists are split, deduplicated and sorted (the filters only ever
+    test membership in them), dates are reduced to their ISO form and empty
+    values are dropped.
+    """
+    canonical = []
+    for name, value in sorted(params.items()):
+        if value is None or value == '':
+            continue
+        if name in LIST_PARAMS:
+            value = ','.join(sorted(set(value.split(','))))
+        elif name in DATE_PARAMS:
+            value = parse_date(value).isoformat()
+        canonical.append((name, value))
+    return tuple(canonical)
+
+
+def key_string(key):
+    """Stable text form of a cache key, used to name stored presets"""
+    return json.dumps(key, default=str)
+
+
+class CachedResponse:
+    """A rendered response body plus what is needed to revalidate it"""
+
+    def __init__(self, body, media_type):
+        self.body = body
+        self.media_type = media_type
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self.created = time.monotonic()
+
+
+class ResponseCache:
+    """LRU cache of CachedResponses bounded by total body size, with a TTL"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def bind(self, version):
+        """Drop everything cached for another dataset version"""
+        with self.lock:
+            if version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry.created > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry, version=None):
+        """Store entry, evicting least recently used ones to stay in budget.
+
+        An entry rendered from another dataset version than the one bound
+        now (the dataset changed while it was rendering) is not stored.
+        """
+        if len(entry.body) > self.max_bytes:
+            return
+        with self.lock:
+            if version != self.version:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= len(self.entries.pop(key).body)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+            }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one computation.
+
+    Only used from the event loop, so it needs no lock. A caller that goes
+    away (a closed connection) does not cancel the computation the others
+    are waiting for.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def run(self, key, executor, fn):
+        """Result of fn() run on executor, shared with every caller of the same key meanwhile"""
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(executor, fn)
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def stats(self):
+        return {'renders': self.started, 'coalesced': self.coalesced, 'in_flight': len(self.calls)}
+
+
+# Bump whenever the preset store layout, or how the stored responses are
+# computed, changes
+PRESET_VERSION = 2
+PRESET_META = "meta.json"
+
+
+def save_presets(directory, responses, source):
+    """Write {key: CachedResponse} as a preset store for the given source CSV.
+
+    Each body goes to its own file next to a meta.json index; the store is
+    written to a temporary directory and moved into place.
+    """
+    tmp_dir = directory + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    entries = {}
+    for key, entry in responses.items():
+        name = key_string(key)
+        file = hashlib.sha1(name.encode()).hexdigest() + ".body"
+        with open(os.path.join(tmp_dir, file), "wb") as f:
+            f.write(entry.body)
+        entries[name] = {"file": file, "media_type": entry.media_type}
+    with open(os.path.join(tmp_dir, PRESET_META), "w") as f:
+        json.dump({"version": PRESET_VERSION, "source": source, "entries": entries}, f, indent=2)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+
+
+class PresetStore:
+    """Precomputed responses, read-only once loaded"""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+        self.hits = 0
+
+    @classmethod
+    def load(cls, directory, source):
+        """The store in directory if it was computed from source, else an empty one"""
+        path = os.path.join(directory, PRESET_META)
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            meta = json.load(f)
+        if meta.get("version") != PRESET_VERSION or meta.get("source") != source:
+            return cls()
+        entries = {}
+        for name, info in meta["entries"].items():
+            with open(os.path.join(directory, info["file"]), "rb") as f:
+                entries[name] = CachedResponse(f.read(), info["media_type"])
+        return cls(entries)
+
+    def get(self, key):
+        entry = self.entries.get(key_string(key))
+        if entry is not None:
+            self.hits += 1
+        return entry
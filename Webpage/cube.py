@@ -0,0 +1,223 @@
+"""Pre-aggregated ranking cube.
+
+Rankings only need a handful of sums (crash count, injury score and the
+injury counts) per street or grid cell. A RankingCube holds those sums for
+every combination of month, group and filter dimension that occurs in the
+data, so a ranking request sums a slice of the cube instead of aggregating
+raw crash rows. Cubes are cached next to the dataset snapshot.
+"""
+import numpy as np
+import pandas as pd
+
+from filters import CATEGORY_FILTERS, CAUSE_BUCKETS, cause_column, injury_classes
+
+# Bump whenever the cube layout changes so cached cubes are rebuilt
+CUBE_VERSION = 1
+
+# Measures the rankings aggregate; the other columns are never summed
+MEASURES = ['COUNT', 'INJURY_SCORE', 'INJURIES_FATAL',
+            'INJURIES_INCAPACITATING', 'INJURIES_NON_INCAPACITATING']
+
+# Month index of crashes without a date; they only match unfiltered dates
+NO_MONTH = np.iinfo(np.int32).min
+
+# Cause bucket codes; 0 is every cause outside the three buckets
+CAUSE_CODES = {bucket: code for code, bucket in enumerate(CAUSE_BUCKETS, start=1)}
+
+# A crash can fall into several injury classes, so they are stored as bits
+INJURY_BITS = {name: 1 << i for i, name in enumerate(['none', 'non_incapacitating', 'incapacitating', 'fatal'])}
+
+
+def month_index(dates):
+    """Months since 1970-01 of int64 nanosecond dates, NO_MONTH for NaT"""
+    months = dates.view("datetime64[ns]").astype("datetime64[M]").astype(np.int64)
+    return np.where(dates == np.iinfo(np.int64).min, NO_MONTH, months).astype(np.int32)
+
+
+def month_start(month):
+    return pd.Timestamp(np.datetime64(int(month), "M"))
+
+
+def filter_signature(df, values=None):
+    """One code per row combining all of its filter dimensions.
+
+    Each dimension (damage, crash type, lighting, cause bucket, injury class
+    bits) is a digit of a mixed-radix number, so a request turns its filters
+    into a lookup table over all possible signatures. Returns the per-row
+    signatures, the radix of each dimension and the values behind the
+    categorical codes (code 0 is reserved for missing values).
+
+    values, if given, are the categorical values of an existing cube: its
+    codes are kept and values it lacks get the next ones.
+    """
+    digits, radices = {}, {}
+    values = {param: list(known) for param, known in (values or {}).items()}
+    for param, col in CATEGORY_FILTERS.items():
+        if col in df.columns:
+            codes, uniques = pd.factorize(df[col])
+            known = values.setdefault(param, [])
+            lookup = {value: code for code, value in enumerate(known)}
+            for value in uniques:
+                if value not in lookup:
+                    lookup[value] = len(known)
+                    known.append(value)
+            digits[param] = np.array([lookup[value] for value in uniques] + [-1], dtype=np.int64)[codes] + 1
+            radices[param] = len(known) + 1
+
+    cause_col = cause_column(df)
+    if cause_col:
+        codes, uniques = pd.factorize(df[cause_col])
+        bucket_of = {value: CAUSE_CODES[bucket] for bucket, causes in CAUSE_BUCKETS.items() for value in causes}
+        buckets = np.array([bucket_of.get(value, 0) for value in uniques] + [0])
+        digits['cause'] = buckets[codes]
+        radices['cause'] = len(CAUSE_CODES) + 1
+
+    bits = np.zeros(len(df), dtype=np.int64)
+    for name, cond in injury_classes(df).items():
+        bits |= np.where(cond.to_numpy(), INJURY_BITS[name], 0)
+    digits['injuries'] = bits
+    radices['injuries'] = 1 << len(INJURY_BITS)
+
+    signature = np.zeros(len(df), dtype=np.int64)
+    for param, digit in digits.items():
+        signature = signature * radices[param] + digit
+    return signature.astype(np.int32), radices, values
+
+
+def recode(signature, old_radices, new_radices):
+    """Signatures re-encoded after some dimensions gained values (the digits stay the same)"""
+    rest = signature.astype(np.int64)
+    digits = []
+    for radix in reversed(list(old_radices.values())):
+        digits.append(rest % radix)
+        rest //= radix
+    recoded = np.zeros(len(signature), dtype=np.int64)
+    for radix, digit in zip(new_radices.values(), reversed(digits)):
+        recoded = recoded * radix + digit
+    return recoded.astype(np.int32)
+
+
+def aggregate(df, dates, group_ids, signature):
+    """Measure sums of df's rows per (month, group, signature), sorted by those"""
+    frame = pd.DataFrame({'month': month_index(dates), 'group': group_ids, 'signature': signature})
+    keys = list(frame.columns)
+    for col in MEASURES:
+        if col in df.columns:
+            frame[col] = df[col].to_numpy()
+    cube = frame.groupby(keys, sort=True).sum().reset_index()
+    return {col: cube[col].to_numpy() for col in cube.columns}
+
+
+def cube_keys(arrays):
+    """The (month, group, signature) of every cube row as one sortable array"""
+    keys = np.empty(len(arrays['month']), dtype=[('month', np.int64), ('group', np.int64), ('signature', np.int64)])
+    for name in keys.dtype.names:
+        keys[name] = arrays[name]
+    return keys
+
+
+class RankingCube:
+    """Measure sums keyed by (month, group, filter signature), sorted by month.
+
+    Rows whose group is unknown (no street name, no coordinates) are kept
+    under group -1 so the cube also yields the total crash count.
+    """
+
+    def __init__(self, arrays, radices, values):
+        self.arrays = arrays
+        self.radices = radices
+        self.values = values
+        self.lookup = {param: {value: code for code, value in enumerate(vals, start=1)} for param, vals in values.items()}
+        # First and last month that has dated crashes
+        month = arrays['month']
+        dated = month[month != NO_MONTH]
+        self.dated_months = (int(dated[0]), int(dated[-1])) if len(dated) else None
+
+    @classmethod
+    def build(cls, df, dates, group_ids):
+        signature, radices, values = filter_signature(df)
+        return cls(aggregate(df, dates, group_ids, signature), radices, values)
+
+    def append(self, df, dates, group_ids, group_map):
+        """A new cube with the crashes in df added to this one's.
+
+        group_map gives the new id of each of this cube's groups (new groups
+        may be numbered in between, but existing ones keep their order) and
+        group_ids the groups of df's rows in the new numbering. Existing cube
+        rows are renumbered and added to, never aggregated again.
+        """
+        signature, radices, values = filter_signature(df, self.values)
+        added = aggregate(df, dates, group_ids, signature)
+        arrays = dict(self.arrays)
+        group = arrays['group']
+        arrays['group'] = np.where(group >= 0, group_map[np.maximum(group, 0)], group).astype(group.dtype)
+        if radices != self.radices:
+            arrays['signature'] = recode(arrays['signature'], self.radices, radices)
+
+        keys, added_keys = cube_keys(arrays), cube_keys(added)
+        at = np.searchsorted(keys, added_keys)
+        found = at < len(keys)
+        found[found] = keys[at[found]] == added_keys[found]
+        for col in arrays:
+            if col in MEASURES:
+                sums = arrays[col].astype(np.result_type(arrays[col], added[col]))
+                sums[at[found]] += added[col][found]
+                arrays[col] = sums
+            arrays[col] = np.insert(arrays[col], at[~found], added[col][~found])
+        return RankingCube(arrays, radices, values)
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        return cls(arrays, meta['radices'], meta['values'])
+
+    def meta(self):
+        return {'version': CUBE_VERSION, 'radices': self.radices, 'values': self.values}
+
+    def allowed(self, damage, crash_type, injuries, cause, lighting):
+        """Boolean table over all signatures: which ones pass the filters"""
+        requested = {'damage': damage, 'crash_type': crash_type, 'lighting': lighting}
+        for param, value in requested.items():
+            if value and param not in self.radices:
+                raise KeyError(CATEGORY_FILTERS[param])
+
+        table = np.ones(1, dtype=bool)
+        for param, radix in self.radices.items():
+            digit = np.ones(radix, dtype=bool)
+            if param in requested and requested[param]:
+                lookup = self.lookup[param]
+                digit[:] = False
+                digit[[lookup[v] for v in requested[param].split(',') if v in lookup]] = True
+            elif param == 'injuries' and injuries:
+                selected = sum(bit for name, bit in INJURY_BITS.items() if name in injuries.split(','))
+                if selected:
+                    digit = (np.arange(radix) & selected) != 0
+            elif param == 'cause' and cause:
+                selected = [code for bucket, code in CAUSE_CODES.items() if bucket in cause.split(',')]
+                if selected:
+                    digit = np.isin(np.arange(radix), selected)
+            table = (table[:, None] & digit[None, :]).ravel()
+        return table
+
+    def month_rows(self, months):
+        """First and past-the-end cube row of an inclusive (first, last) month range, or all rows for None"""
+        month = self.arrays['month']
+        if months is None:
+            return 0, len(month)
+        lo = np.searchsorted(month, months[0], side='left')
+        return int(lo), int(max(lo, np.searchsorted(month, months[1], side='right')))
+
+    def sums(self, n_groups, months, measures, damage, crash_type, injuries, cause, lighting):
+        """Sums of the given measures per group over the cube rows matching the filters.
+
+        months is an inclusive (first, last) month range, or None for every
+        row including undated ones. Each array has n_groups + 1 entries:
+        entry 0 collects the rows without a group, entry g + 1 group g.
+        """
+        lo, hi = self.month_rows(months)
+        keep = self.allowed(damage, crash_type, injuries, cause, lighting)[self.arrays['signature'][lo:hi]]
+        ids = self.arrays['group'][lo:hi][keep] + 1
+        # bincount returns ints for an empty selection, so force floats
+        return {
+            col: np.bincount(ids, weights=self.arrays[col][lo:hi][keep], minlength=n_groups + 1).astype(float)
+            for col in measures
+        }
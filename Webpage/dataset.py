@@ -0,0 +1,588 @@
+"""Shared, read-only crash dataset.
+
+Every request used to start from a full copy of the DataFrame and add its own
+derived columns. A Dataset is built once when the data is loaded and then
+shared by all requests: handlers select row positions and only pull the
+columns they need, so per-request memory follows the filtered result instead
+of the dataset size.
+
+Rows are kept in CRASH_DATE_ONLY order, so a date range is a contiguous
+slice found by binary search before any other filter runs. Rankings are
+answered from per-street and per-cell RankingCubes, with only the partial
+months at the edges of a date range aggregated from raw rows. Map tiles
+and bounding box, radius and nearest hotspot queries look their crashes up
+in a SpatialIndex and filter just those rows.
+
+Like the cubes, the group ids, filter bitmaps and spatial index are cached
+in the snapshot directory and memory-mapped, so API worker processes share
+them instead of each building its own. So are the hourly, daily and monthly
+crash counts (see rollup.py) that time series and per-month rates come from.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from cube import CUBE_VERSION, MEASURES, RankingCube, month_start
+from filters import FilterIndex, parse_date
+from rollup import NAT, ROLLUP_VERSION, Rollups
+from snapshot import decode_text, load_arrays, save_arrays
+from spatial import SpatialIndex, haversine_m, radius_bbox
+from timing import stage
+
+# Size of the lat/lon grid cells used by the location ranking (about 50 m)
+LOCATION_DELTA = 0.00045
+
+# Fewest crashes a street or grid cell needs to appear in the "dangerous"
+# ranking; a single crash with one fatality would otherwise top it
+DANGEROUS_MIN_CRASHES = 5
+
+# Nearest hotspot searches start at this radius at the least and give up
+# beyond the max
+HOTSPOT_START_RADIUS_M = 250
+HOTSPOT_MAX_RADIUS_M = 16000
+
+# Distance from a grid cell's centre to its corners, with some slack
+CELL_HALF_DIAGONAL_M = 50
+
+DAY_NS = 24 * 60 * 60 * 10**9
+
+# Table rows scanned per chunk when filtered rows are streamed
+CHUNK_ROWS = 16384
+
+# Row sets holding more than one row in this many of a date range are
+# filtered through whole bitmaps rather than bit by bit
+FILTER_DENSE_SHARE = 32
+
+# Rankings are summed from a cube only when its rows for the date range are
+# this many times fewer than the table's
+CUBE_MIN_COMPRESSION = 4
+
+# Bump whenever the layout of the cached index (see build_index) changes
+INDEX_VERSION = 2
+
+# Column identifying a crash, used to skip records ingested before
+RECORD_ID = "CRASH_RECORD_ID"
+
+# Where the index, the cubes and the rollups are cached inside the cache directory
+INDEX_DIR = "index"
+CUBE_DIR = "cube-{}"
+ROLLUP_DIR = "rollups"
+
+# Timestamp of each crash, to the minute, and how it is written
+TIME_COLUMN = "CRASH_DATE"
+TIME_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+# Column the rollups are split by, when the data has it
+CONDITION_COLUMN = "WEATHER_CONDITION"
+
+
+def cell_labels(lat_bin, lon_bin):
+    """The old "<lat>_<lon>" string labels of grid cells, which fix their order"""
+    return np.char.add(np.char.add(np.asarray(lat_bin).astype(str), "_"), np.asarray(lon_bin).astype(str))
+
+
+def location_cells(df, delta=LOCATION_DELTA):
+    """Grid cell of every row.
+
+    Each row's LAT_BIN/LON_BIN pair is packed into one int64 key and the
+    distinct keys are numbered, giving a dense cell id per row (-1 for rows
+    without coordinates) plus the LAT_BIN/LON_BIN of every cell. Cells are
+    numbered in the order of their old "<lat>_<lon>" string labels so rankings
+    break ties exactly as they did when grouping on those strings.
+    """
+    lat = df["LATITUDE"].to_numpy(dtype=float)
+    lon = df["LONGITUDE"].to_numpy(dtype=float)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+
+    lat_bin = np.round(lat[valid] / delta).astype(np.int64)
+    lon_bin = np.round(lon[valid] / delta).astype(np.int64)
+    keys = (lat_bin << 32) | (lon_bin & 0xFFFFFFFF)
+    cells, inverse = np.unique(keys, return_inverse=True)
+
+    cell_lat_bin = cells >> 32
+    cell_lon_bin = ((cells & 0xFFFFFFFF) ^ 0x80000000) - 0x80000000
+    order = np.argsort(cell_labels(cell_lat_bin, cell_lon_bin), kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    cell_ids = np.full(len(df), -1, dtype=np.int32)
+    cell_ids[valid] = rank[inverse]
+    return cell_ids, cell_lat_bin[order], cell_lon_bin[order]
+
+
+def build_index(df, text=None):
+    """Street and grid cell ids, filter bitmaps and spatial index of a frame.
+
+    Returned as named arrays plus JSON-able meta, the form they are cached in.
+    When the record ids are among the text columns, their sort order
+    (record_order) is included too.
+    """
+    street_ids, street_names = pd.factorize(df["STREET_NAME"], sort=True)
+    cell_ids, cell_lat_bin, cell_lon_bin = location_cells(df)
+    record_order = np.argsort(text[RECORD_ID], kind="stable") if text and RECORD_ID in text else None
+    return index_arrays(street_ids, street_names, cell_ids, cell_lat_bin, cell_lon_bin, FilterIndex.build(df),
+                        SpatialIndex.build(df["LATITUDE"].to_numpy(), df["LONGITUDE"].to_numpy()), record_order)
+
+
+def index_arrays(street_ids, street_names, cell_ids, cell_lat_bin, cell_lon_bin, filter_index, spatial_index,
+                 record_order=None):
+    """The arrays and meta of a cached index (see build_index)"""
+    filter_arrays, filter_meta = filter_index.arrays()
+    arrays = dict(street_ids=street_ids.astype(np.int32), cell_ids=cell_ids, cell_lat_bin=cell_lat_bin,
+                  cell_lon_bin=cell_lon_bin, **filter_arrays, **spatial_index.arrays())
+    if record_order is not None:
+        arrays["record_order"] = record_order
+    return arrays, {"street_names": list(street_names), "filters": filter_meta}
+
+
+def cached_arrays(index, cubes, checksum, rollups=None):
+    """An index (or None), cubes and rollups (or None) in the form Dataset finds them in a cache directory.
+
+    Maps directory names to the (arrays, meta) to save_arrays() there.
+    """
+    cached = {}
+    if index is not None:
+        arrays, meta = index
+        cached[INDEX_DIR] = (arrays, dict(meta, version=INDEX_VERSION, source=checksum))
+    for group_by, cube in cubes.items():
+        cached[CUBE_DIR.format(group_by)] = (cube.arrays, dict(cube.meta(), source=checksum))
+    if rollups is not None:
+        cached[ROLLUP_DIR] = (rollups.arrays, dict(rollups.meta(), source=checksum))
+    return cached
+
+
+def top_k(values, k):
+    """Positions of the k largest values, largest first.
+
+    Only the candidates found by np.partition are sorted. Equal values keep
+    their position order, including at the cut-off, so results are
+    deterministic however many groups tie.
+    """
+    # NaN ranks last, as with sort_values
+    values = np.where(np.isnan(values), -np.inf, values.astype(float))
+    k = max(0, min(k, len(values)))
+    if k == 0:
+        return np.empty(0, dtype=np.intp)
+    kth = np.partition(values, len(values) - k)[len(values) - k]
+    above = np.flatnonzero(values > kth)
+    ties = np.flatnonzero(values == kth)[:k - len(above)]
+    picked = np.concatenate([above, ties])
+    return picked[np.lexsort((picked, -values[picked]))]
+
+
+def month_of(ts):
+    return (ts.year - 1970) * 12 + ts.month - 1
+
+
+def date_keys(df):
+    """CRASH_DATE_ONLY as int64 nanoseconds; missing dates sort first"""
+    return df["CRASH_DATE_ONLY"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+
+def column_values(df, text, col):
+    """A frame column or decoded text column, None if there is neither"""
+    if col in text:
+        return decode_text(text[col])
+    return df[col] if col in df.columns else None
+
+
+def fixed_width_times(values):
+    """TIME_FORMAT byte strings as int64 nanoseconds, or None unless every value has that layout.
+
+    Reads the digits with numpy, about ten times faster than pd.to_datetime
+    with an AM/PM format.
+    """
+    values = np.asarray(values)
+    if values.dtype != np.dtype("S22") or not len(values):
+        return None
+    chars = np.frombuffer(values.tobytes(), dtype=np.uint8).reshape(len(values), 22)
+    # 0 marks a digit and _ the A or P of AM/PM; everything else must match
+    layout = np.frombuffer(b"00/00/0000 00:00:00 _M", dtype=np.uint8)
+    digits = layout == ord("0")
+    fixed = ~digits & (layout != ord("_"))
+    if (chars[:, fixed] != layout[fixed]).any() or not np.isin(chars[:, 20], [ord("A"), ord("P")]).all():
+        return None
+    if ((chars[:, digits] < ord("0")) | (chars[:, digits] > ord("9"))).any():
+        return None
+
+    def number(lo, hi):
+        return (chars[:, lo:hi].astype(np.int64) - ord("0")) @ (10 ** np.arange(hi - lo - 1, -1, -1))
+
+    try:
+        days = pd.to_datetime(pd.DataFrame({"year": number(6, 10), "month": number(0, 2), "day": number(3, 5)}))
+    except ValueError:
+        return None
+    hours = number(11, 13) % 12 + 12 * (chars[:, 20] == ord("P"))
+    seconds = (hours * 60 + number(14, 16)) * 60 + number(17, 19)
+    return days.to_numpy(dtype="datetime64[ns]").view(np.int64) + seconds * 10**9
+
+
+def crash_times(df, text, dates):
+    """Crash timestamps as int64 nanoseconds: CRASH_DATE where it parses, else the date"""
+    times = fixed_width_times(text[TIME_COLUMN]) if TIME_COLUMN in text else None
+    if times is None:
+        values = column_values(df, text, TIME_COLUMN)
+        if values is None:
+            return dates
+        times = pd.to_datetime(values, format=TIME_FORMAT, errors="coerce").to_numpy(dtype="datetime64[ns]").view(np.int64)
+    return np.where(times == np.iinfo(np.int64).min, dates, times)
+
+
+def build_rollups(df, text, dates):
+    """Rollups of a frame's crashes, split by CONDITION_COLUMN if it has one"""
+    return Rollups.build(crash_times(df, text, dates), column_values(df, text, CONDITION_COLUMN))
+
+
+class Dataset:
+    """The loaded crash table plus everything derived from it at load time.
+
+    Nothing here may be modified after construction; requests only read it.
+    """
+
+    def __init__(self, df, text=None, source=None, cache_dir=None):
+        text = text or {}
+        dates = date_keys(df)
+        if len(dates) and (np.diff(dates) < 0).any():
+            # Snapshots are stored sorted; anything else is sorted once here,
+            # missing dates first
+            order = np.argsort(dates, kind="stable")
+            df = df.iloc[order].reset_index(drop=True)
+            text = {col: values[order] for col, values in text.items()}
+            dates = date_keys(df)
+        self.df = df
+        # Text columns kept out of the frame (see snapshot.py), read with frame()
+        self.text = text
+        self.columns = list(df.columns) + list(text)
+        self.dates = dates
+        # Dates without a time of day make whole days the finest step
+        dated = dates[dates != np.iinfo(np.int64).min]
+        self.date_step = pd.Timedelta(days=1) if (dated % DAY_NS == 0).all() else pd.Timedelta(1)
+        self.measures = [col for col in MEASURES if col in df.columns]
+        self.source = source
+
+        arrays, meta = self.load_index(cache_dir)
+        self.street_ids = arrays["street_ids"]
+        self.street_names = np.asarray(meta["street_names"], dtype=object)
+        self.cell_ids = arrays["cell_ids"]
+        self.cell_lat_bin = arrays["cell_lat_bin"]
+        self.cell_lon_bin = arrays["cell_lon_bin"]
+        # Crashes per cell before any filter, bounding what a filter can leave
+        self.cell_counts = np.bincount(self.cell_ids[self.cell_ids >= 0], minlength=len(self.cell_lat_bin))
+        self.filter_index = FilterIndex.from_arrays(arrays, meta["filters"])
+        self.spatial_index = SpatialIndex.from_arrays(arrays)
+        # Row positions in record id order, when the ids are text columns
+        self.record_order = arrays.get("record_order")
+        self.cubes = {group_by: self.load_cube(group_by, cache_dir) for group_by in ("street", "location")}
+        self.rollups = self.load_rollups(cache_dir)
+
+    def load_index(self, cache_dir):
+        """The cached build_index() arrays if they match this data, else new ones"""
+        checksum = self.source["checksum"] if self.source else None
+        directory = os.path.join(cache_dir, INDEX_DIR) if cache_dir and checksum else None
+        if directory:
+            arrays, meta = load_arrays(directory)
+            if meta and meta.get("version") == INDEX_VERSION and meta.get("source") == checksum:
+                return arrays, meta
+
+        index = build_index(self.df, self.text)
+        if directory:
+            try:
+                save_arrays(directory, *cached_arrays(index, {}, checksum)[INDEX_DIR])
+            except OSError:
+                pass
+        return index
+
+    def frame(self, columns, rows):
+        """A frame of the given columns at the given row positions, text columns included"""
+        data = {}
+        for col in columns:
+            if col in self.text:
+                data[col] = decode_text(self.text[col][rows])
+            else:
+                data[col] = self.df[col].iloc[rows].reset_index(drop=True)
+        return pd.DataFrame(data, columns=columns)
+
+    def group_ids(self, group_by):
+        """Street or grid cell of every row; anything but "street" means cells"""
+        return self.street_ids if group_by == "street" else self.cell_ids
+
+    def group_count(self, group_by):
+        return len(self.street_names) if group_by == "street" else len(self.cell_lat_bin)
+
+    def load_cube(self, group_by, cache_dir):
+        """The cached cube for group_by if it matches this data, else a new one"""
+        checksum = self.source["checksum"] if self.source else None
+        directory = os.path.join(cache_dir, CUBE_DIR.format(group_by)) if cache_dir and checksum else None
+        if directory:
+            arrays, meta = load_arrays(directory)
+            if meta and meta.get("version") == CUBE_VERSION and meta.get("source") == checksum:
+                return RankingCube.from_arrays(arrays, meta)
+
+        cube = RankingCube.build(self.df, self.dates, self.group_ids(group_by))
+        if directory:
+            try:
+                save_arrays(directory, *cached_arrays(None, {group_by: cube}, checksum)[CUBE_DIR.format(group_by)])
+            except OSError:
+                pass
+        return cube
+
+    def load_rollups(self, cache_dir):
+        """The cached rollups if they match this data, else new ones"""
+        checksum = self.source["checksum"] if self.source else None
+        directory = os.path.join(cache_dir, ROLLUP_DIR) if cache_dir and checksum else None
+        if directory:
+            arrays, meta = load_arrays(directory)
+            if meta and meta.get("version") == ROLLUP_VERSION and meta.get("source") == checksum:
+                return Rollups.from_arrays(arrays, meta)
+
+        rollups = build_rollups(self.df, self.text, self.dates)
+        if directory:
+            try:
+                save_arrays(directory, *cached_arrays(None, {}, checksum, rollups)[ROLLUP_DIR])
+            except OSError:
+                pass
+        return rollups
+
+    def date_range(self, date_start, date_end):
+        """First and past-the-end row of the crashes between the two dates.
+
+        Crashes without a date sort first and only belong to the range when
+        neither date is given.
+        """
+        start, stop = 0, len(self.dates)
+        date_start, date_end = parse_date(date_start), parse_date(date_end)
+        if date_start is not None or date_end is not None:
+            start = np.searchsorted(self.dates, NAT, side="right")
+        if date_start is not None:
+            start = np.searchsorted(self.dates, date_start.value, side="left")
+        if date_end is not None:
+            stop = np.searchsorted(self.dates, date_end.value, side="right")
+        return int(start), int(max(start, stop))
+
+    def filter_rows(self, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+        """Positions of the rows passing the dashboard filters, in date order"""
+        start, stop = self.date_range(date_start, date_end)
+        mask = self.filter_index.mask(damage, crash_type, injuries, cause, lighting, start, stop)
+        return np.flatnonzero(mask) + start
+
+    def filter_chunks(self, date_start, date_end, damage, crash_type, injuries, cause, lighting,
+                      start_row=0, stop_row=None, chunk_rows=CHUNK_ROWS):
+        """Positions of the filtered rows in start_row:stop_row, a chunk of the table at a time.
+
+        Only one chunk's mask and positions are held at once, for streaming
+        results too large to select in one go.
+        """
+        start, stop = self.date_range(date_start, date_end)
+        start, stop = max(start, start_row), stop if stop_row is None else min(stop, stop_row)
+        for lo in range(start, stop, chunk_rows):
+            hi = min(lo + chunk_rows, stop)
+            yield np.flatnonzero(self.filter_index.mask(damage, crash_type, injuries, cause, lighting, lo, hi)) + lo
+
+    def passes_filters(self, rows, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+        """Boolean array telling which of the given row positions pass the filters.
+
+        Bits are read per row, unless the rows are dense enough in the date
+        range that combining the whole bitmaps over it costs less.
+        """
+        start, stop = self.date_range(date_start, date_end)
+        rows = np.asarray(rows)
+        keep = (rows >= start) & (rows < stop)
+        if len(rows) * FILTER_DENSE_SHARE < stop - start:
+            return keep & self.filter_index.contains(rows, damage, crash_type, injuries, cause, lighting)
+        mask = self.filter_index.mask(damage, crash_type, injuries, cause, lighting, start, stop)
+        keep[keep] = mask[rows[keep] - start]
+        return keep
+
+    def bbox_rows(self, bbox, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+        """Positions of the filtered rows inside a (south, west, north, east) box, in date order"""
+        rows = self.spatial_index.rows[self.spatial_index.bbox(*bbox)]
+        rows = rows[self.passes_filters(rows, date_start, date_end, damage, crash_type, injuries, cause, lighting)]
+        return np.sort(rows)
+
+    def nearby_rows(self, lat, lon, radius_m, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+        """Positions and distances (m) of the filtered rows within radius_m, nearest first"""
+        positions, distance = self.spatial_index.radius(lat, lon, radius_m)
+        rows = self.spatial_index.rows[positions]
+        keep = self.passes_filters(rows, date_start, date_end, damage, crash_type, injuries, cause, lighting)
+        return rows[keep], distance[keep]
+
+    def nearest_hotspots(self, lat, lon, k, min_crashes, date_start, date_end, damage, crash_type,
+                         injuries, cause, lighting):
+        """The k grid cells closest to a point with at least min_crashes filtered crashes.
+
+        A cell never has more filtered crashes than crashes in total, so only
+        cells with min_crashes crashes before filtering are candidates, and
+        fewer than k cells can qualify inside the k-th nearest candidate. The
+        search radius starts there and doubles, through the spatial index,
+        while fewer than k cells qualify within it and candidates lie beyond
+        it, up to HOTSPOT_MAX_RADIUS_M. Crashes are gathered from a box
+        reaching a little beyond the radius, so every cell whose centre is
+        inside it is counted in full. Once a box holds so many crashes that
+        filtering the whole date range costs less (see passes_filters), the
+        filtered rows are taken from there instead and the search ends.
+        Returns the cells' ids, the distances (m) from the point to their
+        centres, nearest first, and a group_frame() of their totals.
+        """
+        filters = (parse_date(date_start), parse_date(date_end), damage, crash_type, injuries, cause, lighting)
+        start, stop = self.date_range(*filters[:2])
+        min_crashes = max(min_crashes, 1)
+        candidates = np.flatnonzero(self.cell_counts >= min_crashes)
+        reach = haversine_m(lat, lon, self.cell_lat_bin[candidates] * LOCATION_DELTA,
+                            self.cell_lon_bin[candidates] * LOCATION_DELTA)
+        reach = np.sort(reach[reach <= HOTSPOT_MAX_RADIUS_M])
+        farthest = reach[-1] if len(reach) else 0
+        radius = max(HOTSPOT_START_RADIUS_M, reach[k - 1] if len(reach) >= k else farthest)
+        while True:
+            radius = min(radius, HOTSPOT_MAX_RADIUS_M)
+            box = radius_bbox(lat, lon, radius + CELL_HALF_DIAGONAL_M)
+            rows = self.spatial_index.rows[self.spatial_index.bbox(*box)]
+            rows = rows[self.cell_counts[self.cell_ids[rows]] >= min_crashes]
+            if len(rows) * FILTER_DENSE_SHARE < stop - start:
+                rows = rows[self.passes_filters(rows, *filters)]
+            else:
+                rows = self.filter_rows(*filters)
+                cells = self.cell_ids[rows]
+                rows = rows[(cells >= 0) & (self.cell_counts[cells] >= min_crashes)]
+                radius = HOTSPOT_MAX_RADIUS_M
+            cells, counts = np.unique(self.cell_ids[rows], return_counts=True)
+            hot = cells[counts >= min_crashes]
+            distance = haversine_m(lat, lon, self.cell_lat_bin[hot] * LOCATION_DELTA, self.cell_lon_bin[hot] * LOCATION_DELTA)
+            inside = distance <= radius
+            if inside.sum() >= k or radius >= farthest:
+                hot, distance = hot[inside], distance[inside]
+                order = np.lexsort((hot, distance))[:k]
+                hot = hot[order]
+                totals, _ = self.raw_totals("location", rows[np.isin(self.cell_ids[rows], hot)], groups=np.sort(hot))
+                return hot, distance[order], totals.reindex(hot)
+            radius *= 2
+
+    def split_months(self, date_start, date_end, months):
+        """Split a date filter into whole months and partial edges.
+
+        Returns the inclusive month range the cube can answer (None for no
+        date filter at all) and the (start, end) date ranges left over at
+        either side, which are aggregated from raw rows.
+        """
+        if date_start is None and date_end is None:
+            return None, []
+        if months is None:
+            return (0, -1), [(date_start, date_end)]
+
+        first, last = months
+        if date_start is not None:
+            month = month_of(date_start)
+            first = max(first, month if date_start <= month_start(month) else month + 1)
+        if date_end is not None:
+            month = month_of(date_end)
+            last = min(last, month if date_end >= month_start(month + 1) - self.date_step else month - 1)
+        if first > last:
+            return (first, last), [(date_start, date_end)]
+
+        edges = []
+        if date_start is not None and date_start < month_start(first):
+            edges.append((date_start, month_start(first) - pd.Timedelta(1)))
+        if date_end is not None and date_end >= month_start(last + 1):
+            edges.append((month_start(last + 1), date_end))
+        return (first, last), edges
+
+    def raw_sums(self, group_by, rows, measures, groups=None):
+        """Measure sums per group over the given rows, shaped like RankingCube.sums.
+
+        With groups (sorted group ids holding every row), only those groups
+        are summed, in that order.
+        """
+        ids = self.group_ids(group_by)[rows]
+        if groups is None:
+            ids, count = ids + 1, self.group_count(group_by)
+        else:
+            ids, count = np.searchsorted(groups, ids) + 1, len(groups)
+        sums = {}
+        for col in measures:
+            values = np.nan_to_num(self.df[col].to_numpy()[rows].astype(float), nan=0.0)
+            sums[col] = np.bincount(ids, weights=values, minlength=count + 1).astype(float)
+        return sums
+
+    def group_frame(self, group_by, sums, groups=None):
+        """Turn per-group sums into a frame of the groups that have crashes.
+
+        Returns the frame (one row per street or cell, in group order, with
+        "name" for streets and LAT_BIN/LON_BIN for cells) and the number of
+        crashes matched, including those without a street or location.
+        groups gives the group ids the sums are for, when not all of them.
+        """
+        total = int(round(sums["COUNT"].sum()))
+        present = np.flatnonzero(sums["COUNT"][1:] > 0)
+        ids = present if groups is None else groups[present]
+        totals = {}
+        for col, values in sums.items():
+            values = values[1:][present]
+            if np.issubdtype(self.df[col].dtype, np.integer):
+                values = np.rint(values).astype(self.df[col].dtype)
+            totals[col] = values
+        if group_by == "street":
+            totals["name"] = self.street_names[ids]
+        else:
+            totals["LAT_BIN"] = self.cell_lat_bin[ids]
+            totals["LON_BIN"] = self.cell_lon_bin[ids]
+        return pd.DataFrame(totals, index=ids), total
+
+    def ranking_measures(self, measures):
+        """The measures to aggregate; COUNT is always needed"""
+        if measures is None:
+            return self.measures
+        return ["COUNT"] + [col for col in measures if col != "COUNT" and col in self.measures]
+
+    def raw_totals(self, group_by, rows, measures=None, groups=None):
+        """group_frame() aggregated straight from the given rows (of the given groups only)"""
+        sums = self.raw_sums(group_by, rows, self.ranking_measures(measures), groups)
+        return self.group_frame(group_by, sums, groups)
+
+    def group_totals(self, group_by, date_start, date_end, damage, crash_type, injuries, cause, lighting, measures=None):
+        """Ranking measures per street or grid cell for the filtered crashes.
+
+        Summed from the cube (see cube_totals) when its whole months hold
+        CUBE_MIN_COMPRESSION times fewer rows than the table does over the
+        date range, and from the filtered rows otherwise: a cube that barely
+        aggregates the crashes costs more to sum than the rows the filter
+        bitmaps select. Only the given measures (default: all) are summed.
+        """
+        filters = (damage, crash_type, injuries, cause, lighting)
+        date_start, date_end = parse_date(date_start), parse_date(date_end)
+        cube = self.cubes["street" if group_by == "street" else "location"]
+        months, _ = self.split_months(date_start, date_end, cube.dated_months)
+        lo, hi = cube.month_rows(months)
+        start, stop = self.date_range(date_start, date_end)
+        if (hi - lo) * CUBE_MIN_COMPRESSION <= stop - start:
+            return self.cube_totals(group_by, date_start, date_end, *filters, measures=measures)
+
+        with stage("filter") as timer:
+            rows = self.filter_rows(date_start, date_end, *filters)
+            timer.rows = len(rows)
+        with stage("aggregate"):
+            sums = self.raw_sums(group_by, rows, self.ranking_measures(measures))
+        with stage("group") as timer:
+            frame, total = self.group_frame(group_by, sums)
+            timer.rows = len(frame)
+        return frame, total
+
+    def cube_totals(self, group_by, date_start, date_end, damage, crash_type, injuries, cause, lighting, measures=None):
+        """group_totals() with whole months summed from the cube and only the partial ones from rows"""
+        cube = self.cubes["street" if group_by == "street" else "location"]
+        measures = self.ranking_measures(measures)
+        filters = (damage, crash_type, injuries, cause, lighting)
+        months, edges = self.split_months(parse_date(date_start), parse_date(date_end), cube.dated_months)
+
+        with stage("cube"):
+            sums = cube.sums(self.group_count(group_by), months, measures, *filters)
+        # Rows of the partial months at either end of the date range
+        for edge_start, edge_end in edges:
+            with stage("filter") as timer:
+                rows = self.filter_rows(edge_start, edge_end, *filters)
+                timer.rows = len(rows)
+            with stage("aggregate"):
+                for col, values in self.raw_sums(group_by, rows, measures).items():
+                    sums[col] += values
+        with stage("group") as timer:
+            frame, total = self.group_frame(group_by, sums)
+            timer.rows = len(frame)
+        return frame, total
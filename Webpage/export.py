@@ -0,0 +1,113 @@
+"""Streaming export of the filtered crash rows.
+
+/api/export sends every row passing the dashboard filters, not a sample.
+The rows are encoded a chunk at a time as the response is sent, so the
+server holds one chunk of rows at once however many match, and the first
+bytes go out as soon as the first chunk is encoded.
+
+Pages of `limit` rows are chained with a cursor: the row the next page
+starts at, plus the snapshot version it refers to. Rows are kept in date
+order, so a page never repeats or skips rows of the same dataset; once
+ingest.py has added rows the old cursors are refused, and the export has
+to start over.
+
+Arrow IPC streams need pyarrow, which the rest of the API does not.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+class StaleCursor(Exception):
+    """A cursor from an earlier version of the data"""
+
+
+def version(dataset):
+    source = dataset.source
+    return source["checksum"][:16] if source else "csv"
+
+
+def make_cursor(dataset, row):
+    return f"{row}-{version(dataset)}"
+
+
+def read_cursor(dataset, cursor):
+    """Row a cursor points at; ValueError if it is malformed, StaleCursor if outdated"""
+    if not cursor:
+        return 0
+    row, _, cursor_version = cursor.partition("-")
+    if not row.isdigit() or not cursor_version:
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    if cursor_version != version(dataset):
+        raise StaleCursor("The data changed since this cursor was issued; start the export again")
+    return int(row)
+
+
+def page_end(chunks, limit):
+    """First row of the page after `limit` rows, or None when no rows follow them"""
+    seen = 0
+    for rows in chunks:
+        if seen + len(rows) > limit:
+            return int(rows[limit - seen])
+        seen += len(rows)
+    return None
+
+
+def page_frames(dataset, columns, chunks):
+    """A frame of the given columns for each chunk of rows"""
+    for rows in chunks:
+        if len(rows):
+            yield dataset.frame(columns, rows)
+
+
+def ndjson_chunks(frames, dataset, columns):
+    for frame in frames:
+        yield frame.to_json(orient="records", lines=True, date_format="iso").encode()
+
+
+def csv_chunks(frames, dataset, columns):
+    # Every page is a CSV of its own, header included
+    yield pd.DataFrame(columns=columns).to_csv(index=False).encode()
+    for frame in frames:
+        yield frame.to_csv(index=False, header=False).encode()
+
+
+def arrow_schema(dataset, columns):
+    """Schema of the exported columns, the same for every chunk"""
+    schema = pa.Schema.from_pandas(dataset.frame(columns, np.arange(0)), preserve_index=False)
+    for col in columns:
+        if col in dataset.text:
+            schema = schema.set(schema.get_field_index(col), pa.field(col, pa.string()))
+    return schema
+
+
+def arrow_chunks(frames, dataset, columns):
+    schema = arrow_schema(dataset, columns)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for frame in frames:
+            writer.write_batch(pa.RecordBatch.from_pandas(frame, schema=schema, preserve_index=False))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+ENCODERS = {"ndjson": ndjson_chunks, "csv": csv_chunks, "arrow": arrow_chunks}
+
+
+def export_chunks(dataset, columns, chunks, format):
+    """The encoded body of one export page, chunk by chunk"""
+    return ENCODERS[format](page_frames(dataset, columns, chunks), dataset, columns)
@@ -0,0 +1,279 @@
+"""Row filters shared by the API endpoints.
+
+filter_mask() evaluates the dashboard's filter parameters by scanning the
+columns. FilterIndex answers the categorical and injury filters from bitmaps
+built once at load time, so a request only ORs and ANDs a few packed arrays
+instead of rescanning string columns; it selects exactly the rows
+filter_mask() does.
+"""
+import numpy as np
+import pandas as pd
+
+# Cause categories from st_ranking2.py
+USER_ERROR = ['DRIVING SKILLS/KNOWLEDGE/EXPERIENCE', 'FAILING TO REDUCE SPEED TO AVOID CRASH', 
+    'IMPROPER OVERTAKING/PASSING', 'FOLLOWING TOO CLOSELY', 'DISTRACTION - FROM OUTSIDE VEHICLE',
+    'FAILING TO YIELD RIGHT-OF-WAY', 'DISREGARDING STOP SIGN', 'IMPROPER LANE USAGE',
+    'IMPROPER TURNING/NO SIGNAL', 'OPERATING VEHICLE IN ERRATIC, RECKLESS, CARELESS, NEGLIGENT OR AGGRESSIVE MANNER',
+    'IMPROPER BACKING', 'DISTRACTION - FROM INSIDE VEHICLE', 'DRIVING ON WRONG SIDE/WRONG WAY',
+    'DISREGARDING TRAFFIC SIGNALS', 'CELL PHONE USE OTHER THAN TEXTING', 'PHYSICAL CONDITION OF DRIVER',
+    'DISREGARDING OTHER TRAFFIC SIGNS', 'RELATED TO BUS STOP', 'DISREGARDING ROAD MARKINGS',
+    'TURNING RIGHT ON RED', 'UNDER THE INFLUENCE OF ALCOHOL/DRUGS (USE WHEN ARREST IS EFFECTED)',
+    'HAD BEEN DRINKING (USE WHEN ARREST IS NOT MADE)', 'TEXTING', 'OBSTRUCTED CROSSWALKS',
+    'DISTRACTION - OTHER ELECTRONIC DEVICE (NAVIGATION DEVICE, DVD PLAYER, ETC.)',
+    'PASSING STOPPED SCHOOL BUS', 'DISREGARDING YIELD SIGN', 'BICYCLE ADVANCING LEGALLY ON RED LIGHT',
+    'MOTORCYCLE ADVANCING LEGALLY ON RED LIGHT', 'EXCEEDING AUTHORIZED SPEED LIMIT',
+    'EXCEEDING SAFE SPEED FOR CONDITIONS']
+
+NON_USER_ERROR = ['ANIMAL', 'ROAD ENGINEERING/SURFACE/MARKING DEFECTS',
+    'VISION OBSCURED (SIGNS, TREE LIMBS, BUILDINGS, ETC.)',
+    'EVASIVE ACTION DUE TO ANIMAL, OBJECT, NONMOTORIST', 'WEATHER', 'ROAD CONSTRUCTION/MAINTENANCE']
+
+VEHICLE_ERROR = ['EQUIPMENT - VEHICLE CONDITION']
+
+CAUSE_BUCKETS = {
+    'user': USER_ERROR,
+    'non_user': NON_USER_ERROR,
+    'vehicle': VEHICLE_ERROR,
+}
+
+# Dashboard parameter -> column it is matched against
+CATEGORY_FILTERS = {
+    'damage': 'DAMAGE',
+    'crash_type': 'CRASH_TYPE',
+    'lighting': 'LIGHTING_CONDITION',
+}
+
+
+def parse_date(value):
+    """Parse a date_start/date_end parameter; None when it is not given.
+
+    Raises ValueError for anything that is not a plain (timezone-naive) date.
+    """
+    if value is None or isinstance(value, pd.Timestamp):
+        return value
+    if not value:
+        return None
+    parsed = pd.to_datetime(value)
+    if parsed is pd.NaT:
+        raise ValueError(f"Invalid date: {value!r}")
+    if parsed.tzinfo is not None:
+        raise ValueError(f"Dates must not carry a timezone: {value!r}")
+    return parsed
+
+
+def cause_column(df):
+    """Name of the primary cause column, which differs between exports"""
+    for col in ['PRIM_CONTRIBUTORY_CAUSE', 'PRIMARY_CONTRIBUTORY_CAUSE', 'PRIMARY_CAUSE']:
+        if col in df.columns:
+            return col
+    return None
+
+
+def filter_mask(df, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+    """Boolean array marking the rows of df that pass all filters"""
+    mask = np.ones(len(df), dtype=bool)
+
+    # Apply date filter
+    if date_start:
+        start_dt = pd.to_datetime(date_start)
+        mask &= (df["CRASH_DATE_ONLY"] >= start_dt).to_numpy()
+    if date_end:
+        end_dt = pd.to_datetime(date_end)
+        mask &= (df["CRASH_DATE_ONLY"] <= end_dt).to_numpy()
+    
+    # Apply damage filter
+    if damage:
+        damage_list = damage.split(',')
+        mask &= df["DAMAGE"].isin(damage_list).to_numpy()
+    
+    # Apply crash type filter
+    if crash_type:
+        crash_list = crash_type.split(',')
+        mask &= df["CRASH_TYPE"].isin(crash_list).to_numpy()
+    
+    # Apply injury filter
+    if injuries:
+        injury_list = injuries.split(',')
+        injury_conditions = []
+        if 'none' in injury_list:
+            injury_conditions.append(df["INJURY_SCORE"] == 0)
+        if 'non_incapacitating' in injury_list:
+            injury_conditions.append(df["INJURIES_NON_INCAPACITATING"] > 0)
+        if 'incapacitating' in injury_list:
+            injury_conditions.append(df["INJURIES_INCAPACITATING"] > 0)
+        if 'fatal' in injury_list:
+            injury_conditions.append(df["INJURIES_FATAL"] > 0)
+        
+        if injury_conditions:
+            combined = injury_conditions[0]
+            for cond in injury_conditions[1:]:
+                combined = combined | cond
+            mask &= combined.to_numpy()
+    
+    # Apply cause filter
+    if cause:
+        cause_list = cause.split(',')
+        cause_values = []
+        if 'user' in cause_list:
+            cause_values.extend(USER_ERROR)
+        if 'non_user' in cause_list:
+            cause_values.extend(NON_USER_ERROR)
+        if 'vehicle' in cause_list:
+            cause_values.extend(VEHICLE_ERROR)
+        
+        if cause_values:
+            cause_col = cause_column(df)
+            if cause_col:
+                mask &= df[cause_col].isin(cause_values).to_numpy()
+    
+    # Apply lighting filter
+    if lighting:
+        lighting_list = lighting.split(',')
+        mask &= df["LIGHTING_CONDITION"].isin(lighting_list).to_numpy()
+    
+    return mask
+
+
+def apply_filters(df, date_start, date_end, damage, crash_type, injuries, cause, lighting):
+    """Apply all filters to dataframe"""
+    return df[filter_mask(df, date_start, date_end, damage, crash_type, injuries, cause, lighting)]
+
+
+def injury_classes(df):
+    """Boolean Series for each value of the injuries filter"""
+    return {
+        'none': df["INJURY_SCORE"] == 0,
+        'non_incapacitating': df["INJURIES_NON_INCAPACITATING"] > 0,
+        'incapacitating': df["INJURIES_INCAPACITATING"] > 0,
+        'fatal': df["INJURIES_FATAL"] > 0,
+    }
+
+
+def pack(mask):
+    return np.packbits(np.asarray(mask, dtype=bool))
+
+
+def value_bitmaps(values):
+    """Packed bitmap of the rows holding each distinct value of a column"""
+    codes, uniques = pd.factorize(values)
+    return {value: pack(codes == i) for i, value in enumerate(uniques)}
+
+
+class FilterIndex:
+    """Bitmaps for every filterable value of a DataFrame.
+
+    Each categorical value, cause bucket and injury class gets one packed
+    bitmap (a bit per row). A filter parameter selects the OR of its values'
+    bitmaps and the parameters are ANDed, mirroring filter_mask().
+    """
+
+    def __init__(self, size, categories, causes, injuries):
+        self.size = size
+        self.categories = categories
+        self.causes = causes
+        self.injuries = injuries
+
+    @classmethod
+    def build(cls, df):
+        categories = {
+            param: value_bitmaps(df[col])
+            for param, col in CATEGORY_FILTERS.items()
+            if col in df.columns
+        }
+
+        injuries = {name: pack(cond) for name, cond in injury_classes(df).items()}
+        index = cls(len(df), categories, None, injuries)
+
+        cause_col = cause_column(df)
+        if cause_col:
+            by_value = value_bitmaps(df[cause_col])
+            index.causes = {
+                bucket: index.union(by_value.get(value) for value in values)
+                for bucket, values in CAUSE_BUCKETS.items()
+            }
+        return index
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        """Rebuild an index from what arrays() returned"""
+        groups = {'categories': {}, 'causes': {}, 'injuries': {}}
+        for i, (group, param, value) in enumerate(meta['bitmaps']):
+            bitmaps = groups[group].setdefault(param, {}) if group == 'categories' else groups[group]
+            bitmaps[value] = arrays[f'filter{i}']
+        return cls(meta['size'], groups['categories'], groups['causes'] or None, groups['injuries'])
+
+    def arrays(self):
+        """The bitmaps as named arrays, plus the meta from_arrays() needs"""
+        entries = [('categories', param, bitmaps) for param, bitmaps in self.categories.items()]
+        entries += [('causes', None, self.causes or {}), ('injuries', None, self.injuries)]
+        arrays, keys = {}, []
+        for group, param, bitmaps in entries:
+            for value, bitmap in bitmaps.items():
+                arrays[f'filter{len(keys)}'] = bitmap
+                keys.append([group, param, value])
+        return arrays, {'size': self.size, 'bitmaps': keys}
+
+    def union(self, bitmaps, lo=0, hi=None):
+        """OR of the given packed bitmaps over bytes lo:hi"""
+        hi = (self.size + 7) // 8 if hi is None else hi
+        result = np.zeros(hi - lo, dtype=np.uint8)
+        for bitmap in bitmaps:
+            if bitmap is not None:
+                result |= bitmap[lo:hi]
+        return result
+
+    def selected(self, damage, crash_type, injuries, cause, lighting):
+        """For every active filter parameter, the bitmaps of the values it accepts"""
+        selected = []
+        for param, value in (('damage', damage), ('crash_type', crash_type), ('lighting', lighting)):
+            if value:
+                bitmaps = self.categories[param]
+                selected.append([bitmaps.get(v) for v in value.split(',')])
+
+        if injuries:
+            injury_list = injuries.split(',')
+            classes = [self.injuries[name] for name in self.injuries if name in injury_list]
+            if classes:
+                selected.append(classes)
+
+        if cause and self.causes is not None:
+            cause_list = cause.split(',')
+            buckets = [self.causes[name] for name in self.causes if name in cause_list]
+            if buckets:
+                selected.append(buckets)
+        return selected
+
+    def mask(self, damage, crash_type, injuries, cause, lighting, start=0, stop=None):
+        """Boolean array over rows start:stop passing the non-date filters.
+
+        Only the bytes covering start:stop are combined, so a narrow date
+        range costs a fraction of the full bitmaps.
+        """
+        stop = self.size if stop is None else stop
+        lo, hi = start // 8, (stop + 7) // 8
+        selected = [self.union(bitmaps, lo, hi) for bitmaps in self.selected(damage, crash_type, injuries, cause, lighting)]
+
+        if not selected:
+            return np.ones(stop - start, dtype=bool)
+        combined = selected[0]
+        for bitmap in selected[1:]:
+            combined &= bitmap
+        bits = np.unpackbits(combined, count=stop - lo * 8)
+        return bits[start - lo * 8:].view(bool)
+
+    def contains(self, rows, damage, crash_type, injuries, cause, lighting):
+        """Boolean array telling which of the given rows pass the non-date filters.
+
+        Reads single bits out of the bitmaps, for row sets that are scattered
+        over the table (such as the crashes on one map tile).
+        """
+        rows = np.asarray(rows)
+        byte, shift = rows >> 3, 7 - (rows & 7)
+        keep = np.ones(len(rows), dtype=bool)
+        for bitmaps in self.selected(damage, crash_type, injuries, cause, lighting):
+            passes = np.zeros(len(rows), dtype=bool)
+            for bitmap in bitmaps:
+                if bitmap is not None:
+                    passes |= ((bitmap[byte] >> shift) & 1).astype(bool)
+            keep &= passes
+        return keep
@@ -0,0 +1,150 @@
+"""Heatmap points for the crash map.
+
+Folium embeds every heat point in the page, so the map used to show a
+10,000 crash sample. heat_grid() instead bins all crashes into cells a few
+screen pixels wide at the zoom level being viewed and sends one weighted
+point per cell: the page size then depends on the map area, not on how many
+crashes match, and nothing is sampled away. When the crashes occupy more
+than GRID_MAX_CELLS cells (a deep zoom without a viewport box around them)
+they are binned at a coarser zoom instead, so it never exceeds that.
+
+The same points are served without any Folium HTML by /api/heatmap, as JSON
+or as a packed float32 buffer (pack_points) for the dashboard's own Leaflet
+heat layer.
+"""
+import numpy as np
+
+# Web Mercator tiles are 256 pixels wide at zoom 0
+TILE_SIZE = 256
+
+MAX_LATITUDE = 85.05112878
+
+# Cells per side of a map tile served by tile_features(), 8 pixels each
+TILE_CELLS = 32
+
+# Grid cell size in screen pixels. Leaflet.heat itself merges points into
+# cells of half its radius plus blur (13 px for the map's settings), so
+# binning finer than that does not show on the map
+GRID_CELL_PX = 6
+# Most cells a heat grid sends, about a dozen full-screen viewports' worth
+GRID_MAX_CELLS = 2 ** 16
+
+
+def heat_points(lat, lon, weights=None):
+    """[lat, lon] pairs (or [lat, lon, weight] triples) for a heat layer.
+
+    Built straight from the coordinate arrays in one step rather than row by
+    row. Points without coordinates are dropped; missing weights count as 0.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    columns = [lat[valid], lon[valid]]
+    if weights is not None:
+        columns.append(np.nan_to_num(np.asarray(weights, dtype=float)[valid], nan=0.0))
+    return np.column_stack(columns).tolist()
+
+
+def mercator_pixels(lat, lon, zoom):
+    """Global Web Mercator pixel coordinates of points at a zoom level"""
+    scale = TILE_SIZE * 2.0 ** zoom
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0 * scale
+    # Web Mercator stops at about 85 degrees north and south
+    sin_lat = np.sin(np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE)))
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * scale
+    return x, y
+
+
+def mercator_latlon(x, y, zoom):
+    """Inverse of mercator_pixels: latitude and longitude of global pixels"""
+    scale = TILE_SIZE * 2.0 ** zoom
+    lon = np.asarray(x, dtype=float) / scale * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=float) / scale))))
+    return lat, lon
+
+
+def grid_cells(lat, lon, weights=None, zoom=11, cell_px=GRID_CELL_PX, max_cells=GRID_MAX_CELLS):
+    """Bin crashes on a screen-space grid.
+
+    Returns the mean position of the crashes in every cell and their number
+    (or the sum of their weights). Cells whose weights sum to 0 are left out.
+    While more than max_cells cells are occupied, the grid is coarsened one
+    zoom level at a time by merging each 2x2 block of cells.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    weights = np.ones(len(lat)) if weights is None else np.nan_to_num(np.asarray(weights, dtype=float), nan=0.0)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    lat, lon, weights = lat[valid], lon[valid], weights[valid]
+
+    x, y = mercator_pixels(lat, lon, zoom)
+    columns = int(TILE_SIZE * 2 ** zoom // cell_px) + 1
+    cells = (y // cell_px).astype(np.int64) * columns + (x // cell_px).astype(np.int64)
+    occupied, inverse = np.unique(cells, return_inverse=True)
+    while len(occupied) > max_cells and zoom > 0:
+        # A cell at one zoom level out is the 2x2 block of cells it covers here
+        row, column = occupied // columns, occupied % columns
+        zoom -= 1
+        columns = int(TILE_SIZE * 2 ** zoom // cell_px) + 1
+        occupied, merged = np.unique(row // 2 * columns + column // 2, return_inverse=True)
+        inverse = merged[inverse]
+
+    counts = np.bincount(inverse)
+    totals = np.bincount(inverse, weights=weights)
+    keep = totals > 0
+    cell_lat = np.bincount(inverse, weights=lat)[keep] / counts[keep]
+    cell_lon = np.bincount(inverse, weights=lon)[keep] / counts[keep]
+    return cell_lat, cell_lon, totals[keep]
+
+
+def heat_grid(lat, lon, weights=None, zoom=11, cell_px=GRID_CELL_PX, max_cells=GRID_MAX_CELLS):
+    """Heat points of all crashes pre-binned on a screen-space grid, one per cell"""
+    return heat_points(*grid_cells(lat, lon, weights, zoom, cell_px, max_cells))
+
+
+def pack_points(lat, lon, weights):
+    """Points as little-endian float32 (lat, lon, weight) triples.
+
+    12 bytes per point, read in the browser with a Float32Array. float32
+    keeps coordinates to well under a metre around Chicago.
+    """
+    return np.column_stack([lat, lon, weights]).astype("<f4").tobytes()
+
+
+def tile_features(z, x, y, px, py, weights=None):
+    """GeoJSON FeatureCollection of the crash density on map tile (z, x, y).
+
+    px, py are the global pixel coordinates at zoom z of the crashes on the
+    tile. They are counted on a TILE_CELLS x TILE_CELLS grid and every
+    occupied cell becomes a polygon with its crash count (and the sum of the
+    weights, when given), so a tile never holds more than TILE_CELLS**2
+    features however many crashes it covers.
+    """
+    cell_px = TILE_SIZE // TILE_CELLS
+    col = np.clip((np.asarray(px) - x * TILE_SIZE) // cell_px, 0, TILE_CELLS - 1).astype(np.int64)
+    row = np.clip((np.asarray(py) - y * TILE_SIZE) // cell_px, 0, TILE_CELLS - 1).astype(np.int64)
+    cells = row * TILE_CELLS + col
+    counts = np.bincount(cells, minlength=TILE_CELLS ** 2)
+    totals = None
+    if weights is not None:
+        weights = np.nan_to_num(np.asarray(weights, dtype=float), nan=0.0)
+        totals = np.bincount(cells, weights=weights, minlength=TILE_CELLS ** 2)
+
+    occupied = np.flatnonzero(counts)
+    left = x * TILE_SIZE + (occupied % TILE_CELLS) * cell_px
+    top = y * TILE_SIZE + (occupied // TILE_CELLS) * cell_px
+    north, west = mercator_latlon(left, top, z)
+    south, east = mercator_latlon(left + cell_px, top + cell_px, z)
+
+    features = []
+    for i, cell in enumerate(occupied):
+        w, e, n, s = round(west[i], 6), round(east[i], 6), round(north[i], 6), round(south[i], 6)
+        properties = {"crashes": int(counts[cell])}
+        if totals is not None:
+            properties["weight"] = float(totals[cell])
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[w, s], [e, s], [e, n], [w, n], [w, s]]]},
+            "properties": properties,
+        })
+    return {"type": "FeatureCollection", "features": features}
@@ -0,0 +1,354 @@
+"""Incremental ingestion of new crash records.
+
+The crash feed grows every day, and rebuilding the snapshot means parsing,
+sorting and aggregating the whole history again. This job adds just the new
+rows to an existing snapshot:
+
+- the delta CSVs are parsed on their own, and rows whose CRASH_RECORD_ID is
+  already in the data (or earlier in the delta) are dropped;
+- the new rows are appended to the source CSV, which stays the source of
+  truth: a full rebuild from it gives the same data;
+- they are merged into the date-ordered columns, and the street and grid
+  cell ids, filter bitmaps, spatial index, record id order, ranking cubes
+  and time rollups are updated from the new rows alone. Existing entries are only renumbered
+  and moved, never parsed, sorted or aggregated again;
+- the result is written as the next snapshot, which replaces the old one in
+  a rename. Running API workers notice it and swap it in for new requests
+  while in-flight ones finish on the old one.
+
+Merging still copies every column once, but that is a memory copy, not the
+parse, sort and group-by a rebuild costs.
+
+    python ingest.py DELTA.csv [DELTA.csv ...] [--csv PATH] [--snapshot DIR]
+    python ingest.py --watch DIR [--interval S] [--csv PATH] [--snapshot DIR]
+
+Watched directories are polled for *.csv files, which are moved into a
+done/ subdirectory once ingested, or into failed/ if they could not be.
+"""
+import argparse
+import glob
+import hashlib
+import io
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from dataset import (CONDITION_COLUMN, RECORD_ID, Dataset, cached_arrays, cell_labels, column_values, crash_times,
+                     date_keys, index_arrays, location_cells)
+from filters import FilterIndex, pack
+from snapshot import DATA_PATH, SNAPSHOT_DIR, encode_text, load_dataframe, type_frame, write_snapshot
+from spatial import SpatialIndex
+
+logger = logging.getLogger("crash_ingest")
+
+
+def read_delta(paths, header):
+    """The rows of the delta CSVs as raw strings, in the source CSV's column order"""
+    frames = [pd.read_csv(path, dtype=str, keep_default_na=False) for path in paths]
+    return pd.concat(frames, ignore_index=True).reindex(columns=header, fill_value="")
+
+
+def new_records(raw, dataset):
+    """The raw rows whose record id is not in the dataset nor earlier in raw.
+
+    Known ids are looked up by binary search through the dataset's record
+    order. Rows without an id are always kept.
+    """
+    if RECORD_ID not in raw.columns:
+        return raw
+    ids = raw[RECORD_ID]
+    keep = (~ids.duplicated() | (ids == "")).to_numpy()
+    known = dataset.text.get(RECORD_ID)
+    if known is not None and dataset.record_order is not None and len(known):
+        encoded = np.array([value.encode("utf-8") for value in ids], dtype=bytes)
+        at = np.searchsorted(known, encoded, sorter=dataset.record_order)
+        at = dataset.record_order[np.minimum(at, len(known) - 1)]
+        keep &= (known[at] != encoded) | (encoded == b"")
+    elif RECORD_ID in dataset.df.columns:
+        keep &= ~ids.isin(dataset.df[RECORD_ID].cat.categories).to_numpy()
+    return raw[keep]
+
+
+def conform(delta, dataset):
+    """The typed delta rows with every column typed like the dataset's.
+
+    Returns the frame and the text columns encoded as bytes.
+    """
+    columns = {}
+    for col in dataset.columns:
+        values = delta[col] if col in delta.columns else pd.Series(np.nan, index=delta.index)
+        if col in dataset.text or isinstance(dataset.df[col].dtype, pd.CategoricalDtype):
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.where(values.isna(), values.astype(str)).astype("category")
+        elif pd.api.types.is_datetime64_any_dtype(dataset.df[col].dtype):
+            values = pd.to_datetime(values)
+        else:
+            values = pd.to_numeric(values)
+        columns[col] = values
+    text = {col: encode_text(columns.pop(col)) for col in dataset.text}
+    return pd.DataFrame(columns), text
+
+
+def merge_mask(keys, added_keys):
+    """Where sorted added_keys land among sorted keys: a mask over the merged rows.
+
+    Added rows go after existing rows with equal keys, where a stable sort
+    of the existing rows followed by the added ones puts them.
+    """
+    at = np.searchsorted(keys, added_keys, side="right") + np.arange(len(added_keys))
+    added = np.zeros(len(keys) + len(added_keys), dtype=bool)
+    added[at] = True
+    return added
+
+
+def merge(values, added_values, added):
+    """Interleave two arrays where the added mask says"""
+    merged = np.empty(len(added), dtype=np.result_type(values, added_values))
+    merged[~added] = values
+    merged[added] = added_values
+    return merged
+
+
+def merge_groups(keys, added_keys):
+    """Sorted union of two sets of group keys.
+
+    Returns the position in keys + added_keys of every merged group, then
+    the merged id of every group in keys and of every group in added_keys.
+    """
+    _, first, inverse = np.unique(np.concatenate([keys, added_keys]), return_index=True, return_inverse=True)
+    return first, inverse[:len(keys)], inverse[len(keys):]
+
+
+def renumber(ids, new_ids):
+    """Group ids mapped through new_ids, -1 (no group) staying -1"""
+    return np.where(ids >= 0, new_ids[np.maximum(ids, 0)], -1).astype(np.int32)
+
+
+def sort_keys(**fields):
+    """Arrays zipped into one array sorting by the fields in order"""
+    first = next(iter(fields.values()))
+    keys = np.empty(len(first), dtype=[(name, np.asarray(values).dtype) for name, values in fields.items()])
+    for name, values in fields.items():
+        keys[name] = values
+    return keys
+
+
+def category_codes(values, categories):
+    """Codes of a categorical column against a superset of its categories"""
+    lookup = np.append(categories.get_indexer(values.cat.categories), -1)
+    return lookup[values.cat.codes.to_numpy()]
+
+
+def merge_bitmaps(bitmaps, added_bitmaps, size, added_size, added):
+    """Packed bitmaps of the merged rows, for every key of either side"""
+    def bits(bitmap, count):
+        return np.zeros(count, dtype=np.uint8) if bitmap is None else np.unpackbits(bitmap, count=count)
+    keys = list(bitmaps) + [key for key in added_bitmaps if key not in bitmaps]
+    return {key: pack(merge(bits(bitmaps.get(key), size), bits(added_bitmaps.get(key), added_size), added))
+            for key in keys}
+
+
+def append_rows(dataset, delta, text):
+    """The dataset with the conformed delta rows merged in.
+
+    Returns the merged frame, text columns, index (as index_arrays()), cubes
+    and rollups.
+    """
+    dates, added_dates = dataset.dates, date_keys(delta)
+    added = merge_mask(dates, added_dates)
+    positions, added_positions = np.flatnonzero(~added), np.flatnonzero(added)
+
+    columns = {}
+    for col in dataset.df.columns:
+        values, added_values = dataset.df[col], delta[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories.union(added_values.cat.categories)
+            codes = merge(category_codes(values, categories), category_codes(added_values, categories), added)
+            columns[col] = pd.Categorical.from_codes(codes, categories=categories)
+        else:
+            columns[col] = merge(values.to_numpy(), added_values.to_numpy(), added)
+    df = pd.DataFrame(columns)
+    merged_text = {col: merge(values, text[col], added) for col, values in dataset.text.items()}
+
+    # Streets and cells are numbered in name / label order, so new ones can
+    # fall in between: renumber the existing ones, then merge
+    added_streets, names = pd.factorize(delta["STREET_NAME"])
+    first, street_map, added_street_map = merge_groups(dataset.street_names, np.asarray(names, dtype=object))
+    street_names = np.concatenate([dataset.street_names, np.asarray(names, dtype=object)])[first]
+    street_ids = merge(renumber(dataset.street_ids, street_map), renumber(added_streets, added_street_map), added)
+
+    added_cells, lat_bin, lon_bin = location_cells(delta)
+    first, cell_map, added_cell_map = merge_groups(cell_labels(dataset.cell_lat_bin, dataset.cell_lon_bin),
+                                                   cell_labels(lat_bin, lon_bin))
+    cell_lat_bin = np.concatenate([dataset.cell_lat_bin, lat_bin])[first]
+    cell_lon_bin = np.concatenate([dataset.cell_lon_bin, lon_bin])[first]
+    cell_ids = merge(renumber(dataset.cell_ids, cell_map), renumber(added_cells, added_cell_map), added)
+
+    index, added_index = dataset.filter_index, FilterIndex.build(delta)
+    size, added_size = index.size, added_index.size
+    categories = {
+        param: merge_bitmaps(index.categories.get(param, {}), added_index.categories.get(param, {}),
+                             size, added_size, added)
+        for param in list(index.categories) + [p for p in added_index.categories if p not in index.categories]
+    }
+    causes = None
+    if index.causes is not None or added_index.causes is not None:
+        causes = merge_bitmaps(index.causes or {}, added_index.causes or {}, size, added_size, added)
+    injuries = merge_bitmaps(index.injuries, added_index.injuries, size, added_size, added)
+    filter_index = FilterIndex(len(added), categories, causes, injuries)
+
+    # The spatial index is sorted by tile code, then row
+    spatial = dataset.spatial_index
+    added_spatial = SpatialIndex.build(delta["LATITUDE"].to_numpy(), delta["LONGITUDE"].to_numpy())
+    rows, added_rows = positions[spatial.rows], added_positions[added_spatial.rows]
+    in_tiles = merge_mask(sort_keys(code=spatial.codes, row=rows), sort_keys(code=added_spatial.codes, row=added_rows))
+    spatial_index = SpatialIndex(*(
+        merge(a, b, in_tiles) for a, b in (
+            (rows, added_rows), (spatial.codes, added_spatial.codes), (spatial.x, added_spatial.x),
+            (spatial.y, added_spatial.y), (spatial.lat, added_spatial.lat), (spatial.lon, added_spatial.lon),
+        )
+    ))
+
+    # Record ids are ordered by id, then row
+    record_order = None
+    if dataset.record_order is not None and RECORD_ID in text:
+        ids, added_ids = dataset.text[RECORD_ID], text[RECORD_ID]
+        width = np.result_type(ids, added_ids)
+        added_order = np.argsort(added_ids, kind="stable")
+        order_rows, added_order_rows = positions[dataset.record_order], added_positions[added_order]
+        by_id = merge_mask(sort_keys(id=ids[dataset.record_order].astype(width), row=order_rows),
+                           sort_keys(id=added_ids[added_order].astype(width), row=added_order_rows))
+        record_order = merge(order_rows, added_order_rows, by_id)
+
+    index = index_arrays(street_ids, street_names, cell_ids, cell_lat_bin, cell_lon_bin, filter_index,
+                         spatial_index, record_order)
+    cubes = {
+        "street": dataset.cubes["street"].append(delta, added_dates, renumber(added_streets, added_street_map),
+                                                 street_map),
+        "location": dataset.cubes["location"].append(delta, added_dates, renumber(added_cells, added_cell_map),
+                                                     cell_map),
+    }
+    rollups = dataset.rollups.append(crash_times(delta, text, added_dates), column_values(delta, text, CONDITION_COLUMN))
+    return df, merged_text, index, cubes, rollups
+
+
+def line_ending(csv_path):
+    """The line ending the CSV's header uses"""
+    with open(csv_path, "rb") as f:
+        return "\r\n" if f.readline().endswith(b"\r\n") else "\n"
+
+
+def append_csv(csv_path, rows):
+    """Append CSV text (without a header) to the source CSV"""
+    with open(csv_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        ends_with_newline = f.tell() == 0
+        if not ends_with_newline:
+            f.seek(-1, os.SEEK_END)
+            ends_with_newline = f.read(1) == b"\n"
+    with open(csv_path, "a", newline="") as f:
+        if not ends_with_newline:
+            f.write(line_ending(csv_path))
+        f.write(rows)
+
+
+def ingest(paths, csv_path=DATA_PATH, snapshot_dir=SNAPSHOT_DIR):
+    """Add the new records in the delta CSVs to the source CSV and its snapshot.
+
+    Returns the number of rows added.
+    """
+    df, text, source = load_dataframe(csv_path, snapshot_dir)
+    dataset = Dataset(df, text=text, source=source, cache_dir=snapshot_dir)
+    header = list(pd.read_csv(csv_path, nrows=0).columns)
+    raw = new_records(read_delta(paths, header), dataset)
+    if raw.empty:
+        return 0
+
+    # Parse the new rows exactly as a rebuild would read them from the CSV
+    ending = line_ending(csv_path)
+    csv_text = raw.to_csv(index=False, lineterminator=ending)
+    rows = csv_text.split(ending, 1)[1]
+    delta, delta_text = conform(type_frame(pd.read_csv(io.StringIO(csv_text), low_memory=False)), dataset)
+    df, text, index, cubes, rollups = append_rows(dataset, delta, delta_text)
+
+    append_csv(csv_path, rows)
+    # Hashing the grown CSV would read the whole history again, so the new
+    # version is identified by chaining the old checksum with the rows added
+    stat = os.stat(csv_path)
+    checksum = hashlib.sha256((source["checksum"] + hashlib.sha256(rows.encode()).hexdigest()).encode()).hexdigest()
+    source = {"checksum": checksum, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    write_snapshot(df, snapshot_dir, source, text=text, derived=cached_arrays(index, cubes, checksum, rollups))
+    return len(raw)
+
+
+def move_to(directory, paths):
+    os.makedirs(directory, exist_ok=True)
+    for path in paths:
+        shutil.move(path, os.path.join(directory, os.path.basename(path)))
+
+
+def ingest_batch(paths, directory, csv_path=DATA_PATH, snapshot_dir=SNAPSHOT_DIR):
+    """Ingest paths together, falling back to one at a time if the batch fails.
+
+    Files that cannot be ingested on their own are moved to failed/ and the
+    rest to done/, so one bad delta does not hold up the others.
+    """
+    start = time.perf_counter()
+    try:
+        added = ingest(paths, csv_path, snapshot_dir)
+    except Exception:
+        logger.exception("Ingesting %d files failed, retrying them one at a time", len(paths))
+    else:
+        move_to(os.path.join(directory, "done"), paths)
+        logger.info("Added %d new rows from %d files in %.2fs", added, len(paths), time.perf_counter() - start)
+        return
+    for path in paths:
+        try:
+            added = ingest([path], csv_path, snapshot_dir)
+        except Exception:
+            logger.exception("Could not ingest %s, moved to failed/", path)
+            move_to(os.path.join(directory, "failed"), [path])
+        else:
+            move_to(os.path.join(directory, "done"), [path])
+            logger.info("Added %d new rows from %s", added, path)
+
+
+def watch(directory, interval, csv_path=DATA_PATH, snapshot_dir=SNAPSHOT_DIR):
+    """Ingest CSV files as they appear in directory, moving them to done/ or failed/ after"""
+    while True:
+        paths = sorted(glob.glob(os.path.join(directory, "*.csv")))
+        if paths:
+            try:
+                ingest_batch(paths, directory, csv_path, snapshot_dir)
+            except Exception:
+                # Moving the files failed too; they are picked up again next poll
+                logger.exception("Watching %s failed", directory)
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add new crash records to the dataset and its snapshot")
+    parser.add_argument("delta", nargs="*", help="CSV files with new rows")
+    parser.add_argument("--watch", help="directory to poll for new CSV files")
+    parser.add_argument("--interval", type=float, default=60, help="seconds between polls of --watch")
+    parser.add_argument("--csv", default=DATA_PATH, help="source CSV")
+    parser.add_argument("--snapshot", default=SNAPSHOT_DIR, help="snapshot directory")
+    args = parser.parse_args()
+
+    if args.watch:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+        watch(args.watch, args.interval, args.csv, args.snapshot)
+    elif args.delta:
+        start = time.perf_counter()
+        added = ingest(args.delta, args.csv, args.snapshot)
+        print(f"Added {added:,} new rows in {time.perf_counter() - start:.2f}s")
+    else:
+        parser.error("give delta CSV files or --watch DIR")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Precompute the API responses for the dashboard's common views.
+
+Most visits only ever see a few views: no filters, the dashboard's default
+date range, single years and fatal crashes only, for every ranking type and
+grouping, plus the heatmap the dashboard opens with. This job renders those
+responses with the API's own code on a pool of worker processes and saves
+them as a preset store inside the snapshot directory, which the API serves
+before computing anything. Other filter combinations are still computed live.
+
+    python precompute.py [--csv PATH] [--snapshot DIR] [--workers N]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import api
+from cache import CachedResponse, canonical_params, save_presets
+from dataset import DANGEROUS_MIN_CRASHES
+from filters import parse_date
+from snapshot import DATA_PATH, SNAPSHOT_DIR
+
+RANK_TYPES = ["frequency", "weighted", "dangerous"]
+GROUP_BYS = ["street", "location"]
+
+# The date range the dashboard starts with (see app.js)
+DASHBOARD_DATES = ("2017-10-24", "2025-10-24")
+
+NO_FILTERS = dict(damage=None, crash_type=None, injuries=None, cause=None, lighting=None)
+
+
+def filter_presets(dataset):
+    """(label, date_start, date_end, filters) of every preset view"""
+    # Rows are in date order, undated ones first
+    dated = dataset.dates[dataset.dates != np.iinfo(np.int64).min]
+    years = range(pd.Timestamp(dated[0]).year, pd.Timestamp(dated[-1]).year + 1) if len(dated) else []
+    presets = [
+        ("all", None, None, NO_FILTERS),
+        ("dashboard", *DASHBOARD_DATES, NO_FILTERS),
+        ("fatal", None, None, dict(NO_FILTERS, injuries="fatal")),
+        ("dashboard fatal", *DASHBOARD_DATES, dict(NO_FILTERS, injuries="fatal")),
+    ]
+    presets += [(str(year), f"{year}-01-01", f"{year}-12-31", NO_FILTERS) for year in years]
+    return presets
+
+
+def preset_requests(dataset):
+    """(endpoint, label, params) of every response to precompute.
+
+    params are exactly what the endpoint passes to cached_response, so the
+    stored responses are found under the same keys.
+    """
+    requests = []
+    for label, date_start, date_end, filters in filter_presets(dataset):
+        dates = dict(date_start=parse_date(date_start), date_end=parse_date(date_end))
+        for rank_type in RANK_TYPES:
+            for group_by in GROUP_BYS:
+                params = dict(rank_type=rank_type, group_by=group_by, limit=10, min_crashes=DANGEROUS_MIN_CRASHES,
+                              **dates, **filters, bbox=None)
+                requests.append(("ranking", f"{label} {rank_type} by {group_by}", params))
+        # The heatmap the dashboard loads before any zooming
+        params = dict(**dates, **filters, weight=None, mode="grid", zoom=api.MAP_ZOOM, format="binary",
+                      bbox=None)
+        requests.append(("heatmap", f"{label} heatmap", params))
+    return requests
+
+
+RENDERERS = {
+    "ranking": lambda params: api.render_ranking(**params),
+    "heatmap": lambda params: api.build_heatmap(**params),
+}
+
+
+def init_worker(csv_path, snapshot_dir):
+    """Point the API at the data and load it"""
+    api.DATA_PATH = csv_path
+    api.SNAPSHOT_DIR = snapshot_dir
+    api.get_dataset()
+
+
+def render(request):
+    """Render one preset in a worker; returns its body and how long it took"""
+    endpoint, label, params = request
+    start = time.perf_counter()
+    response = RENDERERS[endpoint](params)
+    return endpoint, label, params, response.body, response.media_type, time.perf_counter() - start
+
+
+def precompute(csv_path=DATA_PATH, snapshot_dir=SNAPSHOT_DIR, workers=None):
+    """Render every preset and save them; returns the per-preset timings"""
+    # Load (and if need be build) the snapshot and cubes once, before the
+    # workers start, so they do not all build them at the same time
+    init_worker(csv_path, snapshot_dir)
+    dataset = api.get_dataset()
+    requests = preset_requests(dataset)
+
+    responses, timings = {}, []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(csv_path, snapshot_dir)) as pool:
+        for endpoint, label, params, body, media_type, elapsed in pool.map(render, requests):
+            responses[(endpoint, canonical_params(params))] = CachedResponse(body, media_type)
+            timings.append((label, elapsed, len(body)))
+
+    checksum = dataset.source["checksum"] if dataset.source else None
+    save_presets(os.path.join(snapshot_dir, api.PRESET_DIR), responses, checksum)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute API responses for the dashboard's common views")
+    parser.add_argument("--csv", default=DATA_PATH, help="source CSV")
+    parser.add_argument("--snapshot", default=SNAPSHOT_DIR, help="snapshot directory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    timings = precompute(args.csv, args.snapshot, args.workers)
+    elapsed = time.perf_counter() - start
+
+    for label, seconds, size in sorted(timings, key=lambda t: -t[1]):
+        print(f"{label:<40} {seconds * 1000:9.1f} ms {size / 1024:9.1f} KiB")
+    total = sum(seconds for _, seconds, _ in timings)
+    print(f"{len(timings)} presets in {elapsed:.2f}s wall time with {args.workers} workers "
+          f"({total:.2f}s of rendering)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""JSON responses written straight from DataFrames.
+
+Turning a frame into a list of dicts with to_dict(orient="records") and then
+running it through jsonable_encoder creates a Python object for every cell
+and inspects each one again, which is most of the time a large response
+takes. FrameJSONResponse has pandas write the DataFrames of a response
+instead (to_json works on whole columns, in C) and only serialises the small
+envelope around them with the json module. NumPy scalars and Timestamps are
+converted on the way, and missing values go out as null.
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def json_default(value):
+    """Plain Python values for what the json module cannot serialise"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def records_json(frame):
+    """A frame as a JSON list of records, written by pandas"""
+    # Floats get to_json's default 10 decimal places: sub-millimetre for the
+    # coordinates, and more would print binary noise (41.850000000000001)
+    return frame.to_json(orient="records", date_format="iso", date_unit="s")
+
+
+def dumps(content):
+    """JSON text of content; DataFrames in it (as dict values) become lists of records"""
+    if isinstance(content, pd.DataFrame):
+        return records_json(content)
+    if isinstance(content, dict):
+        return "{" + ",".join(f"{json.dumps(str(key))}:{dumps(value)}" for key, value in content.items()) + "}"
+    return json.dumps(content, default=json_default, allow_nan=False, separators=(",", ":"))
+
+
+class FrameJSONResponse(JSONResponse):
+    """JSONResponse for content holding DataFrames, which are written column-wise"""
+
+    def render(self, content):
+        return dumps(content).encode("utf-8")
+
+
+# Schemas of the responses, for the OpenAPI docs. The endpoints return
+# ready-made responses, so these are documentation, not checked per request.
+
+class RankingEntry(BaseModel):
+    """A street or grid cell; the injury measures depend on the rank type"""
+    name: str
+    COUNT: int
+    CRASHES_PER_MONTH: Optional[float] = None
+    INJURIES_FATAL: Optional[float] = None
+    INJURIES_INCAPACITATING: Optional[float] = None
+    INJURIES_NON_INCAPACITATING: Optional[float] = None
+    INJURY_SCORE: Optional[float] = None
+    AVERAGE_INJURY_SCORE: Optional[float] = None
+
+
+class RankingResponse(BaseModel):
+    ranking: List[RankingEntry]
+    rank_type: str
+    group_by: str
+    total_crashes: int
+    message: Optional[str] = None
+
+
+class SampleResponse(BaseModel):
+    """The first rows of the data, one object per row keyed by column"""
+    data: List[Dict[str, Any]]
+
+
+class TimeSeriesPoint(BaseModel):
+    """Crashes in the period starting at period; condition only when the counts are split"""
+    period: str
+    condition: Optional[str] = None
+    crashes: int
+
+
+class TimeSeriesResponse(BaseModel):
+    granularity: str
+    conditions: Optional[List[str]] = None
+    first_crash: Optional[str] = None
+    last_crash: Optional[str] = None
+    series: List[TimeSeriesPoint]
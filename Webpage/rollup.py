@@ -0,0 +1,173 @@
+"""Pre-aggregated crash counts over time.
+
+Several views only need how many crashes happened per hour, day or month:
+the time plots of make_plots.py, /api/timeseries, and the span of time the
+data actually covers, which the per-month crash rates are divided by.
+Rollups holds those counts for every period that has crashes, optionally
+split by a condition column such as the weather, counted in one pass over
+the crash timestamps. Days and months are summed from the hourly table
+rather than from the crashes again.
+
+Like the ranking cubes, rollups are cached as .npy columns next to the data
+they were built from, and ingest.py adds new crashes to them without
+counting the old ones again.
+"""
+import numpy as np
+import pandas as pd
+
+# Bump whenever the rollup layout changes so cached rollups are rebuilt
+ROLLUP_VERSION = 1
+
+# Period units of the tables, finest first
+GRANULARITIES = {"hour": "datetime64[h]", "day": "datetime64[D]", "month": "datetime64[M]"}
+
+# Condition code of crashes without a condition value
+NO_CONDITION = -1
+
+# Average length of a month in days
+DAYS_PER_MONTH = 365.2425 / 12
+
+NAT = np.iinfo(np.int64).min
+
+
+def condition_codes(values, conditions=None):
+    """Codes of per-crash condition values, and the condition names they index.
+
+    conditions, if given, are the names of existing rollups: their codes are
+    kept and values they lack get the next ones. Otherwise categorical values
+    keep the order of their categories.
+    """
+    if conditions is None and isinstance(getattr(values, "dtype", None), pd.CategoricalDtype):
+        conditions = [str(category) for category in values.cat.categories]
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    conditions = list(conditions or [])
+    lookup = {name: code for code, name in enumerate(conditions)}
+    for value in uniques:
+        if str(value) not in lookup:
+            lookup[str(value)] = len(conditions)
+            conditions.append(str(value))
+    mapped = np.array([lookup[str(value)] for value in uniques] + [NO_CONDITION], dtype=np.int16)[codes]
+    return mapped, conditions
+
+
+def count(periods, conditions, weights=None):
+    """Crashes (or summed weights) per (period, condition), sorted by period then condition"""
+    radix = int(conditions.max()) + 2 if len(conditions) else 1
+    keys = np.asarray(periods, dtype=np.int64) * radix + (conditions.astype(np.int64) + 1)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    crashes = np.bincount(inverse, weights=weights, minlength=len(keys))
+    return {
+        "period": (keys // radix).astype(np.int32),
+        "condition": (keys % radix - 1).astype(np.int16),
+        "crashes": np.rint(crashes).astype(np.int64) if weights is not None else crashes.astype(np.int64),
+    }
+
+
+def hour_table(times, codes):
+    """Hourly counts of the crashes with a timestamp (int64 nanoseconds, NAT if missing)"""
+    dated = times != NAT
+    hours = times[dated].view("datetime64[ns]").astype("datetime64[h]").astype(np.int64)
+    return count(hours, codes[dated])
+
+
+def coarser_tables(hours):
+    """The hourly table plus the day and month tables summed from it"""
+    days = count(np.floor_divide(hours["period"].astype(np.int64), 24), hours["condition"], hours["crashes"])
+    months = days["period"].astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+    return {"hour": hours, "day": days, "month": count(months, days["condition"], days["crashes"])}
+
+
+def time_span(times):
+    """First and last timestamp (int64 nanoseconds) of the crashes, or None without any"""
+    dated = times[times != NAT]
+    return (int(dated.min()), int(dated.max())) if len(dated) else None
+
+
+class Rollups:
+    """Crash counts per (period, condition) at each granularity, sorted by period.
+
+    Periods are counted in their unit since 1970 (hours, days or months).
+    conditions is None when the counts are not split by a condition; the
+    condition codes are then all NO_CONDITION. span is the first and last
+    crash timestamp.
+    """
+
+    def __init__(self, tables, conditions, span):
+        self.tables = tables
+        self.conditions = conditions
+        self.span = span
+
+    @classmethod
+    def build(cls, times, conditions=None):
+        """Rollups of crashes at int64 nanosecond times, split by their conditions if given"""
+        times = np.asarray(times, dtype=np.int64)
+        if conditions is None:
+            codes, names = np.full(len(times), NO_CONDITION, dtype=np.int16), None
+        else:
+            codes, names = condition_codes(conditions)
+        return cls(coarser_tables(hour_table(times, codes)), names, time_span(times))
+
+    def append(self, times, conditions=None):
+        """New rollups with more crashes counted in; the existing counts are only added to"""
+        times = np.asarray(times, dtype=np.int64)
+        names = self.conditions
+        if conditions is None or names is None:
+            codes = np.full(len(times), NO_CONDITION, dtype=np.int16)
+        else:
+            codes, names = condition_codes(conditions, names)
+        hours, added = self.tables["hour"], hour_table(times, codes)
+        merged = count(np.concatenate([hours["period"], added["period"]]),
+                       np.concatenate([hours["condition"], added["condition"]]),
+                       np.concatenate([hours["crashes"], added["crashes"]]))
+        spans = [span for span in (self.span, time_span(times)) if span is not None]
+        span = (min(s[0] for s in spans), max(s[1] for s in spans)) if spans else None
+        return Rollups(coarser_tables(merged), names, span)
+
+    @property
+    def arrays(self):
+        return {f"{granularity}_{col}": values for granularity, table in self.tables.items()
+                for col, values in table.items()}
+
+    @classmethod
+    def from_arrays(cls, arrays, meta):
+        tables = {granularity: {col: arrays[f"{granularity}_{col}"] for col in ("period", "condition", "crashes")}
+                  for granularity in GRANULARITIES}
+        return cls(tables, meta["conditions"], tuple(meta["span"]) if meta["span"] else None)
+
+    def meta(self):
+        return {"version": ROLLUP_VERSION, "conditions": self.conditions, "span": self.span}
+
+    def frame(self, granularity, start=None, end=None):
+        """Counts of the periods overlapping start..end (Timestamps, None for open ends).
+
+        Columns are period (the start of each period), condition (only when
+        split) and crashes. Periods without crashes are left out.
+        """
+        table = self.tables[granularity]
+        unit = GRANULARITIES[granularity]
+        period = table["period"]
+        lo, hi = 0, len(period)
+        if start is not None:
+            lo = np.searchsorted(period, pd.Timestamp(start).to_datetime64().astype(unit).astype(np.int64), side="left")
+        if end is not None:
+            hi = max(lo, np.searchsorted(period, pd.Timestamp(end).to_datetime64().astype(unit).astype(np.int64), side="right"))
+        frame = pd.DataFrame({"period": period[lo:hi].astype(np.int64).astype(unit).astype("datetime64[ns]")})
+        if self.conditions is not None:
+            frame["condition"] = pd.Categorical.from_codes(table["condition"][lo:hi], categories=self.conditions)
+        frame["crashes"] = table["crashes"][lo:hi]
+        return frame
+
+    def covered_days(self, start=None, end=None):
+        """Days from start to end (Timestamps, inclusive, None for open ends) within the data's span"""
+        if self.span is None:
+            return 0
+        first, last = (pd.Timestamp(t).normalize() for t in self.span)
+        if start is not None:
+            first = max(first, pd.Timestamp(start).normalize())
+        if end is not None:
+            last = min(last, pd.Timestamp(end).normalize())
+        return max(0, (last - first).days + 1)
+
+    def covered_months(self, start=None, end=None):
+        """covered_days() in average-length months"""
+        return self.covered_days(start, end) / DAYS_PER_MONTH
@@ -0,0 +1,291 @@
+"""Columnar snapshot of Newnew_dataset.csv.
+
+Parsing the CSV made the first request after every restart slow, so this
+module converts it once into a directory of .npy column files (dates already
+parsed, strings dictionary-encoded, rows in date order) plus a meta.json
+carrying a checksum of the source CSV. The API memory-maps the snapshot at startup and only reads
+the CSV again when the snapshot is missing or stale. Structures derived from
+the data (such as the ranking cubes) are cached inside the snapshot directory
+with save_arrays() and disappear with it when the snapshot is rebuilt.
+
+The text columns, whose values are nearly all distinct (the record ids and
+crash timestamps), gain nothing from dictionary encoding: their categories
+would be a Python string per row, rebuilt in every process. They are stored as fixed-width
+UTF-8 byte strings instead and handed out separately from the frame as
+mapped arrays, so several API workers share one copy through the page cache.
+
+Build it with:
+
+    python snapshot.py [--csv PATH] [--out DIR]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "..", "Newnew_dataset.csv")
+SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), "..", "Newnew_dataset.snapshot")
+
+# Bump whenever the on-disk layout or the typing rules below change
+SNAPSHOT_VERSION = 4
+META_FILE = "meta.json"
+DATE_COLUMNS = ["CRASH_DATE_ONLY"]
+
+# String columns stored as text rather than as categories. Named rather than
+# picked by how many distinct values the data has, since the API indexes and
+# groups by the other columns and needs them in the frame
+TEXT_COLUMNS = ["CRASH_RECORD_ID", "CRASH_DATE"]
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_info(csv_path):
+    """Identify the CSV a snapshot was built from"""
+    stat = os.stat(csv_path)
+    return {
+        "checksum": file_checksum(csv_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def read_csv(csv_path):
+    """Read the CSV into the typed frame the API works on"""
+    return type_frame(pd.read_csv(csv_path, low_memory=False))
+
+
+def type_frame(df):
+    """Type freshly parsed CSV rows the way the API expects them"""
+    df["COUNT"] = 1
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col])
+    # Rows are stored in date order so date ranges are contiguous slices
+    if "CRASH_DATE_ONLY" in df.columns:
+        df = df.sort_values("CRASH_DATE_ONLY", kind="stable", na_position="first", ignore_index=True)
+    for col in df.columns:
+        if df[col].dtype == object:
+            values = df[col]
+            df[col] = values.where(values.isna(), values.astype(str)).astype("category")
+    return df
+
+
+def encode_text(values):
+    """Categorical values as fixed-width UTF-8 bytes, missing values as b"""""
+    encoded = np.array([str(v).encode("utf-8") for v in values.cat.categories] + [b""])
+    return encoded[values.cat.codes.to_numpy()]
+
+
+def decode_text(values):
+    """Fixed-width UTF-8 bytes back to strings, b"" to None"""
+    decoded = pd.Series(np.char.decode(np.asarray(values), "utf-8"), dtype=object)
+    return decoded.where(decoded != "", None)
+
+
+def read_meta(snapshot_dir):
+    path = os.path.join(snapshot_dir, META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def is_fresh(csv_path, snapshot_dir):
+    """True when the snapshot can be used in place of the CSV.
+
+    The size/mtime pair is checked first so a fresh snapshot costs no hashing;
+    the checksum only decides when the CSV was touched but may be unchanged.
+    A snapshot shipped without its CSV is trusted as-is.
+    """
+    meta = read_meta(snapshot_dir)
+    if meta is None or meta.get("version") != SNAPSHOT_VERSION:
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    source = meta["source"]
+    stat = os.stat(csv_path)
+    if stat.st_size != source["size"]:
+        return False
+    if stat.st_mtime_ns == source["mtime_ns"]:
+        return True
+    return file_checksum(csv_path) == source["checksum"]
+
+
+def write_snapshot(df, snapshot_dir, source, text=None, derived=None):
+    """Write df (and text columns already encoded as bytes) as one .npy file per column.
+
+    Categorical columns are stored as their integer codes with the categories
+    in a JSON sidecar, or as text for the TEXT_COLUMNS.
+    derived maps directory names to (arrays, meta) written with save_arrays()
+    alongside. The snapshot is written to a temporary directory and moved
+    into place so a reader never sees a half-written one.
+    """
+    tmp_dir = snapshot_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    columns = []
+    for i, col in enumerate(list(df.columns) + list(text or {})):
+        values = df[col] if col in df.columns else text[col]
+        entry = {"name": col, "file": f"col{i:03d}.npy"}
+        if col not in df.columns:
+            entry["kind"] = "text"
+            array = values
+        elif isinstance(values.dtype, pd.CategoricalDtype) and col in TEXT_COLUMNS:
+            entry["kind"] = "text"
+            array = encode_text(values)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            entry["kind"] = "category"
+            entry["categories"] = f"col{i:03d}.categories.json"
+            with open(os.path.join(tmp_dir, entry["categories"]), "w") as f:
+                json.dump(values.cat.categories.tolist(), f)
+            array = values.cat.codes.to_numpy()
+        elif pd.api.types.is_datetime64_any_dtype(values.dtype):
+            entry["kind"] = "datetime"
+            array = values.to_numpy(dtype="datetime64[ns]")
+        else:
+            entry["kind"] = "numeric"
+            array = values.to_numpy()
+        np.save(os.path.join(tmp_dir, entry["file"]), array, allow_pickle=False)
+        columns.append(entry)
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "rows": len(df),
+        "source": source,
+        "columns": columns,
+    }
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    for name, (arrays, array_meta) in (derived or {}).items():
+        save_arrays(os.path.join(tmp_dir, name), arrays, array_meta)
+
+    replace_dir(tmp_dir, snapshot_dir)
+    return meta
+
+
+def replace_dir(new_dir, directory):
+    """Move new_dir into place of directory.
+
+    The old directory is renamed away before it is deleted, so it is missing
+    only between two renames; processes that still map its files keep
+    reading them until they let go.
+    """
+    old_dir = directory + ".old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_dir)
+    os.replace(new_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def load_snapshot(snapshot_dir, mmap=True):
+    """Load a snapshot, memory-mapping the column files by default.
+
+    Returns the frame and a {name: bytes array} dict of the text columns,
+    which are left out of the frame.
+    """
+    meta = read_meta(snapshot_dir)
+    if meta is None:
+        raise FileNotFoundError(f"No snapshot in {snapshot_dir}")
+
+    data, text = {}, {}
+    for entry in meta["columns"]:
+        values = np.load(
+            os.path.join(snapshot_dir, entry["file"]),
+            mmap_mode="r" if mmap else None,
+            allow_pickle=False,
+        )
+        if entry["kind"] == "text":
+            text[entry["name"]] = np.asarray(values)
+            continue
+        if entry["kind"] == "category":
+            with open(os.path.join(snapshot_dir, entry["categories"])) as f:
+                categories = json.load(f)
+            values = pd.Categorical.from_codes(values, categories=categories)
+        data[entry["name"]] = values
+    # copy=False keeps every column backed by its own (mapped) array instead
+    # of consolidating same-dtype columns into fresh blocks
+    return pd.DataFrame(data, copy=False), text
+
+
+def build_snapshot(csv_path=DATA_PATH, snapshot_dir=SNAPSHOT_DIR):
+    """Convert csv_path into a snapshot at snapshot_dir"""
+    source = source_info(csv_path)
+    df = read_csv(csv_path)
+    write_snapshot(df, snapshot_dir, source)
+    return df
+
+
+def load_dataframe(csv_path=DATA_PATH, snapshot_dir=SNAPSHOT_DIR):
+    """Load the dataset from the snapshot, or from the CSV if it is stale.
+
+    Returns the frame, its text columns (see load_snapshot) and the
+    source_info() of the CSV it came from, which identifies the data for
+    anything cached alongside it. A stale snapshot is rebuilt on the way and
+    then mapped like a fresh one; failing to write it (e.g. a read-only
+    checkout) is not fatal, the frame read from the CSV is used as it is.
+    """
+    if not is_fresh(csv_path, snapshot_dir):
+        source = source_info(csv_path)
+        df = read_csv(csv_path)
+        try:
+            write_snapshot(df, snapshot_dir, source)
+        except OSError:
+            return df, {}, source
+    df, text = load_snapshot(snapshot_dir)
+    return df, text, read_meta(snapshot_dir)["source"]
+
+
+def save_arrays(directory, arrays, meta):
+    """Store structures derived from a snapshot as .npy files plus meta.json"""
+    tmp_dir = directory + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array, allow_pickle=False)
+    with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+        json.dump(dict(meta, arrays=list(arrays)), f, indent=2)
+    replace_dir(tmp_dir, directory)
+
+
+def load_arrays(directory, mmap=True):
+    """Arrays and meta written by save_arrays, or (None, None) if absent"""
+    meta = read_meta(directory)
+    if meta is None:
+        return None, None
+    # np.asarray drops the memmap subclass, whose indexing overhead is large,
+    # while still reading straight from the mapped file
+    arrays = {
+        name: np.asarray(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r" if mmap else None, allow_pickle=False))
+        for name in meta["arrays"]
+    }
+    return arrays, meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the columnar snapshot of the crash CSV")
+    parser.add_argument("--csv", default=DATA_PATH, help="source CSV")
+    parser.add_argument("--out", default=SNAPSHOT_DIR, help="snapshot directory")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    df = build_snapshot(args.csv, args.out)
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {len(df):,} rows x {len(df.columns)} columns to {args.out} in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
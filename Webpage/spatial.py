@@ -0,0 +1,138 @@
+"""Spatial index over crash coordinates.
+
+Crashes are ordered along a Z-order (Morton) curve of the zoom 16 Web
+Mercator tiles they fall in. Every map tile at zoom 16 or below then covers
+one contiguous run of that order, found by binary search, so a tile request
+only looks at the crashes inside it. Deeper tiles start from their zoom 16
+ancestor and are cut down by pixel position.
+
+Bounding boxes are covered by a handful of tiles of a suitable zoom level
+and radius searches start from the bounding box of their circle, so both
+only touch the crashes near the area asked about.
+"""
+import numpy as np
+
+from heatmap import TILE_SIZE, mercator_pixels
+
+# Zoom level of the tiles the index is sorted by (tiles about 450 m wide)
+BASE_ZOOM = 16
+
+# A bounding box is covered by at most this many tiles per side
+BBOX_TILES = 8
+
+EARTH_RADIUS_M = 6371008.8
+
+# Arrays an index is made of, in constructor order
+ARRAYS = ["rows", "codes", "x", "y", "lat", "lon"]
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def radius_bbox(lat, lon, radius_m):
+    """(south, west, north, east) box enclosing a circle around a point"""
+    dlat = np.degrees(radius_m / EARTH_RADIUS_M)
+    dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def interleave(x, y):
+    """Morton code of 16-bit tile coordinates: the bits of x and y alternated"""
+    def spread(v):
+        v = np.asarray(v, dtype=np.int64) & 0xFFFF
+        v = (v | (v << 8)) & 0x00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F
+        v = (v | (v << 2)) & 0x33333333
+        v = (v | (v << 1)) & 0x55555555
+        return v
+    return spread(x) | (spread(y) << 1)
+
+
+class SpatialIndex:
+    """Crash rows sorted by Morton code, with their zoom 16 pixel positions.
+
+    Crashes without coordinates, or at (0, 0), are not indexed, matching what
+    the map plots.
+    """
+
+    def __init__(self, rows, codes, x, y, lat, lon):
+        self.rows = rows
+        self.codes = codes
+        self.x = x
+        self.y = y
+        self.lat = lat
+        self.lon = lon
+
+    @classmethod
+    def build(cls, lat, lon):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        valid = ~(np.isnan(lat) | np.isnan(lon)) & (lat != 0) & (lon != 0)
+        rows = np.flatnonzero(valid)
+        x, y = mercator_pixels(lat[rows], lon[rows], BASE_ZOOM)
+        codes = interleave(x // TILE_SIZE, y // TILE_SIZE)
+        order = np.argsort(codes, kind="stable")
+        rows = rows[order]
+        return cls(rows, codes[order], x[order], y[order], lat[rows], lon[rows])
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(*(arrays[f"spatial_{name}"] for name in ARRAYS))
+
+    def arrays(self):
+        """The index as named arrays, for from_arrays()"""
+        return {f"spatial_{name}": getattr(self, name) for name in ARRAYS}
+
+    def tile(self, z, x, y):
+        """Index positions of the crashes inside map tile (z, x, y)"""
+        if z <= BASE_ZOOM:
+            shift = 2 * (BASE_ZOOM - z)
+            first = int(interleave(x, y)) << shift
+            lo, hi = np.searchsorted(self.codes, [first, first + (1 << shift)])
+            return np.arange(lo, hi)
+
+        # Start from the zoom 16 ancestor and keep the pixels inside the tile
+        ancestor = self.tile(BASE_ZOOM, x >> (z - BASE_ZOOM), y >> (z - BASE_ZOOM))
+        scale = 2 ** (z - BASE_ZOOM)
+        px, py = self.x[ancestor] * scale, self.y[ancestor] * scale
+        inside = ((px >= x * TILE_SIZE) & (px < (x + 1) * TILE_SIZE) &
+                  (py >= y * TILE_SIZE) & (py < (y + 1) * TILE_SIZE))
+        return ancestor[inside]
+
+    def bbox(self, south, west, north, east):
+        """Index positions of the crashes inside a latitude/longitude box"""
+        left, top = mercator_pixels(north, west, BASE_ZOOM)
+        right, bottom = mercator_pixels(south, east, BASE_ZOOM)
+        x0, x1 = int(left // TILE_SIZE), int(right // TILE_SIZE)
+        y0, y1 = int(top // TILE_SIZE), int(bottom // TILE_SIZE)
+
+        # Cover the box with at most BBOX_TILES x BBOX_TILES tiles of one zoom
+        span = max(x1 - x0, y1 - y0) + 1
+        levels = min(BASE_ZOOM, max(0, int(np.ceil(np.log2(span / BBOX_TILES)))))
+        tx, ty = np.meshgrid(np.arange(x0 >> levels, (x1 >> levels) + 1), np.arange(y0 >> levels, (y1 >> levels) + 1))
+        first = interleave(tx.ravel(), ty.ravel()) << (2 * levels)
+        lo = np.searchsorted(self.codes, first)
+        hi = np.searchsorted(self.codes, first + (1 << (2 * levels)))
+        candidates = np.concatenate([np.arange(l, h) for l, h in zip(lo, hi)] or [np.empty(0, dtype=np.int64)])
+
+        x, y = self.x[candidates], self.y[candidates]
+        inside = (x >= left) & (x <= right) & (y >= top) & (y <= bottom)
+        return candidates[inside]
+
+    def radius(self, lat, lon, radius_m):
+        """Index positions and distances (m) of the crashes within radius_m, nearest first"""
+        candidates = self.bbox(*radius_bbox(lat, lon, radius_m))
+        distance = haversine_m(lat, lon, self.lat[candidates], self.lon[candidates])
+        inside = distance <= radius_m
+        candidates, distance = candidates[inside], distance[inside]
+        order = np.argsort(distance, kind="stable")
+        return candidates[order], distance[order]
+
+    def pixels(self, positions, zoom):
+        """Global pixel coordinates at zoom of the crashes at index positions"""
+        scale = 2.0 ** (zoom - BASE_ZOOM)
+        return self.x[positions] * scale, self.y[positions] * scale
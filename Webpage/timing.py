@@ -0,0 +1,290 @@
+"""Per-stage timing of API requests.
+
+Code on the request path wraps its steps in stage("filter"), stage("cube"),
+... and notes how many rows a step left. Each request collects its stages in
+a Timings object that travels with it in a context variable (into the render
+pool too, see in_context()), so the same code records nothing when it runs
+outside a request, as in precompute.py or the benchmarks.
+
+When a request finishes its stages are:
+- sent back in a Server-Timing header, which browser dev tools show per request
+- added to per endpoint and stage histograms, served by /metrics in the
+  Prometheus text format along with a count of the errors the endpoints
+  caught
+
+Setting CRASH_PROFILE_SLOW_MS turns on a sampling profiler for renders:
+renders slower than that are saved as collapsed stacks (one "frame;frame;...
+count" line per stack, the input of flamegraph.pl and speedscope) in
+CRASH_PROFILE_DIR.
+"""
+import bisect
+import contextvars
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger("crash_api")
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROWS_BUCKETS = (10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# Renders slower than this many milliseconds are profiled (None: never)
+PROFILE_SLOW_MS = float(os.environ["CRASH_PROFILE_SLOW_MS"]) if os.environ.get("CRASH_PROFILE_SLOW_MS") else None
+PROFILE_DIR = os.environ.get("CRASH_PROFILE_DIR", "profiles")
+# Seconds between stack samples
+PROFILE_INTERVAL = 0.005
+
+
+class Stage:
+    """Duration, row count and note of one stage; repeated stages add up"""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.rows = None
+        self.desc = None
+        # Stages that only carry a note are left out of the histograms
+        self.timed = False
+
+
+class Timings:
+    """The stages of one request, in the order they first ran"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds=None, rows=None, desc=None):
+        with self.lock:
+            stage = self.stages.setdefault(name, Stage())
+            if seconds is not None:
+                stage.seconds += seconds
+                stage.timed = True
+            if rows is not None:
+                stage.rows = (stage.rows or 0) + rows
+            if desc is not None:
+                stage.desc = desc
+
+    def header(self, total):
+        """Server-Timing header value: the stages, then the total, in milliseconds"""
+        entries = []
+        for name, stage in list(self.stages.items()) + [("total", None)]:
+            seconds = total if stage is None else stage.seconds
+            entry = f"{name};dur={seconds * 1000:.2f}"
+            desc = None if stage is None else stage.desc or (f"{stage.rows} rows" if stage.rows is not None else None)
+            if desc:
+                entry += f';desc="{desc}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+
+current = contextvars.ContextVar("timings", default=None)
+
+
+class StageTimer:
+    """What stage() yields: set .rows to the rows the stage left"""
+    rows = None
+
+
+@contextmanager
+def stage(name):
+    """Time a block as a stage of the current request, if there is one"""
+    timer = StageTimer()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timings = current.get()
+        if timings is not None:
+            timings.add(name, time.perf_counter() - start, timer.rows)
+
+
+def note(name, desc):
+    """Attach a note such as "hit" or "miss" to a stage of the current request"""
+    timings = current.get()
+    if timings is not None:
+        timings.add(name, desc=desc)
+
+
+def record_error(error):
+    """Log an error an endpoint caught and count it for /metrics"""
+    logger.error("Request failed", exc_info=error)
+    timings = current.get()
+    if timings is not None:
+        timings.error = type(error).__name__
+
+
+def in_context(fn):
+    """fn run in the caller's context, so stages timed on a worker thread reach its request"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        # Buckets count the values up to and including their bound
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """Prometheus text lines for this histogram"""
+        cumulative = list(itertools.accumulate(self.counts))
+        bounds = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+        lines = [f'{name}_bucket{{{labels},le="{bound}"}} {count}' for bound, count in zip(bounds, cumulative)]
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {cumulative[-1]}")
+        return lines
+
+
+class Metrics:
+    """Histograms of request and stage durations and stage row counts, plus error counts"""
+
+    METRICS = {
+        "crash_api_request_seconds": ("histogram", "Time to handle a request, by endpoint"),
+        "crash_api_stage_seconds": ("histogram", "Time spent in each stage of a request, by endpoint and stage"),
+        "crash_api_stage_rows": ("histogram", "Rows left after each stage, by endpoint and stage"),
+        "crash_api_errors_total": ("counter", "Errors caught by the endpoints, by endpoint and error type"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {name: {} for name, (kind, _) in self.METRICS.items() if kind == "histogram"}
+        self.errors = Counter()
+
+    def histogram(self, name, labels, buckets):
+        histograms = self.histograms[name]
+        if labels not in histograms:
+            histograms[labels] = Histogram(buckets)
+        return histograms[labels]
+
+    def observe(self, endpoint, timings, total):
+        """Add a finished request's timings"""
+        with self.lock:
+            self.histogram("crash_api_request_seconds", (("endpoint", endpoint),), SECONDS_BUCKETS).observe(total)
+            for name, stage in timings.stages.items():
+                if not stage.timed:
+                    continue
+                labels = (("endpoint", endpoint), ("stage", name))
+                self.histogram("crash_api_stage_seconds", labels, SECONDS_BUCKETS).observe(stage.seconds)
+                if stage.rows is not None:
+                    self.histogram("crash_api_stage_rows", labels, ROWS_BUCKETS).observe(stage.rows)
+            if timings.error:
+                self.errors[(("endpoint", endpoint), ("error", timings.error))] += 1
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        def label_text(labels):
+            return ",".join(f'{key}="{value}"' for key, value in labels)
+
+        lines = []
+        with self.lock:
+            for name, (kind, help) in self.METRICS.items():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                if kind == "histogram":
+                    for labels, histogram in sorted(self.histograms[name].items()):
+                        lines += histogram.lines(name, label_text(labels))
+                else:
+                    lines += [f"{name}{{{label_text(labels)}}} {count}" for labels, count in sorted(self.errors.items())]
+        return "\n".join(lines) + "\n"
+
+
+class TimingMiddleware:
+    """ASGI middleware giving every HTTP request a Timings to collect its stages in.
+
+    The stages go out in the Server-Timing header and into metrics once the
+    response starts; stages of a streamed body after that are not counted.
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = Timings()
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                total = time.perf_counter() - timings.start
+                # Label by route template, so every map tile does not get its own series
+                route = scope.get("route")
+                self.metrics.observe(route.path if route is not None else "unmatched", timings, total)
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.header(total))
+                headers.append("Timing-Allow-Origin", "*")
+            await send(message)
+
+        token = current.set(timings)
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            current.reset(token)
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval from a background thread"""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.sampler.join()
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def profiled(fn, label):
+    """fn, sampled while it runs if profiling is on; slow runs are saved under PROFILE_DIR"""
+    if PROFILE_SLOW_MS is None:
+        return fn
+
+    def run(*args, **kwargs):
+        start = time.perf_counter()
+        with SamplingProfiler(threading.get_ident()) as profiler:
+            result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if elapsed * 1000 >= PROFILE_SLOW_MS:
+            path = os.path.join(PROFILE_DIR, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}.folded")
+            profiler.save(path)
+            logger.warning("Slow %s render (%.0f ms), profile saved to %s", label, elapsed * 1000, path)
+        return result
+    return run
@@ -1,376 +1,612 @@
+"""Build the interactive plots of the website as plots/plot*.html.
+
+Every plot is registered in PLOTS with the input it reads. A plot is only
+rebuilt when the hash of its inputs changed since the last build: the
+checksum of the source pickle plus the code and parameters of the plot and
+of the feature stage that prepares its data. The hashes are kept in
+plots/manifest.json. Plots that need rebuilding render in a pool of
+worker processes.
+
+The plots of crash counts over time read hourly and daily counts by weather
+from rollups (see Webpage/rollup.py, which the API serves its time series
+from) instead of the crash table. They are cached in rollups/ until their
+pickle or the code building them changes.
+
+    python make_plots.py [--only plot3 ...] [--jobs N] [--force]
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly
 import plotly.graph_objects as go
 import plotly.express as px
 import pandas as pd
 import numpy as np
 
-####################### Import Dataset #######################
-data = pd.read_pickle('dataset.pkl')
-unmerged = pd.read_pickle('full_dataset.pkl')
+# The rollups are built by the same code as the API's
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Webpage'))
+from rollup import ROLLUP_VERSION, Rollups
+from snapshot import load_arrays, save_arrays
 
+DATA_PATH = 'dataset.pkl'
+FULL_DATA_PATH = 'full_dataset.pkl'
+PLOTS_DIR = 'plots'
+MANIFEST_PATH = os.path.join(PLOTS_DIR, 'manifest.json')
+ROLLUP_DIR = 'rollups'
 
-####################### Plot 0 #######################
-df = unmerged.copy()
-df['CRASH_DATE'] = pd.to_datetime(df['CRASH_DATE'])
-
-# Remove October 24, 2025
-df = df[df['CRASH_DATE'].dt.date != pd.to_datetime('2025-10-24').date()]
-
-daily_crashes = (
-    df.groupby(df['CRASH_DATE'].dt.date)['CRASH_RECORD_ID']
-      .count()
-      .reset_index()
-)
-daily_crashes.columns = ['date', 'crash_count']
-
-monthly_crashes = (
-    df.groupby(df['CRASH_DATE'].dt.to_period('M'))['CRASH_RECORD_ID']
-      .count()
-      .reset_index()
-)
-monthly_crashes.columns = ['month', 'crash_count']
-monthly_crashes['month'] = monthly_crashes['month'].dt.to_timestamp()
-
-fig = go.Figure()
-
-fig.add_trace(go.Scatter(
-    x=daily_crashes['date'],
-    y=daily_crashes['crash_count'],
-    mode='lines',
-    line=dict(color='coral', width=1),
-    name='Daily Crashes',
-    hovertemplate='%{x|%Y-%m-%d}<br>Crashes: %{y}<extra></extra>'
-))
-
-fig.add_trace(go.Scatter(
-    x=monthly_crashes['month'],
-    y=monthly_crashes['crash_count'],
-    mode='lines+markers',
-    line=dict(color='rgba(255,140,0,0.6)', width=3),
-    marker=dict(size=8, color='rgba(255,140,0,0.6)'),
-    name='Monthly Crashes',
-    hovertemplate='%{x|%b %Y}<br>Crashes: %{y}<extra></extra>'
-))
-
-fig.update_layout(
-    title='Daily and Monthly Traffic Crashes',
-    xaxis_title='Date',
-    yaxis_title='Crash Count',
-    plot_bgcolor='white',
-    paper_bgcolor='white',
-    xaxis=dict(showgrid=True, gridcolor='lightgray'),
-    yaxis=dict(showgrid=True, gridcolor='lightgray'),
-    width=580,
-    height=380,
-    legend=dict(orientation='h', y=-0.2, x=0.5,
-                xanchor='center', yanchor='top')
-)
-
-fig.update_xaxes(
-    dtick="M12",
-    tickformat="%Y",
-    tickangle=0
-)
-
-fig.write_html("plots/plot0.html")
+# Bump whenever the manifest layout changes
+MANIFEST_VERSION = 1
 
 
-####################### Plot 1 #######################
-df = data.copy()
-
-df['CRASH_DATE'] = pd.to_datetime(df['CRASH_DATE'])
-df['CRASH_HOUR'] = df['CRASH_DATE'].dt.hour
-df['CRASH_DAY_OF_WEEK'] = df['CRASH_DATE'].dt.day_name()
-
-colors = {
-    'Sunday': 'black',
-    'Monday': 'lightcoral',
-    'Tuesday': 'orange',
-    'Wednesday': 'lawngreen',
-    'Thursday': 'red',
-    'Friday': 'blue',
-    'Saturday': 'darkviolet'
+####################### Shared Features #######################
+# Hours left out of the rain and snow regressions, as (year, month, day, hour)
+EXCLUDED_HOURS = []
+
+# Weekday order of plot 1's lines
+DAYS = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+# Snow when the hour's precipitation type is 70, rain when any rain fell, clear otherwise
+def weather_condition(df):
+    return np.select(
+        [df['Precipitation Type'] == 70, df['Interval Rain'] > 0],
+        ['Snow', 'Rain'],
+        default='Clear'
+    )
+
+# Hour of each timestamp as one integer, e.g. 2019061408 for 2019-06-14 08:xx
+def hour_key(year, month, day, hour):
+    return ((year * 100 + month) * 100 + day) * 100 + hour
+
+# True for the crashes in one of the excluded hours
+def in_excluded_hours(dates, excluded=EXCLUDED_HOURS):
+    if not excluded:
+        return np.zeros(len(dates), dtype=bool)
+    parts = [getattr(dates.dt, part).to_numpy(dtype=np.int64, na_value=-1) for part in ('year', 'month', 'day', 'hour')]
+    keys = hour_key(*parts)
+    return np.isin(keys, [hour_key(*hour) for hour in excluded])
+
+# Parse the crash dates once and derive what the plots group and filter by
+def add_features(df):
+    df['CRASH_DATE'] = pd.to_datetime(df['CRASH_DATE'])
+    dates = df['CRASH_DATE']
+    df['date'] = dates.dt.normalize()
+    df['hour'] = dates.dt.hour
+    df['weather'] = pd.Categorical(weather_condition(df), categories=['Clear', 'Rain', 'Snow'])
+    df['excluded'] = in_excluded_hours(dates)
+    return df
+
+# Most common value of a categorical column per group, like
+# groupby(keys)[values].agg(lambda x: x.mode()[0]) without a Python call per group.
+# Counts every (group, value) pair in one bincount and takes the argmax of
+# each group's row; the values are sorted as mode() sorts them, so ties go to
+# the first. Groups without any value get NaN.
+def dominant(keys, values):
+    group, groups = pd.factorize(keys, sort=True)
+    code, categories = pd.factorize(values, sort=True)
+    valid = (group >= 0) & (code >= 0)
+    # A trailing NaN label for the groups without any value
+    labels = np.append(np.asarray(categories, dtype=object), np.nan)
+    counts = np.bincount(group[valid] * len(labels) + code[valid],
+                         minlength=len(groups) * len(labels)).reshape(len(groups), len(labels))
+    counts[:, -1] = ~counts.any(axis=1)
+    return pd.Series(labels[counts.argmax(axis=1)], index=pd.Index(groups, name=getattr(keys, 'name', None)),
+                     name=getattr(values, 'name', None))
+
+# dataset.pkl with the features added
+def load_crashes():
+    return add_features(pd.read_pickle(DATA_PATH))
+
+# full_dataset.pkl: every crash, before the merge with the weather data
+def load_unmerged():
+    unmerged = pd.read_pickle(FULL_DATA_PATH)
+    unmerged['CRASH_DATE'] = pd.to_datetime(unmerged['CRASH_DATE'])
+    return unmerged
+
+# The rollups of an input, reused from ROLLUP_DIR while its input key is unchanged
+def cached_rollups(input, build):
+    directory = os.path.join(ROLLUP_DIR, input)
+    arrays, meta = load_arrays(directory)
+    path = INPUTS[input][0]
+    source = source_fingerprint(path, meta.get('source') if meta else None)
+    key = input_key(input, {path: source})
+    if meta and meta.get('key') == key:
+        return Rollups.from_arrays(arrays, meta)
+    rollups = build()
+    save_arrays(directory, rollups.arrays, dict(rollups.meta(), source=source, key=key))
+    return rollups
+
+# Crashes per hour, day and month of dataset.pkl, by weather
+def load_crash_rollups():
+    def build():
+        crashes = load('crashes')
+        return Rollups.build(crashes['CRASH_DATE'].to_numpy(dtype='datetime64[ns]').view(np.int64), crashes['weather'])
+    return cached_rollups('crash_rollups', build)
+
+# Crashes per hour, day and month of full_dataset.pkl
+def load_unmerged_rollups():
+    def build():
+        return Rollups.build(load_unmerged()['CRASH_DATE'].to_numpy(dtype='datetime64[ns]').view(np.int64))
+    return cached_rollups('unmerged_rollups', build)
+
+
+FEATURE_CODE = [load_crashes, add_features, weather_condition, hour_key, in_excluded_hours]
+
+# Aggregations the plot functions call; part of every plot's hash
+AGGREGATION_CODE = [dominant]
+
+# Inputs of the plots: source pickle, loader, and the code and parameters
+# the loaded frame depends on
+INPUTS = {
+    'crashes': (DATA_PATH, load_crashes, FEATURE_CODE, {'excluded_hours': EXCLUDED_HOURS}),
+    'crash_rollups': (DATA_PATH, load_crash_rollups, FEATURE_CODE + [cached_rollups],
+                      {'excluded_hours': EXCLUDED_HOURS, 'days': DAYS, 'rollup_version': ROLLUP_VERSION}),
+    'unmerged_rollups': (FULL_DATA_PATH, load_unmerged_rollups, [load_unmerged, cached_rollups],
+                         {'rollup_version': ROLLUP_VERSION}),
 }
-days = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
 
-num_weeks = (df['CRASH_DATE'].max() - df['CRASH_DATE'].min()).days / 7
+# Frames loaded in this process. Loaded before the pool starts, they are
+# inherited by forked workers; otherwise every worker loads what it needs
+frames = {}
+
 
-hourly = (
-    df.groupby(['CRASH_DAY_OF_WEEK', 'CRASH_HOUR'])
-    .size()
-    .reset_index(name='Count')
-)
+def load(input):
+    if input not in frames:
+        frames[input] = INPUTS[input][1]()
+    return frames[input]
 
-hourly['CRASH_DAY_OF_WEEK'] = pd.Categorical(hourly['CRASH_DAY_OF_WEEK'], categories=days)
-hourly = hourly.sort_values(['CRASH_DAY_OF_WEEK', 'CRASH_HOUR'])
 
-fig = go.Figure()
+####################### Plot 0 #######################
+# Daily and monthly crash counts
+def crashes_over_time(rollups):
+    daily_crashes = rollups.frame('day')
+    # Remove October 24, 2025
+    daily_crashes = daily_crashes[daily_crashes['period'] != pd.Timestamp('2025-10-24')].reset_index(drop=True)
+
+    monthly_crashes = (
+        daily_crashes.groupby(daily_crashes['period'].dt.to_period('M'))['crashes']
+                     .sum()
+                     .reset_index()
+    )
+    daily_crashes.columns = ['date', 'crash_count']
+    daily_crashes['date'] = daily_crashes['date'].dt.date
+
+    monthly_crashes.columns = ['month', 'crash_count']
+    monthly_crashes['month'] = monthly_crashes['month'].dt.to_timestamp()
+
+    fig = go.Figure()
+
+    fig.add_trace(go.Scatter(
+        x=daily_crashes['date'],
+        y=daily_crashes['crash_count'],
+        mode='lines',
+        line=dict(color='coral', width=1),
+        name='Daily Crashes',
+        hovertemplate='%{x|%Y-%m-%d}<br>Crashes: %{y}<extra></extra>'
+    ))
 
-for day in days:
-    day_data = hourly[hourly['CRASH_DAY_OF_WEEK'] == day]
     fig.add_trace(go.Scatter(
-        x=day_data['CRASH_HOUR'],
-        y=day_data['Count'] / num_weeks,
+        x=monthly_crashes['month'],
+        y=monthly_crashes['crash_count'],
         mode='lines+markers',
-        name=day,
-        line=dict(width=2, color=colors[day]),
-        marker=dict(size=5, color=colors[day], symbol='circle'),
-        opacity=0.7
+        line=dict(color='rgba(255,140,0,0.6)', width=3),
+        marker=dict(size=8, color='rgba(255,140,0,0.6)'),
+        name='Monthly Crashes',
+        hovertemplate='%{x|%b %Y}<br>Crashes: %{y}<extra></extra>'
     ))
 
-fig.update_layout(
-    title='Hourly Crashes Across a Day',
-    xaxis_title='Hour',
-    yaxis_title='Number of Crashes',
-    legend_title='Day of Week',
-    xaxis=dict(
-        tickmode='linear',
-        tick0=0,
-        dtick=1,
-        range=[0, 23],
-        showgrid=True,
-        gridwidth=1,
-        gridcolor='lightgray'
-    ),
-    yaxis=dict(showgrid=True, gridwidth=1, gridcolor='lightgray'),
-    plot_bgcolor='white',
-    width=580,
-    height=380
-)
-
-fig.write_html("plots/plot1.html")
+    fig.update_layout(
+        title='Daily and Monthly Traffic Crashes',
+        xaxis_title='Date',
+        yaxis_title='Crash Count',
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        xaxis=dict(showgrid=True, gridcolor='lightgray'),
+        yaxis=dict(showgrid=True, gridcolor='lightgray'),
+        width=580,
+        height=380,
+        legend=dict(orientation='h', y=-0.2, x=0.5,
+                    xanchor='center', yanchor='top')
+    )
+
+    fig.update_xaxes(
+        dtick="M12",
+        tickformat="%Y",
+        tickangle=0
+    )
+
+    return fig
+
+
+####################### Plot 1 #######################
+# Average crashes per hour of the day, one line per weekday
+def hourly_by_weekday(rollups):
+    colors = {
+        'Sunday': 'black',
+        'Monday': 'lightcoral',
+        'Tuesday': 'orange',
+        'Wednesday': 'lawngreen',
+        'Thursday': 'red',
+        'Friday': 'blue',
+        'Saturday': 'darkviolet'
+    }
+
+    first, last = (pd.Timestamp(t) for t in rollups.span)
+    num_weeks = (last - first).days / 7
+
+    hours = rollups.frame('hour')
+    hours['day_of_week'] = pd.Categorical(hours['period'].dt.day_name(), categories=DAYS)
+    hours['hour'] = hours['period'].dt.hour
+    hourly = (
+        hours.groupby(['day_of_week', 'hour'], observed=True)['crashes']
+        .sum()
+        .reset_index(name='Count')
+    )
+
+    fig = go.Figure()
+
+    for day in DAYS:
+        day_data = hourly[hourly['day_of_week'] == day]
+        fig.add_trace(go.Scatter(
+            x=day_data['hour'],
+            y=day_data['Count'] / num_weeks,
+            mode='lines+markers',
+            name=day,
+            line=dict(width=2, color=colors[day]),
+            marker=dict(size=5, color=colors[day], symbol='circle'),
+            opacity=0.7
+        ))
+
+    fig.update_layout(
+        title='Hourly Crashes Across a Day',
+        xaxis_title='Hour',
+        yaxis_title='Number of Crashes',
+        legend_title='Day of Week',
+        xaxis=dict(
+            tickmode='linear',
+            tick0=0,
+            dtick=1,
+            range=[0, 23],
+            showgrid=True,
+            gridwidth=1,
+            gridcolor='lightgray'
+        ),
+        yaxis=dict(showgrid=True, gridwidth=1, gridcolor='lightgray'),
+        plot_bgcolor='white',
+        width=580,
+        height=380
+    )
+
+    return fig
 
 
 ####################### Plot 2 #######################
-df = data.copy()
-df['CRASH_DATE'] = pd.to_datetime(df['CRASH_DATE'])
-df['hour'] = df['CRASH_DATE'].dt.hour
-df['date'] = df['CRASH_DATE'].dt.date
-
-def categorize(row):
-    if row['Precipitation Type'] == 70:
-        return 'Snow'
-    elif row['Interval Rain'] > 0:
-        return 'Rain'
-    else:
-        return 'Clear'
-
-df['condition'] = df.apply(categorize, axis=1)
-
-hourly_crashes = (
-    df.groupby(['date','hour','condition'])['CRASH_RECORD_ID']
-      .count()
-      .reset_index()
-      .rename(columns={'CRASH_RECORD_ID':'crash_count'})
-)
-
-hourly_avg = (
-    hourly_crashes.groupby(['hour','condition'])['crash_count']
-                  .mean()
-                  .reset_index()
-)
-
-fig = px.bar(
-    hourly_avg,
-    x='hour',
-    y='crash_count',
-    color='condition',
-    barmode='group',
-    labels={'hour':'Hour of Day', 'crash_count':'Average Number of Crashes', 'condition':'Condition'},
-    title='Average Hourly Crashes by Weather Condition',
-    color_discrete_map={'Clear':'orange', 'Snow':'lightblue', 'Rain':'lightseagreen'}
-)
-
-fig.update_layout(
-    xaxis=dict(tickmode='linear'),
-    yaxis=dict(showgrid=True),
-    plot_bgcolor='white',
-    width=580,
-    height=380
-)
-
-fig.write_html("plots/plot2.html")
+# Average crashes per hour of the day by weather condition
+def hourly_by_weather(rollups):
+    # Crashes in every hour that had some, by weather
+    hourly_crashes = rollups.frame('hour')
+    hourly_crashes['hour'] = hourly_crashes['period'].dt.hour
+
+    hourly_avg = (
+        hourly_crashes.groupby(['hour','condition'], observed=True)['crashes']
+                      .mean()
+                      .reset_index()
+                      .rename(columns={'crashes':'crash_count'})
+    )
+    hourly_avg['condition'] = hourly_avg['condition'].astype(str)
+
+    fig = px.bar(
+        hourly_avg,
+        x='hour',
+        y='crash_count',
+        color='condition',
+        barmode='group',
+        labels={'hour':'Hour of Day', 'crash_count':'Average Number of Crashes', 'condition':'Condition'},
+        title='Average Hourly Crashes by Weather Condition',
+        color_discrete_map={'Clear':'orange', 'Snow':'lightblue', 'Rain':'lightseagreen'}
+    )
+
+    fig.update_layout(
+        xaxis=dict(tickmode='linear'),
+        yaxis=dict(showgrid=True),
+        plot_bgcolor='white',
+        width=580,
+        height=380
+    )
+
+    return fig
 
 
 ####################### Plot 3 #######################
-df = data.copy()
-df = df[df['Precipitation Type'] != 70]
-df['CRASH_DATE'] = pd.to_datetime(df['CRASH_DATE'])
-
-df['year'] = df['CRASH_DATE'].dt.year
-df['month'] = df['CRASH_DATE'].dt.month
-df['day'] = df['CRASH_DATE'].dt.day
-df['hour'] = df['CRASH_DATE'].dt.hour
-
-exclude = []
-mask = ~df[['year','month','day','hour']].apply(tuple, axis=1).isin(exclude)
-df_filtered = df[mask]
-
-hourly_per_day = df_filtered.groupby([
-    df_filtered['CRASH_DATE'].dt.date.rename('date'),
-    df_filtered['CRASH_DATE'].dt.hour.rename('hour')
-]).agg({
-    'CRASH_RECORD_ID': 'count',
-    'Interval Rain': 'mean'
-}).reset_index()
-
-hourly_per_day.rename(columns={'CRASH_RECORD_ID': 'crash_count'}, inplace=True)
-
-x = hourly_per_day['Interval Rain']
-y = hourly_per_day['crash_count']
-m, b = np.polyfit(x, y, 1)
-y_fit = m*x + b
-
-fig = go.Figure()
-
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y,
-    mode='markers',
-    marker=dict(color='lightseagreen', opacity=0.3),
-    name='Hourly Crashes',
-))
-
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y_fit,
-    mode='lines',
-    line=dict(color='black', width=2),
-    name=f'Linear Regression: y={m:.2f}x+{b:.2f}',
-))
-
-fig.update_layout(
-    legend=dict(
-        orientation='h',
-        y=-0.2,
-        x=0.5,
-        xanchor='center',
-        yanchor='top'
+# Hourly crashes against rainfall, snow hours left out
+def rain_regression(data):
+    df_filtered = data.loc[(data['Precipitation Type'] != 70) & ~data['excluded'], ['date', 'hour', 'CRASH_RECORD_ID', 'Interval Rain']]
+
+    hourly_per_day = df_filtered.groupby(['date', 'hour']).agg({
+        'CRASH_RECORD_ID': 'count',
+        'Interval Rain': 'mean'
+    }).reset_index()
+
+    hourly_per_day.rename(columns={'CRASH_RECORD_ID': 'crash_count'}, inplace=True)
+
+    x = hourly_per_day['Interval Rain']
+    y = hourly_per_day['crash_count']
+    m, b = np.polyfit(x, y, 1)
+    y_fit = m*x + b
+
+    fig = go.Figure()
+
+    fig.add_trace(go.Scatter(
+        x=x,
+        y=y,
+        mode='markers',
+        marker=dict(color='lightseagreen', opacity=0.3),
+        name='Hourly Crashes',
+    ))
+
+    fig.add_trace(go.Scatter(
+        x=x,
+        y=y_fit,
+        mode='lines',
+        line=dict(color='black', width=2),
+        name=f'Linear Regression: y={m:.2f}x+{b:.2f}',
+    ))
+
+    fig.update_layout(
+        legend=dict(
+            orientation='h',
+            y=-0.2,
+            x=0.5,
+            xanchor='center',
+            yanchor='top'
+        )
     )
-)
 
 
-fig.update_layout(
-    title='Hourly Traffic Crashes During Rain',
-    xaxis_title='Hourly Rain (mm)',
-    yaxis_title='Crash Count',
-    plot_bgcolor='rgb(223, 223, 223)',
-    paper_bgcolor='rgb(223, 223, 223)',
-    xaxis=dict(showgrid=True, gridcolor='lightgray'),
-    yaxis=dict(showgrid=True, gridcolor='lightgray'),
-    width=580,
-    height=380
-)
+    fig.update_layout(
+        title='Hourly Traffic Crashes During Rain',
+        xaxis_title='Hourly Rain (mm)',
+        yaxis_title='Crash Count',
+        plot_bgcolor='rgb(223, 223, 223)',
+        paper_bgcolor='rgb(223, 223, 223)',
+        xaxis=dict(showgrid=True, gridcolor='lightgray'),
+        yaxis=dict(showgrid=True, gridcolor='lightgray'),
+        width=580,
+        height=380
+    )
+
+    return fig
 
-fig.write_html("plots/plot3.html")
 
 ####################### Plot 4 #######################
-df = df.copy()
-df = df[df['Precipitation Type'] != 60]
-df['CRASH_DATE'] = pd.to_datetime(df['CRASH_DATE'])
-
-df['year'] = df['CRASH_DATE'].dt.year
-df['month'] = df['CRASH_DATE'].dt.month
-df['day'] = df['CRASH_DATE'].dt.day
-df['hour'] = df['CRASH_DATE'].dt.hour
-
-exclude = []
-mask = ~df[['year','month','day','hour']].apply(tuple, axis=1).isin(exclude)
-df_filtered = df[mask]
-
-hourly_per_day = df_filtered.groupby([
-    df_filtered['CRASH_DATE'].dt.date.rename('date'),
-    df_filtered['CRASH_DATE'].dt.hour.rename('hour')
-]).agg({
-    'CRASH_RECORD_ID': 'count',
-    'Interval Rain': 'mean'
-}).reset_index()
-
-hourly_per_day.rename(columns={'CRASH_RECORD_ID': 'crash_count'}, inplace=True)
-
-x = hourly_per_day['Interval Rain']
-y = hourly_per_day['crash_count']
-m, b = np.polyfit(x, y, 1)
-y_fit = m*x + b
-
-fig = go.Figure()
-
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y,
-    mode='markers',
-    marker=dict(color='lightblue', opacity=0.5),
-    name='Hourly Crashes'
-))
-
-fig.add_trace(go.Scatter(
-    x=x,
-    y=y_fit,
-    mode='lines',
-    line=dict(color='black', width=2),
-    name=f'Linear Regression: y={m:.2f}x+{b:.2f}'
-))
-
-fig.update_layout(
-    legend=dict(
-        orientation='h',
-        y=-0.2,
-        x=0.5,
-        xanchor='center',
-        yanchor='top'
+# Hourly crashes against snowfall, rain hours left out
+def snow_regression(data):
+    df_filtered = data.loc[(data['Precipitation Type'] != 60) & ~data['excluded'], ['date', 'hour', 'CRASH_RECORD_ID', 'Interval Rain']]
+
+    hourly_per_day = df_filtered.groupby(['date', 'hour']).agg({
+        'CRASH_RECORD_ID': 'count',
+        'Interval Rain': 'mean'
+    }).reset_index()
+
+    hourly_per_day.rename(columns={'CRASH_RECORD_ID': 'crash_count'}, inplace=True)
+
+    x = hourly_per_day['Interval Rain']
+    y = hourly_per_day['crash_count']
+    m, b = np.polyfit(x, y, 1)
+    y_fit = m*x + b
+
+    fig = go.Figure()
+
+    fig.add_trace(go.Scatter(
+        x=x,
+        y=y,
+        mode='markers',
+        marker=dict(color='lightblue', opacity=0.5),
+        name='Hourly Crashes'
+    ))
+
+    fig.add_trace(go.Scatter(
+        x=x,
+        y=y_fit,
+        mode='lines',
+        line=dict(color='black', width=2),
+        name=f'Linear Regression: y={m:.2f}x+{b:.2f}'
+    ))
+
+    fig.update_layout(
+        legend=dict(
+            orientation='h',
+            y=-0.2,
+            x=0.5,
+            xanchor='center',
+            yanchor='top'
+        )
     )
-)
 
-fig.update_layout(
-    title='Hourly Traffic Crashes During Snowfall',
-    xaxis_title='Hourly Snow (mm)',
-    yaxis_title='Crash Count',
-    plot_bgcolor='rgb(223, 223, 223)',
-    paper_bgcolor='rgb(223, 223, 223)',
-    xaxis=dict(showgrid=True, gridcolor='lightgray'),
-    yaxis=dict(showgrid=True, gridcolor='lightgray'),
-    width=580,
-    height=380
-)
+    fig.update_layout(
+        title='Hourly Traffic Crashes During Snowfall',
+        xaxis_title='Hourly Snow (mm)',
+        yaxis_title='Crash Count',
+        plot_bgcolor='rgb(223, 223, 223)',
+        paper_bgcolor='rgb(223, 223, 223)',
+        xaxis=dict(showgrid=True, gridcolor='lightgray'),
+        yaxis=dict(showgrid=True, gridcolor='lightgray'),
+        width=580,
+        height=380
+    )
 
-fig.write_html("plots/plot4.html")
+    return fig
 
 
 ####################### Plot 5 #######################
-df = data.copy()
-df = df[df['condition'].isin(['CLEAR', 'RAIN', 'SNOW'])]
-df['CRASH_DATE'] = pd.to_datetime(df['CRASH_DATE'])
-
-daily_crashes = df.groupby(
-    df['CRASH_DATE'].dt.date.rename('date')
-).agg({
-    'CRASH_RECORD_ID': 'count',
-    'condition': lambda x: x.mode()[0].capitalize()
-}).reset_index()
-
-daily_crashes.rename(columns={'CRASH_RECORD_ID': 'crash_count'}, inplace=True)
-
-fig = px.violin(
-    daily_crashes,
-    x='condition',
-    y='crash_count',
-    color='condition',
-    box=True,
-    points='all',
-    labels={'condition':'Condition', 'crash_count':'Daily Crash Count'},
-    title='Daily Crash Count by Weather Condition',
-    color_discrete_map={'Clear':'orange', 'Rain':'lightseagreen', 'Snow':'lightblue'}
-)
-
-
-fig.update_traces(marker=dict(opacity=0.5))
-
-fig.update_layout(
-    plot_bgcolor='white',
-    paper_bgcolor='white',
-    xaxis=dict(showgrid=False),
-    yaxis=dict(showgrid=True),
-    width=580,
-    height=380
-)
-
-fig.write_html("plots/plot5.html")
+# Daily crash counts by the day's most common weather condition
+def daily_by_weather(data):
+    df = data.loc[data['condition'].isin(['CLEAR', 'RAIN', 'SNOW']), ['date', 'CRASH_RECORD_ID', 'condition']]
+
+    daily_crashes = pd.DataFrame({
+        'CRASH_RECORD_ID': df.groupby('date')['CRASH_RECORD_ID'].count(),
+        'condition': dominant(df['date'], df['condition']).str.capitalize()
+    }).reset_index()
+
+    daily_crashes.rename(columns={'CRASH_RECORD_ID': 'crash_count'}, inplace=True)
+
+    fig = px.violin(
+        daily_crashes,
+        x='condition',
+        y='crash_count',
+        color='condition',
+        box=True,
+        points='all',
+        labels={'condition':'Condition', 'crash_count':'Daily Crash Count'},
+        title='Daily Crash Count by Weather Condition',
+        color_discrete_map={'Clear':'orange', 'Rain':'lightseagreen', 'Snow':'lightblue'}
+    )
+
+
+    fig.update_traces(marker=dict(opacity=0.5))
+
+    fig.update_layout(
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        xaxis=dict(showgrid=False),
+        yaxis=dict(showgrid=True),
+        width=580,
+        height=380
+    )
+
+    return fig
+
+
+# Output name: (function returning the figure, input it reads)
+PLOTS = {
+    'plot0': (crashes_over_time, 'unmerged_rollups'),
+    'plot1': (hourly_by_weekday, 'crash_rollups'),
+    'plot2': (hourly_by_weather, 'crash_rollups'),
+    'plot3': (rain_regression, 'crashes'),
+    'plot4': (snow_regression, 'crashes'),
+    'plot5': (daily_by_weather, 'crashes'),
+}
+
+
+####################### Build #######################
+def plot_path(name):
+    return os.path.join(PLOTS_DIR, name + '.html')
+
+
+def read_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {'sources': {}, 'plots': {}}
+    with open(MANIFEST_PATH) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'sources': {}, 'plots': {}}
+    return manifest
+
+
+def write_manifest(manifest):
+    """Write the manifest to a temporary file and move it into place"""
+    tmp_path = MANIFEST_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(manifest, version=MANIFEST_VERSION), f, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path, known):
+    """Size, mtime and checksum of a pickle; the checksum in known is reused if size and mtime match"""
+    stat = os.stat(path)
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return known
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'checksum': file_checksum(path)}
+
+
+def input_key(input, sources):
+    """Hash of everything an input frame depends on"""
+    path, loader, helpers, params = INPUTS[input]
+    digest = hashlib.sha256()
+    for part in [sources[path]['checksum'], pd.__version__, json.dumps(params, sort_keys=True)]:
+        digest.update(part.encode() + b'\0')
+    for code in [loader] + helpers:
+        digest.update(inspect.getsource(code).encode() + b'\0')
+    return digest.hexdigest()
+
+
+def input_hash(name, sources):
+    """Hash of everything a plot's output depends on"""
+    fn, input = PLOTS[name]
+    digest = hashlib.sha256()
+    code = [fn] + AGGREGATION_CODE
+    for part in [input_key(input, sources), plotly.__version__] + [inspect.getsource(c) for c in code]:
+        digest.update(part.encode() + b'\0')
+    return digest.hexdigest()
+
+
+def build(name):
+    """Render one plot and write its HTML; returns how long it took"""
+    start = time.perf_counter()
+    fn, input = PLOTS[name]
+    fn(load(input)).write_html(plot_path(name))
+    return time.perf_counter() - start
+
+
+def make_plots(names=None, jobs=None, force=False):
+    """Rebuild the plots whose inputs changed; returns (built {name: seconds}, skipped names)"""
+    names = list(PLOTS) if names is None else names
+    os.makedirs(PLOTS_DIR, exist_ok=True)
+    manifest = read_manifest()
+    paths = {INPUTS[PLOTS[name][1]][0] for name in names}
+    sources = {path: source_fingerprint(path, manifest['sources'].get(path)) for path in paths}
+    hashes = {name: input_hash(name, sources) for name in names}
+    stale = [name for name in names
+             if force or manifest['plots'].get(name) != hashes[name] or not os.path.exists(plot_path(name))]
+
+    built = {}
+    if stale:
+        # Load the inputs once here so forked workers share them
+        for input in {PLOTS[name][1] for name in stale}:
+            load(input)
+        jobs = min(jobs or os.cpu_count(), len(stale))
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                built = dict(zip(stale, pool.map(build, stale)))
+        else:
+            built = {name: build(name) for name in stale}
+
+    manifest['sources'].update(sources)
+    manifest['plots'].update({name: hashes[name] for name in built})
+    write_manifest(manifest)
+    return built, [name for name in names if name not in built]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the plots of the website')
+    parser.add_argument('--only', action='append', choices=list(PLOTS), metavar='PLOT',
+                        help='build only this plot (repeatable): ' + ', '.join(PLOTS))
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the inputs did not change')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    built, skipped = make_plots(args.only, args.jobs, args.force)
+    for name, seconds in built.items():
+        print(f'{plot_path(name):<20} {seconds:6.2f}s')
+    if skipped:
+        print('Up to date: ' + ', '.join(skipped))
+    print(f'{len(built)} plots built in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()